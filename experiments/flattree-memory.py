@@ -0,0 +1,82 @@
+# Memory use and lookup time of WildTree versus FlatWildTree for a
+# tree shaped like a large permission tree: per-organisation and
+# per-project rules for a set of actions, plus some wildcard rules.
+#
+# Frozen WildTree nodes are hash-consed in a table shared by all trees,
+# so the table is cleared before each measurement: otherwise nodes
+# interned for earlier trees wouldn't be counted.
+#
+# Run from the top-level directory: python experiments/flattree-memory.py
+
+import gc
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, '.')
+
+from tutelary import wildtree  # noqa
+from tutelary.flattree import FlatWildTree  # noqa
+from tutelary.wildtree import WildTree  # noqa
+
+
+ACTIONS = [('parcel', 'view'), ('parcel', 'edit'), ('party', 'view'),
+           ('party', 'edit'), ('project', 'view')]
+
+
+def keys(norgs, nprojs):
+    for a in ACTIONS:
+        yield a + ('*', '*', '*'), 'deny'
+    for o in range(norgs):
+        for a in ACTIONS:
+            yield a + ('org%d' % o, '*', '*'), 'allow'
+            for p in range(nprojs):
+                yield a + ('org%d' % o, 'proj%d' % p, '*'), 'deny'
+
+
+def measure(build):
+    wildtree._canonical.clear()
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    obj = build()
+    elapsed = time.perf_counter() - start
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return obj, size, elapsed
+
+
+def build_wild(norgs, nprojs):
+    t = WildTree()
+    for k, v in keys(norgs, nprojs):
+        t[k] = v
+    return t
+
+
+wild_frozen = None
+for norgs, nprojs in [(5, 10), (10, 20), (20, 25)]:
+    wild_frozen = None
+    wild, _, _ = measure(lambda: build_wild(norgs, nprojs))
+    wild_frozen, wsize, _ = measure(
+        lambda: build_wild(norgs, nprojs).freeze()
+    )
+    flat, fsize, _ = measure(lambda: FlatWildTree.from_tree(wild))
+    nodes = flat.node_count()
+    assert repr(flat) == repr(wild)
+
+    probe = ('parcel', 'edit', 'org3', 'proj4', 'x')
+    n = 20000
+    start = time.perf_counter()
+    for _ in range(n):
+        wild_frozen[probe]
+    wtime = (time.perf_counter() - start) / n
+    start = time.perf_counter()
+    for _ in range(n):
+        flat[probe]
+    ftime = (time.perf_counter() - start) / n
+
+    print('{:5d} keys, {:5d} nodes: WildTree {:8d} bytes ({:5.1f}/node), '
+          'FlatWildTree {:7d} bytes ({:4.1f}/node), {:4.1f}x smaller; '
+          'lookup {:.1f} us vs {:.1f} us, {:4.1f}x slower'.format(
+              len(wild), nodes, wsize, wsize / nodes, fsize, fsize / nodes,
+              wsize / fsize, wtime * 1e6, ftime * 1e6, ftime / wtime))
@@ -0,0 +1,83 @@
+import pytest
+from tutelary.codec import dump_tree, load_tree, load_permission_tree
+from tutelary.engine import PermissionTree, PolicyBody, Action, Object
+from tutelary.wildtree import WildTree
+from .datadir import datadir  # noqa
+
+
+def _tree():
+    t = WildTree()
+    t[('a', 'b', 'c')] = 1
+    t[('a', '*', 'e')] = 3
+    t[('a', 'b', 'd')] = 'two'
+    t[('x',)] = {'nested': [1, 2]}
+    t[('a', 'bé', '*')] = None
+    return t
+
+
+@pytest.mark.parametrize('lazy', [False, True])
+def test_codec_roundtrip(lazy):
+    t = _tree()
+    u = load_tree(dump_tree(t), lazy=lazy)
+    assert u.frozen
+    assert repr(u) == repr(t)
+    assert u == t
+    assert u[('a', 'b', 'c')] == 1
+    assert u[('a', 'q', 'e')] == 3
+    assert u[('x',)] == {'nested': [1, 2]}
+    with pytest.raises(KeyError):
+        u[('a', 'x', 'f')]
+    with pytest.raises(TypeError):
+        u[('a', 'b', 'c')] = 4
+
+
+def test_codec_lazy_materialisation():
+    u = load_tree(dump_tree(_tree()), lazy=True)
+    assert u.root.subtrees is None
+    assert u[('x',)] == {'nested': [1, 2]}
+    # Only the path to the key has been decoded.
+    assert u.root.subtrees is not None
+    a = [st for k, st in u.root[1] if k == 'a'][0]
+    assert a.subtrees is None
+
+    # Copies of lazily loaded trees can be modified.
+    v = u.copy()
+    v[('a', 'b', 'c')] = 5
+    assert v[('a', 'b', 'c')] == 5
+    assert u[('a', 'b', 'c')] == 1
+
+
+def test_codec_bad_data():
+    data = dump_tree(_tree())
+    with pytest.raises(ValueError):
+        load_tree(b'JUNK' + data[4:])
+    with pytest.raises(ValueError):
+        load_tree(data[:4] + b'\x02\x00' + data[6:])
+    with pytest.raises(ValueError):
+        load_tree(data[:-4])
+
+
+def test_codec_permission_tree(datadir):  # noqa
+    v = {'organisation': 'Cadasta', 'project': 'Test'}
+    pols = [PolicyBody(json=datadir.join(f).read(), variables=v)
+            for f in ['default-policy.json', 'org-policy.json',
+                      'project-policy.json', 'org-admin-policy.json']]
+    ptree = PermissionTree(policies=pols)
+    data = dump_tree(ptree)
+    assert len(data) < len(repr(ptree))
+    for lazy in [False, True]:
+        loaded = load_permission_tree(data, lazy=lazy)
+        assert repr(loaded) == repr(ptree)
+        assert loaded.allow(Action('parcel.edit'),
+                            Object('Cadasta/Test/parcel/123'))
+        assert not loaded.allow(Action('admin.assign-role'),
+                                Object('user/iross'))
+        assert not loaded.object_first
+
+    otree = PermissionTree(policies=pols, object_first=True)
+    for lazy in [False, True]:
+        loaded = load_permission_tree(dump_tree(otree), lazy=lazy)
+        assert loaded.object_first
+        assert repr(loaded) == repr(otree)
+        assert loaded.allow(Action('parcel.edit'),
+                            Object('Cadasta/Test/parcel/123'))
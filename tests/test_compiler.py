@@ -0,0 +1,238 @@
+from tutelary.compiler import (
+    compile_tree, compile_trees, policy_body, policy_clauses, policy_tree
+)
+from tutelary.engine import Action, Object, PermissionTree, PolicyBody
+from tutelary.exceptions import VariableSubstitutionException
+import pytest
+from .datadir import datadir  # noqa
+
+
+def _specs(datadir):  # noqa
+    def pol(f):
+        return datadir.join(f).read()
+    specs = []
+    for org in ['Cadasta', 'H4H']:
+        for proj in ['Test', 'PaP']:
+            v = {'organisation': org, 'project': proj}
+            base = [(pol('default-policy.json'), v),
+                    (pol('org-policy.json'), v),
+                    (pol('project-policy.json'), v)]
+            for extra in ['sys-admin-policy.json', 'org-admin-policy.json',
+                          'data-collector-policy.json']:
+                specs.append(base + [(pol(extra), v)])
+    return specs
+
+
+def test_compile_trees_serial(datadir):  # noqa
+    specs = _specs(datadir)
+    timings = []
+    trees = compile_trees(specs, workers=1, timings=timings)
+    assert len(trees) == len(timings) == len(specs)
+    assert all(t.frozen for t in trees)
+    assert trees[0].allow(Action('parcel.edit'),
+                          Object('Cadasta/Test/parcel/123'))
+    assert not trees[2].allow(Action('admin.invite'), Object('org/Cadasta'))
+
+
+def test_compile_trees_parallel(datadir):  # noqa
+    specs = _specs(datadir)
+    timings = []
+    trees = compile_trees(specs, workers=3, timings=timings)
+    assert len(timings) == len(specs)
+    assert all(t.frozen for t in trees)
+    assert [repr(t) for t in trees] == [repr(compile_tree(s)) for s in specs]
+
+
+def test_compile_trees_prefix_spec(datadir):  # noqa
+    from tutelary import compiler
+    compiler.clear_caches()
+    # Compiling the longer specification first leaves the shorter one's
+    # tree in the prefix cache, but the result must still be the same
+    # as when compiled on its own in a worker process.
+    spec = _specs(datadir)[0]
+    specs = [spec, spec[:-1], spec[:2]]
+    serial = compile_trees(specs, workers=1)
+    parallel = compile_trees(specs, workers=3)
+    assert [repr(t) for t in serial] == [repr(t) for t in parallel]
+    compiler.clear_caches()
+    assert repr(compile_tree(spec[:-1])) == repr(serial[1])
+
+
+def test_compile_tree_prefix_reuse(datadir, monkeypatch):  # noqa
+    from tutelary import compiler
+    compiler.clear_caches()
+    parsed = []
+    policy_body = compiler.PolicyBody
+
+    def counting_policy_body(*args, **kwargs):
+        parsed.append(1)
+        return policy_body(*args, **kwargs)
+    monkeypatch.setattr(compiler, 'PolicyBody', counting_policy_body)
+
+    specs = _specs(datadir)
+    trees = [compile_tree(s) for s in specs]
+    # Each distinct policy body is parsed only once, whatever the
+    # variable assignments: there are five distinct policy bodies (the
+    # default and project policies are identical).
+    assert len(parsed) == 5
+    assert compile_tree(specs[0]) is trees[0]
+    assert len(parsed) == 5
+
+    # Prefixes are reused.
+    overlays = []
+    overlay = PermissionTree.overlay
+
+    def counting_overlay(self, other):
+        overlays.append(1)
+        return overlay(self, other)
+    monkeypatch.setattr(PermissionTree, 'overlay', counting_overlay)
+    compile_tree(specs[1] + [specs[0][3]])
+    assert len(overlays) == 1
+
+    compiler.clear_caches()
+    monkeypatch.setattr(compiler, 'PolicyBody', policy_body)
+    for spec, tree in zip(specs, trees):
+        expected = PermissionTree(
+            policies=[PolicyBody(json=b, variables=v) for b, v in spec]
+        )
+        _assert_same_permissions(tree, expected)
+    assert repr(compile_tree([])) == repr(PermissionTree())
+
+
+def _assert_same_permissions(tree, expected):
+    # Merged and minimised trees may differ structurally from trees
+    # built by inserting clauses one at a time, but give the same
+    # answers.
+    assert tree.tree.node_count() <= expected.tree.node_count()
+    for act in ['parcel.edit', 'parcel.view', 'parcel.create',
+                'admin.invite', 'statistics']:
+        for obj in [None, 'org/Cadasta', 'user/x', 'Cadasta/Test/parcel/1',
+                    'H4H/PaP/parcel', 'Other/Test/parcel/1']:
+            o = Object(obj) if obj is not None else None
+            assert (tree.allow(Action(act), o) ==
+                    expected.allow(Action(act), o))
+
+
+def test_compile_tree_prefix_cache_bounded(datadir, monkeypatch):  # noqa
+    from tutelary import compiler
+    compiler.clear_caches()
+    monkeypatch.setattr(compiler, 'PREFIX_CACHE_SIZE', 5)
+    for spec in _specs(datadir):
+        compile_tree(spec)
+    assert len(compiler._prefix_trees) == 5
+
+
+def _direct_tree(body, variables):
+    return PermissionTree(
+        policies=[PolicyBody(json=body, variables=variables)]
+    ).freeze()
+
+
+def test_policy_tree_template(datadir):  # noqa
+    from tutelary import compiler
+    compiler.clear_caches()
+    body = datadir.join('template-policy.json').read()
+    # Values that are separators or special characters, or that are
+    # equal to fixed pattern components or to each other, can't be
+    # substituted into the template tree.
+    for org, proj, templated in [
+            ('Cadasta', 'Batangas', True), ('H4H', 'SR-71', True),
+            (42, 'A', True), ('Cadasta', 'parcel', False),
+            ('a.b', 'c', False), ('x/y', 'z', False), ('Test', 'x', False),
+            ('Same', 'Same', False), ('', 'Test', False)]:
+        v = {'organisation': org, 'project': proj}
+        tree = policy_tree(body, v)
+        assert tree.frozen
+        assert repr(tree) == repr(_direct_tree(body, v))
+        _assert_same_permissions(tree, _direct_tree(body, v))
+        template, = compiler._templates.values()
+        assert (template.bind(v) is not None) == templated
+
+
+def test_policy_tree_template_shares_structure(datadir):  # noqa
+    from tutelary import compiler
+    compiler.clear_caches()
+    body = datadir.join('template-policy.json').read()
+    t1 = policy_tree(body, {'organisation': 'Cadasta', 'project': 'A'})
+    t2 = policy_tree(body, {'organisation': 'Cadasta', 'project': 'B'})
+    shared = {id(st) for _, st in t1.tree.root[1]}
+    assert any(id(st) in shared for _, st in t2.tree.root[1])
+
+    # Bodies without variables give the same tree for any variables.
+    body = datadir.join('sys-admin-policy.json').read()
+    assert (policy_tree(body, {'organisation': 'Cadasta'}) is
+            policy_tree(body, {'organisation': 'H4H'}))
+
+
+def test_policy_tree_template_errors(datadir):  # noqa
+    body = datadir.join('template-policy.json').read()
+    with pytest.raises(VariableSubstitutionException):
+        policy_tree(body, {'organisation': 'Cadasta'})
+
+
+def test_policy_body_cache(datadir, monkeypatch):  # noqa
+    from tutelary import compiler
+    compiler.clear_caches()
+    monkeypatch.setattr(compiler, 'POLICY_BODY_CACHE_SIZE', 2)
+    body = datadir.join('org-policy.json').read()
+    v1 = {'organisation': 'Cadasta', 'project': 'Test'}
+    v2 = {'project': 'Test', 'organisation': 'Cadasta'}
+    pb = policy_body(body, v1)
+    assert policy_body(body, v2) is pb
+    clauses = policy_clauses(body, v2)
+    assert clauses is policy_clauses(body, v1)
+    expected = PolicyBody(json=body, variables=v1)
+    assert ([(e, str(a), str(o)) for e, a, o in clauses] ==
+            [(e, str(a), str(o)) for e, a, o in expected])
+
+    policy_body(body, {'organisation': 'H4H'})
+    policy_body(body, {'organisation': 'Other'})
+    assert len(compiler._policy_bodies) == 2
+    assert policy_body(body, v1) is not pb
+    compiler.clear_caches()
+    assert len(compiler._policy_bodies) == 0
+
+
+def test_policy_tree_template_id_sets():
+    from tutelary import compiler
+    compiler.clear_caches()
+    body = ('{"clause": ['
+            '{"effect": "allow", "action": ["parcel.view"], '
+            '"object": ["$org/parcel/[1-100]"]}, '
+            '{"effect": "deny", "action": ["parcel.view"], '
+            '"object": ["$org/parcel/$id"]}]}')
+    # Numeric values could be members of the ID set, so the template
+    # can't be used for them.
+    for org, pid, templated in [
+            ('Cadasta', 'x', True), ('H4H', 'y-7', True),
+            ('Cadasta', 7, False), ('Cadasta', 700, False),
+            ('1', 'x', False)]:
+        v = {'org': org, 'id': pid}
+        tree = policy_tree(body, v)
+        assert repr(tree) == repr(_direct_tree(body, v))
+        template, = compiler._templates.values()
+        assert (template.bind(v) is not None) == templated
+
+
+def test_compile_tree_object_first(datadir):  # noqa
+    from tutelary import compiler
+    compiler.clear_caches()
+    specs = _specs(datadir)[:4]
+    trees = [compile_tree(s) for s in specs]
+    otrees = [compile_tree(s, object_first=True) for s in specs]
+    # The two key orders are cached separately.
+    assert all(t.object_first and not u.object_first
+               for t, u in zip(otrees, trees))
+    assert compile_tree(specs[0], object_first=True) is otrees[0]
+    assert compile_tree(specs[0]) is trees[0]
+    for otree, tree in zip(otrees, trees):
+        for act in ['parcel.edit', 'parcel.view', 'admin.invite']:
+            for obj in [None, 'org/Cadasta', 'Cadasta/Test/parcel/1']:
+                o = Object(obj) if obj is not None else None
+                assert (otree.allow(Action(act), o) ==
+                        tree.allow(Action(act), o))
+    parallel = compile_trees(specs, workers=2, object_first=True)
+    assert all(t.object_first for t in parallel)
+    assert [repr(t) for t in parallel] == [repr(t) for t in otrees]
+    assert (compiler.fingerprint(specs[0]) !=
+            compiler.fingerprint(specs[0], object_first=True))
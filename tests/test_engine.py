@@ -71,3 +71,21 @@ def test_object_wildcards():
     for o1, ms in zip(objs, matches):
         for o2, m in zip(objs, ms):
             assert o1.match(o2) == m
+
+
+def test_object_multi_wildcards():
+    objs = [Object('Cadasta/**'),
+            Object('Cadasta/**/parcel/*'),
+            Object('**/party/*'),
+            Object('Cadasta/Batangas/parcel/123'),
+            Object('H4H/party/12'),
+            Object('Cadasta')]
+    matches = [[True, True, True, True, False, True],
+               [True, True, False, True, False, False],
+               [True, False, True, False, True, False],
+               [True, True, False, True, False, False],
+               [False, False, True, False, True, False],
+               [True, False, False, False, False, True]]
+    for o1, ms in zip(objs, matches):
+        for o2, m in zip(objs, ms):
+            assert o1.match(o2) == m
@@ -0,0 +1,105 @@
+import random
+import pytest
+from tutelary.flattree import FlatWildTree
+from tutelary.wildtree import WildTree
+
+
+def test_flattree_basic():
+    t = FlatWildTree()
+    t[('a', 'b', 'c')] = 1
+    t[('a', 'b', 'd')] = 2
+    t[('a', 'b', '*')] = 3
+    t[('a', 'x', 'e')] = {'x': [1, 2]}
+    assert len(t) == 2
+    assert ('a', 'b', '*') in t
+    assert ('a', 'b', 'c') not in t
+    assert t[('a', 'b', 'c')] == 3
+    assert t[('a', 'b')] == 3
+    assert t[('a', 'x', 'e')] == {'x': [1, 2]}
+    with pytest.raises(KeyError):
+        t[('a', 'x', 'f')]
+    del t[('a', 'x', 'e')]
+    assert len(t) == 1
+    with pytest.raises(KeyError):
+        del t[('a', 'x', 'e')]
+    assert FlatWildTree(json=repr(t)) == t
+    assert list(t.items()) == [(('a', 'b', '*'), 3)]
+
+
+def test_flattree_node_reuse():
+    t = FlatWildTree()
+    for i in range(10):
+        t[('a', str(i))] = i
+    n = len(t.key)
+    t[('a', '*')] = 'all'
+    assert t.node_count() == 3
+    for i in range(5):
+        t[('b', str(i))] = i
+    assert len(t.key) == n
+
+
+def test_flattree_freeze_copy():
+    t = FlatWildTree()
+    t[('a', 'b')] = 1
+    t.freeze()
+    with pytest.raises(TypeError):
+        t[('a', 'c')] = 2
+    with pytest.raises(TypeError):
+        del t[('a', 'b')]
+    u = t.copy()
+    u[('a', 'c')] = 2
+    assert ('a', 'c') in u
+    assert ('a', 'c') not in t
+
+
+def _random_ops(rng, n, comps=('a', 'b', 'c', '*')):
+    ops = []
+    for _ in range(n):
+        key = tuple(rng.choice(comps) for _ in range(rng.randint(1, 3)))
+        if rng.random() < 0.2:
+            ops.append(('del', key, None))
+        else:
+            ops.append(('set', key, rng.choice(['allow', 'deny', 1, True])))
+    return ops
+
+
+@pytest.mark.parametrize('seed,comps,queries', [
+    (seed, ('a', 'b', 'c', '*'), ('a', 'b', 'c', 'd'))
+    for seed in range(20)
+] + [
+    (seed, ('1', '2', '[1-2]', '[2-3]', '*'), ('1', '2', '3', '4'))
+    for seed in range(20)
+] + [
+    (seed, ('a', 'b', '*', '**'), ('a', 'b', 'c'))
+    for seed in range(20)
+])
+def test_flattree_matches_wildtree(seed, comps, queries):
+    rng = random.Random(seed)
+    w, f = WildTree(), FlatWildTree()
+    for op, key, value in _random_ops(rng, 40, comps):
+        if op == 'set':
+            w[key] = value
+            f[key] = value
+        else:
+            assert _delete(w, key) == _delete(f, key)
+        assert repr(f) == repr(w)
+    assert len(f) == len(w)
+    assert list(f) == list(w)
+    assert repr(FlatWildTree.from_tree(w)) == repr(w)
+    for _ in range(50):
+        key = tuple(rng.choice(queries) for _ in range(rng.randint(0, 4)))
+        try:
+            expected = w.find(key)
+        except KeyError:
+            with pytest.raises(KeyError):
+                f.find(key)
+        else:
+            assert f.find(key) == expected
+
+
+def _delete(tree, key):
+    try:
+        del tree[key]
+        return True
+    except KeyError:
+        return False
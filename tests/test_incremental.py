@@ -0,0 +1,100 @@
+from tutelary.compiler import compile_tree, recompile_tree
+from tutelary.engine import Action, Object, PermissionTree, PolicyBody
+from tutelary.models import PermissionSet
+import pytest
+from .factories import UserFactory, PolicyFactory
+from .datadir import datadir  # noqa
+from .test_compiler import _assert_same_permissions
+
+
+def _spec(datadir, *files):  # noqa
+    v = {'organisation': 'Cadasta'}
+    return [(datadir.join(f).read(), v) for f in files]
+
+
+def _full(spec):
+    return PermissionTree(
+        policies=[PolicyBody(json=b, variables=v) for b, v in spec]
+    )
+
+
+def test_recompile_tree_unchanged(datadir):  # noqa
+    spec = _spec(datadir, 'default-policy.json', 'org-policy.json')
+    tree = compile_tree(spec)
+    assert recompile_tree(tree, spec, list(spec)) is tree
+
+
+def test_recompile_tree_appended_clause(datadir, monkeypatch):  # noqa
+    from tutelary import compiler
+    old = _spec(datadir, 'default-policy.json', 'org-policy.json')
+    new = _spec(datadir, 'default-policy.json', 'org-policy-appended.json')
+    tree = compile_tree(old)
+
+    # Appending clauses to the last policy only needs the new clauses
+    # to be inserted.
+    def no_compile(instances):
+        raise AssertionError('tree compiled from scratch')
+    monkeypatch.setattr(compiler, 'compile_tree', no_compile)
+    updated = recompile_tree(tree, old, new)
+    assert updated.frozen
+    assert updated.allow(Action('parcel.create'),
+                         Object('Cadasta/Test/parcel'))
+    assert not tree.allow(Action('parcel.create'),
+                          Object('Cadasta/Test/parcel'))
+    _assert_same_permissions(updated, _full(new))
+
+
+def test_recompile_tree_removed_clause(datadir):  # noqa
+    old = _spec(datadir, 'default-policy.json', 'org-policy.json')
+    new = _spec(datadir, 'default-policy.json', 'org-policy-removed.json')
+    tree = compile_tree(old)
+    obj = Object('Cadasta/Test/parcel/1')
+    assert not tree.allow(Action('parcel.edit'), obj)
+
+    # The rule from the lower precedence policy applies again.
+    updated = recompile_tree(tree, old, new)
+    assert updated.allow(Action('parcel.edit'), obj)
+    _assert_same_permissions(updated, _full(new))
+
+
+def test_recompile_tree_earlier_policy(datadir):  # noqa
+    old = _spec(datadir, 'org-policy.json', 'default-policy.json')
+    new = _spec(datadir, 'org-policy-appended.json', 'default-policy.json')
+    updated = recompile_tree(compile_tree(old), old, new)
+    _assert_same_permissions(updated, _full(new))
+
+
+@pytest.fixture(scope="function")  # noqa
+def setup(datadir, db):  # noqa
+    user = UserFactory.create(username='user')
+    PolicyFactory.set_directory(str(datadir))
+    def_pol = PolicyFactory.create(name='def', file='default-policy.json')
+    org_pol = PolicyFactory.create(name='org', file='org-policy.json')
+    user.assign_policies(def_pol, (org_pol, {'organisation': 'Cadasta'}))
+    return user, org_pol
+
+
+@pytest.mark.parametrize('body,allowed', [  # noqa
+    ('org-policy-appended.json', ('parcel.create', 'Cadasta/Test/parcel')),
+    ('org-policy-removed.json', ('parcel.edit', 'Cadasta/Test/parcel/1'))
+])
+def test_policy_edit_updates_cached_tree(datadir, setup,  # noqa
+                                         monkeypatch, body, allowed):
+    user, org_pol = setup
+    act, obj = allowed
+    assert not user.has_perm(act, Object(obj))
+    pset = user.permissionset.first()
+    old = PermissionSet.ptree_cache[pset.pk]
+
+    # Setting the body doesn't touch the cache until the policy is
+    # saved, and the cached tree is then updated rather than built
+    # again from the database.
+    org_pol.body = datadir.join(body).read()
+    assert PermissionSet.ptree_cache[pset.pk] is old
+    org_pol.save()
+
+    def no_build(self):
+        raise AssertionError('tree rebuilt')
+    monkeypatch.setattr(PermissionSet, '_build_tree', no_build)
+    assert PermissionSet.ptree_cache[pset.pk] is not old
+    assert user.has_perm(act, Object(obj))
@@ -0,0 +1,125 @@
+import pytest
+from tutelary.codec import dump_tree, load_permission_tree
+from tutelary.compiler import compile_layered_tree, compile_tree
+from tutelary.engine import Action, LayeredPermissionTree, Object
+from tutelary.models import PermissionSet
+from .factories import UserFactory, PolicyFactory
+from .datadir import datadir  # noqa
+
+
+ACTIONS = ['parcel.edit', 'parcel.view', 'parcel.create', 'party.edit',
+           'admin.invite', 'admin.assign', 'statistics']
+OBJECTS = [None, 'org/Cadasta', 'org/H4H', 'user/x', 'Cadasta/Test/parcel/1',
+           'Cadasta/Test/parcel', 'H4H/PaP/party/2', 'Other/Test/parcel/1']
+
+
+def _check_same(layered, composed):
+    for act in ACTIONS:
+        for obj in OBJECTS:
+            o = Object(obj) if obj is not None else None
+            assert (layered.allow(Action(act), o) ==
+                    composed.allow(Action(act), o))
+
+    def objf(a):
+        return Object('Cadasta/Test/parcel/1')
+    assert layered.permitted_actions(objf) == composed.permitted_actions(objf)
+
+
+def _instances(datadir, files, v):  # noqa
+    return [(datadir.join(f).read(), v) for f in files]
+
+
+def test_layered_tree(datadir):  # noqa
+    v = {'organisation': 'Cadasta', 'project': 'Test'}
+    orders = [
+        ['default-policy.json', 'org-policy.json', 'org-admin-policy.json'],
+        ['org-admin-policy.json', 'org-policy.json'],
+        ['sys-admin-policy.json', 'data-collector-policy.json',
+         'org-policy.json'],
+        ['data-collector-policy.json', 'sys-admin-policy.json']
+    ]
+    for files in orders:
+        instances = _instances(datadir, files, v)
+        layered = compile_layered_tree(instances)
+        composed = compile_tree(instances)
+        assert layered.frozen
+        assert len(layered.layers) == len(files)
+        _check_same(layered, composed)
+        # Composed trees are minimised after building.
+        expected = layered.copy()
+        expected.minimise()
+        assert sorted(expected.tree.items()) == sorted(composed.tree.items())
+        loaded = load_permission_tree(dump_tree(layered))
+        _check_same(loaded, composed)
+
+    assert not LayeredPermissionTree().allow(Action('parcel.edit'))
+
+
+def test_layered_tree_object_first(datadir, monkeypatch):  # noqa
+    monkeypatch.setattr(Action, 'registered',
+                        {Action(a) for a in ACTIONS})
+    v = {'organisation': 'Cadasta', 'project': 'Test'}
+    files = ['default-policy.json', 'org-policy.json',
+             'org-admin-policy.json', 'data-collector-policy.json']
+    for n in range(1, len(files) + 1):
+        instances = _instances(datadir, files[:n], v)
+        composed = compile_tree(instances)
+        layered = compile_layered_tree(instances, object_first=True)
+        assert layered.object_first
+        assert all(layer.object_first for layer in layered.layers)
+        _check_same(layered, composed)
+        _check_same(compile_tree(instances, object_first=True), composed)
+        loaded = load_permission_tree(dump_tree(layered))
+        assert loaded.object_first
+        _check_same(loaded, composed)
+    with pytest.raises(ValueError):
+        LayeredPermissionTree([compile_tree(instances),
+                               compile_tree(instances, object_first=True)])
+
+
+def test_layered_tree_shares_layers(datadir):  # noqa
+    v1 = {'organisation': 'Cadasta', 'project': 'Test'}
+    v2 = {'organisation': 'H4H', 'project': 'Test'}
+    t1 = compile_layered_tree(
+        _instances(datadir, ['default-policy.json', 'org-policy.json'], v1)
+    )
+    t2 = compile_layered_tree(
+        _instances(datadir, ['default-policy.json'], v1) +
+        _instances(datadir, ['org-policy.json'], v2)
+    )
+    assert t1.layers[0] is t2.layers[0]
+    assert t1.layers[1] is not t2.layers[1]
+
+
+@pytest.fixture(scope="function")  # noqa
+def setup(datadir, db, settings):  # noqa
+    settings.TUTELARY_LAYERED_TREES = True
+    PermissionSet.ptree_cache.clear()
+    user1 = UserFactory.create(username='user1')
+    user2 = UserFactory.create(username='user2')
+    PolicyFactory.set_directory(str(datadir))
+    def_pol = PolicyFactory.create(name='def', file='default-policy.json')
+    org_pol = PolicyFactory.create(name='org', file='org-policy.json')
+    adm_pol = PolicyFactory.create(name='adm', file='org-admin-policy.json')
+    user1.assign_policies(def_pol, (org_pol, {'organisation': 'Cadasta'}))
+    user2.assign_policies(def_pol, (org_pol, {'organisation': 'Cadasta'}),
+                          (adm_pol, {'organisation': 'Cadasta'}))
+    return (user1, user2)
+
+
+def test_layered_permission_sets(setup):  # noqa
+    user1, user2 = setup
+    t1 = user1.permissionset.first().tree()
+    t2 = user2.permissionset.first().tree()
+    assert isinstance(t1, LayeredPermissionTree)
+    assert t1.layers[1] is t2.layers[1]
+    obj = Object('Cadasta/Test/parcel/1')
+    assert user1.has_perm('parcel.view', obj)
+    assert not user1.has_perm('parcel.edit', obj)
+    assert user2.has_perm('parcel.edit', obj)
+
+    PermissionSet.ptree_cache.clear()
+    PermissionSet.objects.warm()
+    assert isinstance(user2.permissionset.first().tree(),
+                      LayeredPermissionTree)
+    assert user2.has_perm('parcel.edit', obj)
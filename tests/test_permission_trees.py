@@ -1,4 +1,7 @@
+import itertools
 import json
+import random
+import pytest
 from tutelary.engine import PermissionTree, PolicyBody, Action, Object
 from .datadir import datadir  # noqa
 
@@ -121,3 +124,113 @@ def test_permission_set_policies_4():
     user_list = Action('project.users.list')
     proj = Object('project/Cadasta/TestProj')
     assert pset.allow(user_list, proj)
+
+
+def test_permission_tree_minimise(datadir):  # noqa
+    v = {'organisation': 'Cadasta', 'project': 'Test'}
+    pols = [PolicyBody(json=datadir.join(f).read(), variables=v)
+            for f in ['default-policy.json', 'org-policy.json',
+                      'project-policy.json', 'data-collector-policy.json']]
+    tree = PermissionTree(policies=pols)
+    full = PermissionTree(policies=pols)
+    assert tree.minimise() < 1
+    for act in ['parcel.view', 'parcel.edit', 'parcel.create', 'party.edit',
+                'admin.invite', 'statistics']:
+        for obj in ['Cadasta/Test/parcel/123', 'Cadasta/Test/party',
+                    'H4H/PaP/parcel/1', 'org/Cadasta', 'user/x']:
+            assert (tree.allow(Action(act), Object(obj)) ==
+                    full.allow(Action(act), Object(obj)))
+
+
+def test_permission_tree_id_ranges():
+    body = {
+        "clause": [
+            {
+                "effect": "allow",
+                "object": ["Cadasta/Test/parcel/*"],
+                "action": ["parcel.view"]
+            },
+            {
+                "effect": "deny",
+                "object": ["Cadasta/Test/parcel/[1000-1999,2500]"],
+                "action": ["parcel.view"]
+            },
+            {
+                "effect": "allow",
+                "object": ["Cadasta/Test/parcel/{}".format(i)
+                           for i in range(1500, 1600)],
+                "action": ["parcel.view"]
+            }
+        ]
+    }
+    pset = PermissionTree(policies=[PolicyBody(json=json.dumps(body))])
+    full = pset.copy()
+    # The per-object allows are merged into a single ID set.
+    assert pset.minimise() < 0.1
+    view = Action('parcel.view')
+    for i, allowed in [(999, True), (1000, False), (1500, True),
+                       (1599, True), (1600, False), (2000, True),
+                       (2500, False)]:
+        obj = Object('Cadasta/Test/parcel/{}'.format(i))
+        assert pset.allow(view, obj) == full.allow(view, obj) == allowed
+
+
+def test_permission_tree_multi_wildcards():
+    body = {
+        "clause": [
+            {
+                "effect": "allow",
+                "object": ["H4H/**"],
+                "action": ["parcel.*"]
+            },
+            {
+                "effect": "deny",
+                "object": ["H4H/**/parcel/[1-9]"],
+                "action": ["parcel.edit"]
+            }
+        ]
+    }
+    pset = PermissionTree(policies=[PolicyBody(json=json.dumps(body))])
+    view, edit = Action('parcel.view'), Action('parcel.edit')
+    for obj, viewable, editable in [
+            ('H4H', True, True), ('H4H/PaP/parcel/3', True, False),
+            ('H4H/parcel/3', True, False), ('H4H/a/b/parcel/30', True, True),
+            ('Cadasta/parcel/3', False, False)]:
+        for tree in [pset, pset.copy().freeze()]:
+            assert tree.allow(view, Object(obj)) == viewable
+            assert tree.allow(edit, Object(obj)) == editable
+
+
+@pytest.mark.parametrize('seed', range(100))
+def test_permission_tree_object_first(seed, monkeypatch):
+    acts = [Action(a) for a in ['parcel.view', 'parcel.edit', 'party.view']]
+    monkeypatch.setattr(Action, 'registered', set(acts))
+    rng = random.Random(seed)
+    action_first = PermissionTree()
+    object_first = PermissionTree(object_first=True)
+    for _ in range(rng.randint(0, 10)):
+        act = Action(rng.choice(['parcel.view', 'parcel.edit', 'parcel.*',
+                                 '*.view', '*.*', 'party.view']))
+        obj = None
+        if rng.random() > 0.2:
+            obj = Object('/'.join(rng.choice(['a', 'b', '1', '[1-2]',
+                                              '*', '**'])
+                                  for _ in range(rng.randint(1, 3))))
+        effect = rng.choice(['allow', 'deny'])
+        action_first.add(effect, act, obj)
+        object_first.add(effect, act, obj)
+    minimised = object_first.copy().freeze()
+    minimised.minimise()
+    objs = [None] + [Object('/'.join(o)) for n in range(1, 4)
+                     for o in itertools.product(['a', 'b', '1', '3'],
+                                                repeat=n)]
+    for obj in objs:
+        for act in acts:
+            expected = action_first.allow(act, obj)
+            assert object_first.allow(act, obj) == expected
+            assert minimised.allow(act, obj) == expected
+        expected = action_first.permitted_actions(lambda a: obj)
+        assert object_first.permitted_actions(lambda a: obj) == expected
+        assert minimised.permitted_actions(lambda a: obj) == expected
+    with pytest.raises(ValueError):
+        action_first.freeze().overlay(object_first)
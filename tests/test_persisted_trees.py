@@ -0,0 +1,111 @@
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from tutelary.models import PermissionSet
+from tutelary.engine import Object
+import tutelary.models
+import pytest
+from .factories import UserFactory, PolicyFactory
+from .datadir import datadir  # noqa
+
+
+@pytest.fixture(scope="function")  # noqa
+def setup(datadir, db, settings):
+    settings.TUTELARY_PERSIST_TREES = True
+    user1 = UserFactory.create(username='user1')
+    user2 = UserFactory.create(username='user2')
+
+    PolicyFactory.set_directory(str(datadir))
+    def_pol = PolicyFactory.create(name='def', file='default-policy.json')
+    org_pol = PolicyFactory.create(name='org', file='org-policy-1.json')
+
+    user1.assign_policies(def_pol)
+    user2.assign_policies(def_pol,
+                          (org_pol, {'organisation': 'Cadasta'}))
+    return (user1, user2, def_pol, org_pol)
+
+
+def _no_compile(monkeypatch):
+    def fail(*args, **kwargs):
+        raise AssertionError('permission tree compiled')
+    monkeypatch.setattr(tutelary.models, 'compile_tree', fail)
+
+
+def test_tree_persisted(setup, monkeypatch):  # noqa
+    user1, user2, def_pol, org_pol = setup
+    obj = Object('parcel/Cadasta/TestProj/123')
+    assert user2.has_perm('parcel.edit', obj)
+    assert not user1.has_perm('parcel.edit', obj)
+
+    pset = PermissionSet.objects.get(users=user2)
+    assert pset.tree_fingerprint != ''
+    assert pset.compiled_tree is not None
+
+    # With the tree in the database, a cold cache doesn't need to
+    # compile anything.
+    PermissionSet.ptree_cache.clear()
+    _no_compile(monkeypatch)
+    assert user2.has_perm('parcel.edit', obj)
+    assert not user1.has_perm('parcel.edit', obj)
+
+
+def test_tree_not_fetched(setup):  # noqa
+    user1, user2, def_pol, org_pol = setup
+    obj = Object('parcel/Cadasta/TestProj/123')
+    assert user2.has_perm('parcel.edit', obj)
+
+    # Permission checks with a warm cache don't load the compiled tree
+    # from the database.
+    with CaptureQueriesContext(connection) as queries:
+        assert user2.has_perm('parcel.edit', obj)
+    assert len(queries) > 0
+    assert not any('compiled_tree' in q['sql'] for q in queries)
+
+
+def test_persisted_tree_stale(setup, datadir, monkeypatch):  # noqa
+    user1, user2, def_pol, org_pol = setup
+    obj = Object('parcel/Cadasta/TestProj/123')
+    assert user2.has_perm('parcel.edit', obj)
+    pset = PermissionSet.objects.get(users=user2)
+    fp = pset.tree_fingerprint
+
+    # Change the policy behind the cache's back: the fingerprint no
+    # longer matches so the tree is recompiled.
+    PermissionSet.ptree_cache.clear()
+    org_pol.body = datadir.join('org-policy-2.json').read()
+    org_pol.save()
+    PermissionSet.ptree_cache.clear()
+    assert not user2.has_perm('parcel.edit', obj)
+    assert PermissionSet.objects.get(pk=pset.pk).tree_fingerprint != fp
+
+
+def test_warm_persisted(setup, monkeypatch):  # noqa
+    PermissionSet.ptree_cache.clear()
+    PermissionSet.objects.warm()
+    for pset in PermissionSet.objects.all():
+        assert pset.compiled_tree is not None
+
+    PermissionSet.ptree_cache.clear()
+    monkeypatch.setattr(tutelary.models, 'compile_trees',
+                        lambda specs, **kwargs: [] if not specs else None)
+    timings = PermissionSet.objects.warm()
+    assert len(timings) == 2
+    for pset in PermissionSet.objects.all():
+        assert pset.pk in PermissionSet.ptree_cache
+
+
+def test_persisted_tree_object_first(setup, settings):  # noqa
+    user1, user2, def_pol, org_pol = setup
+    obj = Object('parcel/Cadasta/TestProj/123')
+    assert user2.has_perm('parcel.edit', obj)
+    pset = PermissionSet.objects.get(users=user2)
+    fp = pset.tree_fingerprint
+
+    # Changing the key order changes the fingerprint, so the stored
+    # tree is recompiled with the new order.
+    settings.TUTELARY_OBJECT_FIRST = True
+    PermissionSet.ptree_cache.clear()
+    assert user2.has_perm('parcel.edit', obj)
+    assert not user1.has_perm('parcel.edit', obj)
+    pset = PermissionSet.objects.get(pk=pset.pk)
+    assert pset.tree().object_first
+    assert pset.tree_fingerprint != fp
@@ -1,9 +1,13 @@
-from tutelary.engine import Clause, PolicyBody, Action, Object
+from tutelary.engine import (
+    Clause, PolicyBody, Action, Object, CommentStripper, strip_comments,
+    overlapping_patterns
+)
 from tutelary.exceptions import (
     EffectException, PatternOverlapException,
     PolicyBodyException, VariableSubstitutionException
 )
 import pytest
+import random
 from .datadir import datadir  # noqa
 
 
@@ -27,6 +31,22 @@ def test_clause_creation_pattern_overlaps():
         assert c3.effect == 'allow'
 
 
+def test_clause_creation_multi_wildcards():
+    c = Clause('allow',
+               [Action('parcel.edit')],
+               [Object('Cadasta/**/parcel/*'), Object('H4H/party/*')])
+    assert [str(o) for o in c.object] == ['Cadasta/**/parcel/*',
+                                          'H4H/party/*']
+    with pytest.raises(PatternOverlapException):
+        Clause('allow',
+               [Action('parcel.edit')],
+               [Object('Cadasta/**'), Object('*/Batangas/parcel')])
+    with pytest.raises(PolicyBodyException):
+        Clause('allow',
+               [Action('parcel.**')],
+               [Object('Cadasta/*/parcel/*')])
+
+
 def test_clause_creation_effect_exception():
     with pytest.raises(EffectException):
         c4 = Clause('allows',
@@ -87,3 +107,100 @@ def test_policy_iteration(datadir):  # noqa
         else:
             assert a == Action('*.edit')
         i += 1
+
+
+def test_policy_comments(datadir):  # noqa
+    text = datadir.join('comment-policy.json').read()
+    p = PolicyBody(json=text)
+    assert len(p) == 3
+    assert [str(o) for _, _, o in p][1:] == [
+        'tag/#1', 'say/"#not a comment"'
+    ]
+    stripped = strip_comments(text)
+    assert '"http://example.com/*"' in stripped
+    assert stripped.count('\n') == text.count('\n')
+    assert '$unassigned' not in stripped
+    assert 'Two objects' not in stripped
+    assert strip_comments('"unterminated // string') == \
+        '"unterminated // string'
+
+
+def test_policy_comments_streaming(datadir):  # noqa
+    text = datadir.join('comment-policy.json').read()
+    for size in [1, 2, 7, 1000]:
+        stripper = CommentStripper()
+        pieces = [stripper.feed(text[i:i + size])
+                  for i in range(0, len(text), size)]
+        pieces.append(stripper.close())
+        assert ''.join(pieces) == strip_comments(text)
+
+
+def test_policy_error_position():
+    text = ('{ "version": "2015-12-10",  // comment\n'
+            '  "clause": [ { "effect": "$effect" ] }')
+    with pytest.raises(PolicyBodyException) as exc:
+        PolicyBody(json=text, variables={'effect': 'allow-everything'})
+    assert str(exc.value).endswith('line 2, column 37')
+    with pytest.raises(PolicyBodyException) as exc:
+        PolicyBody(json='{ "a": "$x" } $x', variables={'x': 'long value'})
+    assert str(exc.value).endswith('line 1, column 15')
+
+
+def test_overlapping_patterns():
+    objs = [Object(o) for o in ['a/b/c', 'a/*/c', 'a/b/c', 'x/y', '*/y',
+                                'a/b', '*/*/*', 'q/r/s']]
+    conflicts = overlapping_patterns(objs)
+    naive = [(p, q) for i, p in enumerate(objs) for q in objs[i + 1:]
+             if p.match(q) and p != q]
+    assert [(str(p), str(q)) for p, q in conflicts] == \
+        [(str(p), str(q)) for p, q in naive]
+    assert overlapping_patterns([Object('a/b'), Object('a/b')]) == []
+
+    rng = random.Random(4)
+    for _ in range(200):
+        acts = [Action('.'.join(rng.choice(['a', 'b', '*'])
+                                for _ in range(rng.randint(1, 3))))
+                for _ in range(rng.randint(0, 8))]
+        naive = [(i, j) for i in range(len(acts))
+                 for j in range(i + 1, len(acts))
+                 if acts[i].match(acts[j]) and acts[i] != acts[j]]
+        assert overlapping_patterns(acts) == \
+            [(acts[i], acts[j]) for i, j in naive]
+
+    # ID set components overlap wildcards, their members and other ID
+    # sets with members in common.
+    for _ in range(200):
+        objs = [Object('/'.join(rng.choice(['1', '5', '[1-3]', '[3-6]',
+                                            '[7,9]', '*'])
+                                for _ in range(rng.randint(1, 2))))
+                for _ in range(rng.randint(0, 8))]
+        naive = [(i, j) for i in range(len(objs))
+                 for j in range(i + 1, len(objs))
+                 if objs[i].match(objs[j]) and objs[i] != objs[j]]
+        assert overlapping_patterns(objs) == \
+            [(objs[i], objs[j]) for i, j in naive]
+    assert Object('a/[1-3]').match(Object('a/2'))
+    assert not Object('a/[1-3]').match(Object('a/[4-9]'))
+
+    # Patterns with ``**`` wildcards can overlap patterns of any length.
+    for _ in range(200):
+        objs = [Object('/'.join(rng.choice(['a', 'b', '*', '**'])
+                                for _ in range(rng.randint(1, 3))))
+                for _ in range(rng.randint(0, 8))]
+        naive = [(i, j) for i in range(len(objs))
+                 for j in range(i + 1, len(objs))
+                 if objs[i].match(objs[j]) and objs[i] != objs[j]]
+        assert overlapping_patterns(objs) == \
+            [(objs[i], objs[j]) for i, j in naive]
+
+
+def test_clause_overlap_conflicts():
+    objs = [Object('parcel/{}'.format(i)) for i in range(5000)]
+    assert Clause('allow', [Action('parcel.view')], objs).object == objs
+    with pytest.raises(PatternOverlapException) as exc:
+        Clause('allow', [Action('parcel.view')],
+               objs + [Object('parcel/*'), Object('parcel/17')])
+    conflicts = [(str(p), str(q)) for p, q in exc.value.conflicts]
+    assert len(conflicts) == 5001
+    assert ('parcel/17', 'parcel/*') in conflicts
+    assert 'and 5000 more' in str(exc.value)
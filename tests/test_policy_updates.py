@@ -1,8 +1,12 @@
+import threading
+import time
 from tutelary.models import (
     PermissionSet, Policy, PolicyInstance
 )
 from tutelary.engine import Object
+import tutelary.models
 from django.contrib.auth.models import User
+from django.db import connection
 import pytest
 from .factories import UserFactory, PolicyFactory
 from .datadir import datadir  # noqa
@@ -107,3 +111,64 @@ def test_policy_update_2(datadir, setup):  # noqa
     assert user3.has_perm('parcel.view', obj2)
     assert not user3.has_perm('parcel.view', obj3)
     assert user3.has_perm('party.view', obj4)
+
+
+def test_policy_update_stale(datadir, setup, transactional_db,  # noqa
+                             settings, monkeypatch):
+    user1, user2, user3, def_pol, org_pol, prj_pol = setup
+    settings.TUTELARY_TREE_STALE_SECONDS = 60
+    PermissionSet.ptree_cache.clear()
+    obj1 = Object('parcel/Cadasta/TestProj/123')
+    assert user2.has_perm('parcel.edit', obj1)
+    pset = user2.permissionset.first()
+
+    # Background rebuilds wait until released, and record the threads
+    # that close their database connections.
+    release = threading.Event()
+    closed = []
+    build = PermissionSet._build_tree
+
+    def slow_build(self):
+        release.wait(10)
+        return build(self)
+
+    class Connection:
+        def close(self):
+            closed.append(threading.current_thread())
+            connection.close()
+    monkeypatch.setattr(PermissionSet, '_build_tree', slow_build)
+    monkeypatch.setattr(tutelary.models, 'connection', Connection())
+
+    # Change the policy without going through the incremental update
+    # of cached trees, then invalidate the permission set: the old tree
+    # is served while the new one is built.
+    Policy.objects.filter(pk=org_pol.pk).update(
+        body=datadir.join('org-policy-2.json').read()
+    )
+    pset.refresh()
+    assert user2.has_perm('parcel.edit', obj1)
+    assert user2.has_perm('parcel.edit', obj1)
+
+    release.set()
+    deadline = time.monotonic() + 10
+    while (pset.pk not in PermissionSet.ptree_cache and
+           time.monotonic() < deadline):
+        time.sleep(0.01)
+    assert not user2.has_perm('parcel.edit', obj1)
+    assert len(closed) == 1
+    assert closed[0] is not threading.main_thread()
+
+
+def test_deleted_pset_forgotten(setup):  # noqa
+    user1, user2, user3, def_pol, org_pol, prj_pol = setup
+    obj1 = Object('parcel/Cadasta/TestProj/123')
+    assert user3.has_perm('parcel.edit', obj1)
+    pset = user3.permissionset.first()
+    assert pset.pk in PermissionSet.ptree_cache
+
+    # Deleting the only user of a permission set deletes the permission
+    # set, and the tree cache keeps nothing for it.
+    user3.delete()
+    assert not PermissionSet.objects.filter(pk=pset.pk).exists()
+    assert pset.pk not in PermissionSet.ptree_cache
+    assert PermissionSet.ptree_cache.generation(pset.pk) == 0
@@ -0,0 +1,43 @@
+import gc
+from tutelary.models import PermissionSet
+from tutelary.prefork import prepare_for_fork
+import pytest
+from .factories import UserFactory, PolicyFactory
+from .datadir import datadir  # noqa
+
+
+@pytest.fixture(scope="function")  # noqa
+def setup(datadir, db):
+    user1 = UserFactory.create(username='user1')
+    user2 = UserFactory.create(username='user2')
+
+    PolicyFactory.set_directory(str(datadir))
+    def_pol = PolicyFactory.create(name='def', file='default-policy.json')
+    org_pol = PolicyFactory.create(name='org', file='org-policy.json')
+
+    user1.assign_policies(def_pol)
+    user2.assign_policies(def_pol,
+                          (org_pol, {'organisation': 'Cadasta'}))
+    return (user1, user2)
+
+
+def _nodes(node):
+    yield node
+    yield node[1]
+    for st in node[1]:
+        yield st
+        yield from _nodes(st[1])
+
+
+def test_prepare_for_fork(setup):  # noqa
+    PermissionSet.ptree_cache.clear()
+    try:
+        timings = prepare_for_fork()
+        assert len(timings) == 2
+        for pset in PermissionSet.objects.all():
+            assert pset.pk in PermissionSet.ptree_cache
+            root = PermissionSet.ptree_cache[pset.pk].tree.root
+            assert not any(gc.is_tracked(n) for n in _nodes(root))
+    finally:
+        if hasattr(gc, 'unfreeze'):
+            gc.unfreeze()
@@ -0,0 +1,126 @@
+from io import StringIO
+from django.apps import apps as django_apps
+from django.core.management import call_command
+import tutelary.apps
+from tutelary.cache import TreeCache
+from tutelary.engine import Action, Object
+from tutelary.models import PermissionSet
+from tutelary.snapshot import read_snapshot, write_snapshot
+from tutelary.wildtree import WildTree
+import pytest
+from .factories import UserFactory, PolicyFactory
+from .datadir import datadir  # noqa
+
+
+def test_snapshot_file(tmpdir):
+    path = str(tmpdir.join('snapshot'))
+    t = WildTree()
+    t[('a', 'b')] = 'allow'
+    write_snapshot(path, [(1, 3, 'f' * 32, t), (2 ** 40, 0, 'e' * 32,
+                                                WildTree())])
+    entries = read_snapshot(path)
+    assert sorted(entries) == [1, 2 ** 40]
+    assert entries[1][:2] == (3, 'f' * 32)
+    assert entries[2 ** 40][:2] == (0, 'e' * 32)
+
+    data = tmpdir.join('snapshot').read_binary()
+    tmpdir.join('junk').write_binary(b'JUNK' + data[4:])
+    with pytest.raises(ValueError):
+        read_snapshot(str(tmpdir.join('junk')))
+    tmpdir.join('short').write_binary(data[:-1])
+    with pytest.raises(ValueError):
+        read_snapshot(str(tmpdir.join('short')))
+
+
+def test_tree_cache_snapshot_restore():
+    cache = TreeCache()
+    cache.get(1, lambda: 'one')
+    cache.get(2, lambda: 'two')
+    cache.invalidate(2)
+    cache.get(2, lambda: 'two')
+    assert cache.snapshot() == {1: (0, 'one'), 2: (1, 'two')}
+
+    other = TreeCache()
+    other.get(2, lambda: 'built')
+    assert other.restore({1: 'one', 2: 'two'}) == 1
+    assert other[1] == 'one'
+    assert other[2] == 'built'
+
+
+@pytest.fixture(scope="function")  # noqa
+def setup(datadir, db):  # noqa
+    user1 = UserFactory.create(username='user1')
+    user2 = UserFactory.create(username='user2')
+    PolicyFactory.set_directory(str(datadir))
+    def_pol = PolicyFactory.create(name='def', file='default-policy.json')
+    org_pol = PolicyFactory.create(name='org', file='org-policy.json')
+    prj_pol = PolicyFactory.create(name='prj', file='project-policy.json')
+    user1.assign_policies(def_pol,
+                          (org_pol, {'organisation': 'Cadasta'}))
+    user2.assign_policies(def_pol,
+                          (org_pol, {'organisation': 'Cadasta'}),
+                          (prj_pol, {'organisation': 'Cadasta',
+                                     'project': 'TestProj'}))
+    return (user1, user2, prj_pol)
+
+
+def test_snapshot_restore(setup, tmpdir):  # noqa
+    user1, user2, prj_pol = setup
+    path = str(tmpdir.join('snapshot'))
+    PermissionSet.objects.warm()
+    expected = {pset.pk: repr(pset.tree())
+                for pset in PermissionSet.objects.all()}
+    assert PermissionSet.objects.save_snapshot(path) == 2
+
+    PermissionSet.ptree_cache.clear()
+    assert PermissionSet.objects.restore_snapshot(path) == 2
+    for psetid, tree in expected.items():
+        assert repr(PermissionSet.ptree_cache[psetid]) == tree
+    assert user1.has_perm('parcel.edit', Object('parcel/Cadasta/TestProj/1'))
+
+    # Trees whose policies have changed since the snapshot are not
+    # restored.
+    PermissionSet.ptree_cache.clear()
+    prj_pol.body = prj_pol.body.replace('"deny"', '"allow"')
+    prj_pol.save()
+    assert PermissionSet.objects.restore_snapshot(path) == 1
+    pset2 = user2.permissionset.first()
+    assert pset2.pk not in PermissionSet.ptree_cache
+    assert pset2.tree().allow(Action('parcel.edit'),
+                              Object('parcel/Cadasta/TestProj/1'))
+
+    # Nor are trees for deleted permission sets.
+    PermissionSet.ptree_cache.clear()
+    user1.permissionset.first().delete()
+    assert PermissionSet.objects.restore_snapshot(path) == 0
+
+
+def test_snapshot_command(setup, tmpdir):  # noqa
+    path = str(tmpdir.join('snapshot'))
+    PermissionSet.ptree_cache.clear()
+    out = StringIO()
+    call_command('tutelary_snapshot', path, stdout=out)
+    assert out.getvalue().startswith('saved 2 permission trees')
+    assert len(read_snapshot(path)) == 2
+
+
+def test_snapshot_save_on_exit(setup, settings, tmpdir, monkeypatch):  # noqa
+    settings.TUTELARY_TREE_SNAPSHOT = str(tmpdir.join('snapshot'))
+    registered = []
+    monkeypatch.setattr(tutelary.apps.atexit, 'register', registered.append)
+    config = django_apps.get_app_config('tutelary')
+
+    # Saving on exit is opt-in.
+    config._use_snapshot()
+    assert registered == []
+    settings.TUTELARY_SAVE_SNAPSHOT_ON_EXIT = True
+    config._use_snapshot()
+    assert registered == [tutelary.apps._save_snapshot]
+
+    # Nothing is written from an empty cache.
+    PermissionSet.ptree_cache.clear()
+    tutelary.apps._save_snapshot()
+    assert not tmpdir.join('snapshot').exists()
+    PermissionSet.objects.warm()
+    tutelary.apps._save_snapshot()
+    assert len(read_snapshot(settings.TUTELARY_TREE_SNAPSHOT)) == 2
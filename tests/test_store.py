@@ -0,0 +1,228 @@
+import json
+import os
+import pytest
+from tutelary.engine import PermissionTree, PolicyBody, Action, Object
+import tutelary.models
+import tutelary.store
+from tutelary.models import PermissionSet, Policy, shared_store
+from tutelary.store import MappedStore, SharedStore, write_store
+from tutelary.wildtree import WildTree
+from .factories import UserFactory, PolicyFactory
+from .datadir import datadir  # noqa
+
+
+def _tree():
+    t = WildTree()
+    t[('a', 'b', 'c')] = 1
+    t[('a', '*', 'e')] = 3
+    t[('a', 'b', 'd')] = 'two'
+    t[('x',)] = {'nested': [1, 2]}
+    t[('y', '*')] = 'wild'
+    t[('a', 'bé', '*')] = None
+    return t
+
+
+def test_store_lookup(tmpdir):
+    path = str(tmpdir.join('trees'))
+    t = _tree()
+    write_store(path, [(2 ** 40, t), (7, WildTree())])
+    store = MappedStore(path)
+    assert len(store) == 2
+    assert store.get(3) is None
+    assert store.get(7).to_wildtree() == WildTree()
+    mapped = store.get(2 ** 40)
+    assert repr(mapped.to_wildtree()) == repr(t)
+    for key in [('a', 'b', 'c'), ('a', 'q', 'e'), ('a', 'b', 'e'),
+                ('x',), ('y', 'z'), ('y',)]:
+        assert mapped.lookup(key) == t[key]
+    for key in [('a', 'b'), ('a', 'x', 'f'), ('z',), ('x', 'y')]:
+        with pytest.raises(KeyError):
+            mapped.lookup(key)
+
+
+def test_store_id_sets(tmpdir):
+    path = str(tmpdir.join('trees'))
+    t = WildTree()
+    t[('p', '*')] = 'deny'
+    t[('p', '[10-19,30]')] = 'allow'
+    t[('p', '15')] = 'deny'
+    t[('[1-2]',)] = 'one'
+    write_store(path, [(1, t)])
+    mapped = MappedStore(path).get(1)
+    for key in [('p', '15'), ('p', '16'), ('p', '30'), ('p', '20'),
+                ('p', '016'), ('1',), ('2',)]:
+        assert mapped.lookup(key) == t[key]
+    with pytest.raises(KeyError):
+        mapped.lookup(('3',))
+
+
+def test_store_multi_wildcard(tmpdir):
+    path = str(tmpdir.join('trees'))
+    t = WildTree()
+    t[('p', '**')] = 'deny'
+    t[('p', '**', '[1-5]')] = 'allow'
+    t[('p', 'q', '**', 'x', '*')] = 'other'
+    write_store(path, [(1, t)])
+    mapped = MappedStore(path).get(1)
+    for key in [('p',), ('p', 'a', 'b'), ('p', '3'), ('p', 'a', 'b', '4'),
+                ('p', 'q', 'x'), ('p', 'q', 'a', 'x', 'y'), ('p', 'q', '9')]:
+        assert mapped.lookup(key) == t[key]
+    with pytest.raises(KeyError):
+        mapped.lookup(('q', 'x'))
+
+
+def test_store_permission_tree(datadir, tmpdir):  # noqa
+    v = {'organisation': 'Cadasta', 'project': 'Test'}
+    pols = [PolicyBody(json=datadir.join(f).read(), variables=v)
+            for f in ['default-policy.json', 'org-policy.json',
+                      'project-policy.json', 'org-admin-policy.json']]
+    ptree = PermissionTree(policies=pols)
+    path = str(tmpdir.join('trees'))
+    write_store(path, [(1, ptree)])
+    mapped = MappedStore(path).get(1)
+    tests = [('parcel.edit', 'Cadasta/Test/parcel/123'),
+             ('admin.assign-role', 'user/iross'),
+             ('org.list', None),
+             ('project.create', 'Cadasta'),
+             ('project.create', 'Other')]
+    for act, obj in tests:
+        obj = Object(obj) if obj is not None else None
+        assert mapped.allow(Action(act), obj) == ptree.allow(Action(act), obj)
+
+    def objf(a):
+        return Object('Cadasta/Test/parcel/123')
+    assert (mapped.permitted_actions(objf) ==
+            ptree.permitted_actions(objf))
+
+
+@pytest.mark.parametrize('version', [1, 2])  # noqa
+def test_store_object_first(datadir, tmpdir, monkeypatch, version):  # noqa
+    monkeypatch.setattr(tutelary.store, 'VERSION', version)
+    v = {'organisation': 'Cadasta', 'project': 'Test'}
+    pols = [PolicyBody(json=datadir.join(f).read(), variables=v)
+            for f in ['default-policy.json', 'org-policy.json',
+                      'org-admin-policy.json']]
+    ptree = PermissionTree(policies=pols)
+    otree = PermissionTree(policies=pols, object_first=True)
+    path = str(tmpdir.join('trees'))
+    write_store(path, [(1, ptree), (2, otree)])
+    mapped = MappedStore(path)
+    assert not mapped.get(1).object_first
+    # Version 1 files can't record the key order.
+    assert mapped.get(2).object_first == (version > 1)
+    if version > 1:
+        for obj in [None, 'Cadasta/Test/parcel/123', 'user/iross', 'Other']:
+            obj = Object(obj) if obj is not None else None
+            for act in ['parcel.edit', 'admin.assign-role', 'org.list']:
+                assert (mapped.get(2).allow(Action(act), obj) ==
+                        ptree.allow(Action(act), obj))
+
+
+def test_store_publish_and_reopen(tmpdir):
+    path = str(tmpdir.join('trees'))
+    shared = SharedStore(path, check_interval=0)
+    assert shared.current() is None
+    write_store(path, [(1, _tree())])
+    first = shared.current()
+    assert first.get(1).lookup(('x',)) == {'nested': [1, 2]}
+    assert shared.current() is first
+
+    t = WildTree()
+    t[('x',)] = 'new'
+    write_store(path, [(1, t)])
+    assert shared.current() is not first
+    assert shared.current().get(1).lookup(('x',)) == 'new'
+    # The old mapping stays usable by anyone still holding it.
+    assert first.get(1).lookup(('x',)) == {'nested': [1, 2]}
+    assert os.listdir(str(tmpdir)) == ['trees']
+
+
+def test_store_bad_file(tmpdir):
+    path = str(tmpdir.join('trees'))
+    write_store(path, [(1, _tree())])
+    data = open(path, 'rb').read()
+    tmpdir.join('junk').write_binary(b'JUNK' + data[4:])
+    with pytest.raises(ValueError):
+        MappedStore(str(tmpdir.join('junk')))
+    tmpdir.join('short').write_binary(data[:-4])
+    with pytest.raises(ValueError):
+        MappedStore(str(tmpdir.join('short')))
+
+
+@pytest.fixture(scope="function")  # noqa
+def setup(datadir, db, settings, tmpdir):  # noqa
+    settings.TUTELARY_TREE_STORE = str(tmpdir.join('trees'))
+    user1 = UserFactory.create(username='user1')
+    user2 = UserFactory.create(username='user2')
+    PolicyFactory.set_directory(str(datadir))
+    def_pol = PolicyFactory.create(name='def', file='default-policy.json')
+    org_pol = PolicyFactory.create(name='org', file='org-policy.json')
+    user1.assign_policies(def_pol)
+    user2.assign_policies(def_pol,
+                          (org_pol, {'organisation': 'Cadasta'}))
+    return (user1, user2, org_pol)
+
+
+def test_store_backend(setup, datadir, monkeypatch):  # noqa
+    user1, user2, org_pol = setup
+    assert shared_store() is None
+    PermissionSet.objects.warm()
+    store = shared_store()
+    assert len(store) == PermissionSet.objects.count()
+    pset2 = user2.permissionset.first()
+    assert repr(store.get(pset2.pk).to_wildtree()) == repr(pset2.tree())
+
+    # Queries are answered from the shared store, without using the
+    # permission sets' own trees.  (The patch is undone by hand, since
+    # undoing the monkeypatch would also undo the store setting.)
+    def no_tree(self):
+        raise AssertionError('tree built')
+    tree = PermissionSet.tree
+    PermissionSet.tree = no_tree
+    try:
+        obj = Object('Cadasta/Proj/parcel/1')
+        assert user2.has_perm('parcel.view', obj)
+        assert not user2.has_perm('parcel.edit', obj)
+        assert not user1.has_perm('parcel.view', obj)
+    finally:
+        PermissionSet.tree = tree
+
+    # Saving a policy without changing its body leaves the store alone.
+    org_pol.save()
+    assert SharedStore(store.path).current().stat == store.stat
+
+    # Changing a policy publishes a new store, made from the cached
+    # trees rather than by compiling every tree again.
+    def no_compile(*args, **kwargs):
+        raise AssertionError('trees compiled')
+    monkeypatch.setattr(tutelary.models, 'compile_trees', no_compile)
+    org_pol.body = datadir.join('org-admin-policy.json').read()
+    org_pol.save()
+    new = SharedStore(store.path).current()
+    assert new.stat != store.stat
+    assert new.get(pset2.pk).allow(Action('parcel.edit'), obj)
+    assert user2.has_perm('parcel.edit', obj)
+
+
+def test_store_publish_out_of_date(setup, datadir):  # noqa
+    user1, user2, org_pol = setup
+    PermissionSet.objects.warm()
+    path = shared_store().path
+    obj = Object('Other/Proj/parcel/1')
+    assert not user1.has_perm('parcel.view', obj)
+
+    # Another process changes the default policy, so the trees cached
+    # here are out of date: publishing a new store when a policy is
+    # changed here doesn't reinstate them.
+    Policy.objects.filter(name='def').update(body=json.dumps({
+        'version': '2015-12-10',
+        'clause': [{'effect': 'allow', 'action': ['parcel.view'],
+                    'object': ['*/*/*/*']}]
+    }))
+    org_pol.body = datadir.join('org-admin-policy.json').read()
+    org_pol.save()
+    store = SharedStore(path).current()
+    for user in (user1, user2):
+        pset = user.permissionset.first()
+        assert store.get(pset.pk).allow(Action('parcel.view'), obj)
+        assert user.has_perm('parcel.view', obj)
@@ -0,0 +1,223 @@
+import threading
+import time
+import pytest
+import tutelary.cache
+from tutelary.cache import TreeCache
+from tutelary.wildtree import WildTree
+
+
+def test_tree_cache_basic():
+    cache = TreeCache()
+    assert 1 not in cache
+    assert cache.get(1, lambda: 'tree-1') == 'tree-1'
+    assert 1 in cache
+    assert cache[1] == 'tree-1'
+    assert cache.get(1, lambda: 'other') == 'tree-1'
+    cache.invalidate(1)
+    assert 1 not in cache
+    assert cache.get(1, lambda: 'other') == 'other'
+    del cache[1]
+    with pytest.raises(KeyError):
+        del cache[1]
+
+
+def test_tree_cache_single_flight():
+    cache = TreeCache()
+    calls = []
+    start = threading.Barrier(8)
+
+    def build():
+        calls.append(1)
+        time.sleep(0.1)
+        return object()
+
+    results = []
+
+    def worker():
+        start.wait()
+        results.append(cache.get(1, build))
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(calls) == 1
+    assert len(results) == 8
+    assert all(r is results[0] for r in results)
+
+
+def test_tree_cache_build_error():
+    cache = TreeCache()
+    start = threading.Event()
+    errors = []
+
+    def build():
+        start.wait()
+        raise ValueError('bad policy')
+
+    def worker():
+        try:
+            cache.get(1, build)
+        except ValueError as exc:
+            errors.append(exc)
+
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for t in threads:
+        t.start()
+    time.sleep(0.05)
+    start.set()
+    for t in threads:
+        t.join()
+    assert len(errors) == 4
+    assert 1 not in cache
+    assert cache.get(1, lambda: 'ok') == 'ok'
+
+
+def test_tree_cache_invalidate_during_build():
+    cache = TreeCache()
+
+    def build():
+        cache.invalidate(1)
+        return 'stale'
+
+    assert cache.get(1, build) == 'stale'
+    assert 1 not in cache
+    assert cache.get(1, lambda: 'fresh') == 'fresh'
+
+
+def test_tree_cache_swap():
+    cache = TreeCache()
+    tree = WildTree()
+    tree[('a', 'b')] = 'allow'
+    cache.get(1, lambda: tree.freeze())
+    assert cache[1] is tree
+
+    other = WildTree().freeze()
+    cache.swap(1, other)
+    assert cache[1] is other
+
+
+def test_tree_cache_stale_while_revalidate():
+    cache = TreeCache(stale=10)
+    assert cache.get(1, lambda: 'old') == 'old'
+    cache.invalidate(1)
+
+    release = threading.Event()
+
+    def build():
+        release.wait()
+        return 'new'
+
+    # The old tree is served while the new one is built in the
+    # background, and only one background build is started.
+    assert cache.get(1, build) == 'old'
+    assert cache.get(1, lambda: 'unused') == 'old'
+    release.set()
+    for _ in range(100):
+        if 1 in cache:
+            break
+        time.sleep(0.01)
+    assert cache.get(1, lambda: 'unused') == 'new'
+
+
+def test_tree_cache_stale_window():
+    window = [0]
+    cache = TreeCache(stale=lambda: window[0])
+    cache.get(1, lambda: 'old')
+    cache.invalidate(1)
+
+    # Strict mode: rebuild synchronously, and don't keep invalidated
+    # trees.
+    assert cache._stale == {}
+    assert cache.get(1, lambda: 'new') == 'new'
+
+    window[0] = 0.01
+    cache.invalidate(1)
+    cache.get(2, lambda: 'two')
+    time.sleep(0.05)
+    # Staleness window expired: rebuild synchronously.
+    assert cache.get(1, lambda: 'newer') == 'newer'
+
+    # Invalidated trees are forgotten once their windows have passed,
+    # even if their keys are never used again.
+    cache.invalidate(2)
+    time.sleep(0.05)
+    cache.invalidate(3)
+    assert cache._stale == {}
+
+
+def test_tree_cache_forget():
+    cache = TreeCache(stale=10)
+    cache.get(1, lambda: 'one')
+    cache.invalidate(1)
+    cache.forget(1)
+    assert cache.generation(1) == 0
+    assert cache.invalidated_at(1) is None
+    assert cache.get(1, lambda: 'new') == 'new'
+
+    # Builds in flight when the key is forgotten are discarded.
+    release = threading.Event()
+
+    def build():
+        release.wait()
+        return 'old'
+    t = threading.Thread(target=lambda: cache.get(2, build))
+    t.start()
+    while 2 not in cache._flights:
+        time.sleep(0.001)
+    cache.forget(2)
+    release.set()
+    t.join()
+    assert 2 not in cache
+
+
+def test_tree_cache_invalidated_at():
+    cache = TreeCache()
+    assert cache.invalidated_at(1) is None
+    before = time.monotonic()
+    cache.invalidate(1)
+    assert cache.invalidated_at(1) >= before
+    assert cache.invalidated_at(2) is None
+    cache.clear()
+    assert cache.invalidated_at(2) >= cache.invalidated_at(1) >= before
+
+
+def test_tree_cache_replace(monkeypatch):
+    cache = TreeCache()
+    assert cache.replace(1, lambda tree: tree + '-new') is None
+    assert cache.get(1, lambda: 'tree') == 'tree'
+    generation = cache.generation(1)
+    assert cache.replace(1, lambda tree: tree + '-new') == 'tree-new'
+    assert cache[1] == 'tree-new'
+    assert cache.generation(1) == generation + 1
+    assert cache.invalidated_at(1) is not None
+
+    def fail(tree):
+        raise ValueError('bad policy')
+    logged = []
+    monkeypatch.setattr(tutelary.cache.logger, 'exception',
+                        lambda *args: logged.append(args))
+    assert cache.replace(1, fail) is None
+    assert 1 not in cache
+    assert len(logged) == 1
+    assert cache.get(1, lambda: 'rebuilt') == 'rebuilt'
+
+
+def test_tree_cache_replace_detaches_build():
+    cache = TreeCache()
+    started = threading.Event()
+    release = threading.Event()
+
+    def build():
+        started.set()
+        release.wait()
+        return 'old'
+
+    t = threading.Thread(target=lambda: cache.get(1, build))
+    t.start()
+    started.wait()
+    assert cache.replace(1, lambda tree: 'new') is None
+    release.set()
+    t.join()
+    assert 1 not in cache
@@ -0,0 +1,57 @@
+from io import StringIO
+from django.core.management import call_command
+from tutelary.models import PermissionSet
+import pytest
+from .factories import UserFactory, PolicyFactory
+from .datadir import datadir  # noqa
+
+
+@pytest.fixture(scope="function")  # noqa
+def setup(datadir, db):
+    user1 = UserFactory.create(username='user1')
+    user2 = UserFactory.create(username='user2')
+    user3 = UserFactory.create(username='user3')
+
+    PolicyFactory.set_directory(str(datadir))
+    def_pol = PolicyFactory.create(name='def', file='default-policy.json')
+    org_pol = PolicyFactory.create(name='org', file='org-policy.json')
+    prj_pol = PolicyFactory.create(name='prj', file='project-policy.json')
+
+    user1.assign_policies(def_pol)
+    user2.assign_policies(def_pol,
+                          (org_pol, {'organisation': 'Cadasta'}))
+    user3.assign_policies(def_pol,
+                          (org_pol, {'organisation': 'Cadasta'}),
+                          (prj_pol, {'organisation': 'Cadasta',
+                                     'project': 'TestProj'}))
+    return (user1, user2, user3)
+
+
+def test_warm(setup):  # noqa
+    PermissionSet.ptree_cache.clear()
+    timings = PermissionSet.objects.warm()
+    assert len(timings) == PermissionSet.objects.count() == 3
+    for pset in PermissionSet.objects.all():
+        assert pset.pk in PermissionSet.ptree_cache
+        assert repr(pset.tree()) == repr(pset._build_tree())
+
+
+def test_warm_command(setup):  # noqa
+    PermissionSet.ptree_cache.clear()
+    out = StringIO()
+    call_command('tutelary_warm', stdout=out)
+    lines = out.getvalue().splitlines()
+    assert len(lines) == 4
+    for pset in PermissionSet.objects.all():
+        assert 'permission set {}:'.format(pset.pk) in out.getvalue()
+        assert pset.pk in PermissionSet.ptree_cache
+    assert lines[-1].startswith('built 3 permission trees in')
+
+
+def test_warm_parallel(setup):  # noqa
+    PermissionSet.ptree_cache.clear()
+    timings = PermissionSet.objects.warm(workers=2)
+    assert len(timings) == 3
+    for pset in PermissionSet.objects.all():
+        assert pset.pk in PermissionSet.ptree_cache
+        assert repr(pset.tree()) == repr(pset._build_tree())
@@ -1,5 +1,8 @@
+import itertools
+import random
 import pytest
-from tutelary.wildtree import WildTree
+from tutelary import wildtree
+from tutelary.wildtree import WildTree, component_matches, dominates, id_set
 
 
 def test_wildtree_1():
@@ -74,3 +77,427 @@ def test_wildtree_5():
     with pytest.raises(KeyError):
         assert t[('a', 'x', 'f')] == 1
     assert WildTree(json=repr(t)) == t
+
+
+def test_wildtree_freeze():
+    t = WildTree()
+    t[('a', 'b', 'c')] = 1
+    t[('a', '*', 'e')] = 3
+    t.freeze()
+    assert t.frozen
+    assert t[('a', 'b', 'c')] == 1
+    assert t[('a', 'x', 'e')] == 3
+    with pytest.raises(TypeError):
+        t[('a', 'b', 'd')] = 2
+    with pytest.raises(TypeError):
+        del t[('a', 'b', 'c')]
+    assert WildTree(json=repr(t)) == t
+
+
+def test_wildtree_copy_on_write():
+    t = WildTree()
+    t[('a', 'b', 'c')] = 1
+    t[('a', 'b', 'd')] = 2
+    t[('x', 'y')] = 4
+    t.freeze()
+    before = repr(t)
+
+    u = t.copy()
+    assert not u.frozen
+    u[('a', 'b', 'e')] = 5
+    u[('a', 'b', '*')] = 6
+    del u[('x', 'y')]
+    assert repr(t) == before
+    assert t[('a', 'b', 'c')] == 1
+    assert t[('x', 'y')] == 4
+    assert u[('a', 'b', 'c')] == 6
+    assert ('x', 'y') not in u
+
+    # Untouched subtrees are shared between the original and the copy.
+    v = t.copy()
+    v[('a', 'b', 'f')] = 7
+    assert v.root[1][0][1] is t.root[1][0][1]
+    assert v.root[1][1][1] is not t.root[1][1][1]
+
+
+def test_wildtree_hash_consing():
+    def build(value):
+        t = WildTree()
+        t[('a', 'b', 'c')] = value
+        t[('x', 'b', 'c')] = value
+        t[('y', '*')] = 'other'
+        return t.freeze()
+
+    t, u = build('allow'), build('allow')
+    assert t.root is u.root
+    assert t == u
+    # Identical subtrees within a tree are shared too.
+    subs = dict(t.root[1])
+    assert subs['a'] is subs['x']
+
+    # Items that compare equal but have different types are distinct.
+    v, w = build(1), build(True)
+    assert v.root is not w.root
+    assert w[('a', 'b', 'c')] is True
+
+    # Copy-on-write updates keep unchanged subtrees shared.
+    c = t.copy()
+    c[('x', 'b', 'd')] = 'deny'
+    c.freeze()
+    assert dict(c.root[1])['a'] is subs['a']
+    assert dict(c.root[1])['x'] is not subs['x']
+
+
+def test_wildtree_hash_consing_prune():
+    from tutelary import wildtree
+    t = WildTree()
+    t[('only', 'in', 'this', 'tree')] = 'only-in-this-tree'
+    t.freeze()
+    node = t.root
+    before = wildtree.prune_canonical_nodes()
+    del t, node
+    assert wildtree.prune_canonical_nodes() == before - 5
+
+
+def test_wildtree_wildcard_precedence():
+    # A later wildcard rule takes precedence over an earlier rule even
+    # when there is an existing wildcard subtree that isn't first.
+    t = WildTree()
+    t[('a', '*')] = 'old'
+    t[('*', 'x')] = 'wild'
+    t[('*', 'z')] = 'new'
+    assert t[('a', 'z')] == 'new'
+    assert t[('a', 'y')] == 'old'
+
+
+def test_wildtree_delete_keeps_other_lengths():
+    t = WildTree()
+    t[('a',)] = 1
+    t[('a', 'b')] = 2
+    t[('a', 'b', 'c')] = 3
+    del t[('a', 'b')]
+    assert ('a',) in t
+    assert ('a', 'b', 'c') in t
+    del t[('a', 'b', 'c')]
+    assert list(t) == [('a',)]
+
+
+def test_wildtree_trailing_wildcard_domination():
+    t = WildTree()
+    t[('a', 'b')] = 'old'
+    t[('a', 'b', '*')] = 'new'
+    assert len(t) == 1
+    assert t[('a', 'b')] == 'new'
+
+
+def _random_rules(rng, n):
+    comps = ['a', 'b', 'c', '*', '*']
+    return [(tuple(rng.choice(comps) for _ in range(rng.randint(1, 4))),
+             rng.choice(['allow', 'deny', 1]))
+            for _ in range(n)]
+
+
+def _latest_match(rules, key):
+    for pat, v in reversed(rules):
+        if (len(pat) >= len(key) and
+                all(p == '*' or p == k for p, k in zip(pat, key)) and
+                all(p == '*' for p in pat[len(key):])):
+            return v
+    raise KeyError(key)
+
+
+def _lookup(tree, key):
+    try:
+        return tree[key]
+    except KeyError:
+        return KeyError
+
+
+@pytest.mark.parametrize('seed', range(200))
+def test_wildtree_overlay_fuzz(seed):
+    rng = random.Random(seed)
+    lower = _random_rules(rng, rng.randint(0, 8))
+    upper = _random_rules(rng, rng.randint(0, 8))
+    serial = WildTree()
+    for k, v in lower + upper:
+        serial[k] = v
+    t = WildTree()
+    for k, v in lower:
+        t[k] = v
+    u = WildTree()
+    for k, v in upper:
+        u[k] = v
+    merged = t.freeze().overlay(u)
+    assert merged.frozen
+    assert sorted(merged.items(), key=repr) == sorted(serial.items(), key=repr)
+    for n in range(5):
+        for key in itertools.product('abcd', repeat=n):
+            expected = _lookup(serial, key)
+            assert _lookup(merged, key) == expected
+            try:
+                assert _latest_match(lower + upper, key) == expected
+            except KeyError:
+                assert expected is KeyError
+
+
+def test_wildtree_minimise():
+    t = WildTree()
+    t[('a', '*', '*')] = 'allow'
+    t[('a', 'b', 'c')] = 'deny'
+    t[('a', 'b', 'd')] = 'allow'
+    t[('x', 'y')] = 'deny'
+    nodes = t.node_count()
+    ratio = t.minimise(lambda v: v == 'allow')
+    # The allow under the more general allow and the deny that
+    # overrides nothing are redundant.
+    assert sorted(t.items()) == [(('a', '*', '*'), 'allow'),
+                                 (('a', 'b', 'c'), 'deny')]
+    assert ratio == t.node_count() / nodes < 1
+    assert t[('a', 'b', 'd')] == 'allow'
+
+
+@pytest.mark.parametrize('seed', range(200))
+def test_wildtree_minimise_fuzz(seed):
+    rng = random.Random(seed)
+    rules = _random_rules(rng, rng.randint(0, 10))
+    t = WildTree()
+    for k, v in rules:
+        t[k] = v
+    frozen = t.copy().freeze()
+    allowed = t.copy()
+    allowed.minimise(lambda v: v == 'allow')
+    t.minimise()
+    assert t.node_count() <= frozen.node_count()
+    for n in range(5):
+        for key in itertools.product('abcd', repeat=n):
+            expected = _lookup(frozen, key)
+            assert _lookup(t, key) == expected
+            assert ((_lookup(allowed, key) == 'allow') ==
+                    (expected == 'allow'))
+
+
+def test_id_sets():
+    assert str(id_set('[7,1-3,4,10-12]')) == '[1-4,7,10-12]'
+    for bad in ['[]', '[01]', '[3-1]', '[1,]', '1-3', '[a-b]']:
+        assert id_set(bad) is None
+    ids = id_set('[1000-1999,2500]')
+    assert 1000 in ids and 1999 in ids and 2500 in ids
+    assert 999 not in ids and 2000 not in ids and 2501 not in ids
+    assert len(ids) == 1001
+    assert dominates(('a', '[1-10]'), ('a', '3'))
+    assert dominates(('a', '[1-10]'), ('a', '[2-5,7]'))
+    assert not dominates(('a', '[1-10]'), ('a', '[5-11]'))
+    assert not dominates(('a', '3'), ('a', '[3]'))
+
+    t = WildTree()
+    t[('a', '*')] = 'deny'
+    t[('a', '[1000-1999]')] = 'allow'
+    assert t[('a', '1500')] == 'allow'
+    for k in ['999', '2000', '01500', 'x']:
+        assert t[('a', k)] == 'deny'
+    # Later keys take precedence, and ID sets purge the keys they
+    # dominate.
+    t[('a', '1500')] = 'deny'
+    assert t[('a', '1500')] == 'deny' and len(t) == 3
+    t[('a', '[1000-1999]')] = 'allow'
+    assert t[('a', '1500')] == 'allow' and len(t) == 2
+
+
+def test_wildtree_minimise_id_sets():
+    t = WildTree()
+    t[('p', '*')] = 'deny'
+    for i in range(1000, 1100):
+        t[('p', str(i))] = 'allow'
+    t[('p', '1050', 'x')] = 'deny'
+    t[('p', '2000')] = 'deny'
+    nodes = t.node_count()
+    t.minimise()
+    # The IDs with identical subtrees are merged, and the deny that
+    # overrides the wildcard with the same value is removed.
+    assert sorted(t) == [('p', '*'), ('p', '1050'), ('p', '1050', 'x'),
+                         ('p', '[1000-1049,1051-1099]')]
+    assert t.node_count() == 6 < nodes / 10
+    assert t[('p', '1099')] == 'allow'
+    assert t[('p', '1100')] == 'deny'
+    assert t[('p', '1050', 'x')] == 'deny'
+
+
+def _id_rules(rng, n):
+    comps = ['1', '2', '3', '4', '[1-2]', '[2-4]', '[1,3]', '*']
+    return [(tuple(rng.choice(comps) for _ in range(rng.randint(1, 3))),
+             rng.choice(['allow', 'deny']))
+            for _ in range(n)]
+
+
+def _latest_id_match(rules, key):
+    for pat, v in reversed(rules):
+        if (len(pat) >= len(key) and
+                all(component_matches(p, k) for p, k in zip(pat, key)) and
+                all(p == '*' for p in pat[len(key):])):
+            return v
+    return KeyError
+
+
+@pytest.mark.parametrize('seed', range(200))
+def test_wildtree_id_set_fuzz(seed, monkeypatch):
+    monkeypatch.setattr(wildtree, 'ID_SET_MIN_SIZE', 2)
+    rng = random.Random(seed)
+    lower = _id_rules(rng, rng.randint(0, 8))
+    upper = _id_rules(rng, rng.randint(0, 8))
+    serial = WildTree()
+    t = WildTree()
+    u = WildTree()
+    for k, v in lower:
+        serial[k] = t[k] = v
+    for k, v in upper:
+        serial[k] = u[k] = v
+    merged = t.freeze().overlay(u)
+    assert sorted(merged.items(), key=repr) == sorted(serial.items(), key=repr)
+    minimised = serial.copy()
+    minimised.minimise()
+    assert minimised.node_count() <= serial.node_count()
+    for n in range(4):
+        for key in itertools.product(['1', '2', '3', '4', '5', '01'],
+                                     repeat=n):
+            expected = _latest_id_match(lower + upper, key)
+            assert _lookup(serial, key) == expected
+            assert _lookup(merged, key) == expected
+            assert _lookup(minimised, key) == expected
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_wildtree_bloom_prefilter(seed, monkeypatch):
+    monkeypatch.setattr(wildtree, 'BLOOM_MIN_CHILDREN', 8)
+    rng = random.Random(seed)
+    comps = [str(i) for i in range(40)] + ['*', '[5-9]', 'x']
+    t = WildTree()
+    for _ in range(60):
+        key = tuple(rng.choice(comps) for _ in range(rng.randint(1, 3)))
+        t[key] = rng.choice(['allow', 'deny'])
+    frozen = t.copy().freeze()
+    for n in range(4):
+        for _ in range(100):
+            key = tuple(rng.choice(comps + ['41', '07', 'y'])
+                        for _ in range(n))
+            assert _lookup(frozen, key) == _lookup(t, key)
+            try:
+                expected = t.find(key, perfect=True)
+            except KeyError:
+                expected = KeyError
+            try:
+                assert frozen.find(key, perfect=True) == expected
+            except KeyError:
+                assert expected is KeyError
+    wide = [n for n, _ in frozen._prefilters.values()]
+    assert wide and all(len(n[1]) >= 8 for n in wide)
+    # Minimising replaces the nodes, so their filters are dropped.
+    frozen.minimise()
+    assert not frozen._prefilters
+
+
+def test_wildtree_bloom_prefilter_misses():
+    subtrees = [(str(i), (i % 2 == 0 and 'allow' or 'deny', ()))
+                for i in range(2000)]
+    t = WildTree()
+    t.root = (None, (('p', (None, tuple(subtrees) + (('*', ('x', ())),))),))
+    t.frozen = True
+    assert t[('p', '1998')] == 'allow'
+    assert t[('p', '1999')] == 'deny'
+    assert t[('p', '2000')] == 'x'
+    node = t.root[1][0][1]
+    pf = wildtree._prefilter(node, t._prefilters)
+    assert pf.wild == (2000,)
+    assert all(str(i) in pf for i in range(2000))
+    false_positives = sum(str(i) in pf for i in range(2000, 12000))
+    assert false_positives < 500
+
+
+def test_wildtree_multi_wildcard():
+    t = WildTree()
+    t[('a', '**')] = 'deny'
+    t[('a', '**', 'x')] = 'allow'
+    t[('a', 'b', '**', 'x', '*')] = 'other'
+    assert t[('a',)] == 'deny'
+    assert t[('a', 'x')] == 'allow'
+    assert t[('a', 'c', 'd', 'x')] == 'allow'
+    assert t[('a', 'b', 'c', 'x', 'y')] == 'other'
+    assert t[('a', 'b', 'x')] == 'other'
+    assert t[('a', 'x', 'y')] == 'deny'
+    with pytest.raises(KeyError):
+        t[('b', 'x')]
+    assert dominates(('a', '**'), ('a', 'b', '*'))
+    assert dominates(('**', 'x'), ('*', '*', 'x'))
+    assert not dominates(('a', '*'), ('a', '**'))
+    assert not dominates(('**', 'x'), ('a', '**'))
+
+
+def _multi_rules(rng, n):
+    comps = ['a', 'b', '1', '2', '[1-2]', '*', '**']
+    return [(tuple(rng.choice(comps) for _ in range(rng.randint(1, 3))),
+             rng.choice(['allow', 'deny']))
+            for _ in range(n)]
+
+
+def _glob_match(pat, key):
+    if not pat:
+        return not key
+    if pat[0] == '**':
+        return any(_glob_match(pat[1:], key[i:])
+                   for i in range(len(key) + 1))
+    if not key:
+        return all(p in ('*', '**') for p in pat)
+    return (component_matches(pat[0], key[0]) and
+            _glob_match(pat[1:], key[1:]))
+
+
+@pytest.mark.parametrize('seed', range(100))
+def test_wildtree_multi_wildcard_fuzz(seed, monkeypatch):
+    monkeypatch.setattr(wildtree, 'ID_SET_MIN_SIZE', 2)
+    rng = random.Random(seed)
+    lower = _multi_rules(rng, rng.randint(0, 7))
+    upper = _multi_rules(rng, rng.randint(0, 7))
+    serial = WildTree()
+    t = WildTree()
+    u = WildTree()
+    for k, v in lower:
+        serial[k] = t[k] = v
+    for k, v in upper:
+        serial[k] = u[k] = v
+    merged = t.freeze().overlay(u)
+    minimised = serial.copy()
+    minimised.minimise()
+    frozen = serial.copy().freeze()
+    for n in range(5):
+        for key in itertools.product(['a', 'b', '1', '3'], repeat=n):
+            expected = next((v for p, v in reversed(lower + upper)
+                             if _glob_match(p, key)), KeyError)
+            assert _lookup(serial, key) == expected
+            assert _lookup(merged, key) == expected
+            assert _lookup(minimised, key) == expected
+            assert _lookup(frozen, key) == expected
+    for p, _ in lower + upper:
+        for q, _ in lower + upper:
+            if dominates(p, q):
+                assert all(_glob_match(p, key) for n in range(5)
+                           for key in itertools.product(['a', 'b', '1', '3'],
+                                                        repeat=n)
+                           if _glob_match(q, key))
+
+
+@pytest.mark.parametrize('bloom', [None, 4])
+def test_wildtree_lookup_each(bloom, monkeypatch):
+    monkeypatch.setattr(wildtree, 'BLOOM_MIN_CHILDREN', bloom)
+    t = WildTree()
+    t[('a', '*', '', 'view')] = 'allow'
+    t[('a', '**', '', 'edit')] = 'deny'
+    t[('a', 'b', '', '*')] = 'other'
+    t[('**', 'c', '', 'view')] = 'last'
+    for i in range(6):
+        t[('a', str(i), '', 'view')] = i
+    frozen = t.copy().freeze()
+    keys = [('view',), ('edit',), ('delete',), ('view', 'x')]
+    for prefix in [('a', 'b', ''), ('a', 'c', ''), ('a', ''),
+                   ('a', '3', ''), ('x', 'y', 'c', ''), ('b', '')]:
+        for tree in [t, frozen]:
+            expected = [_lookup(t, prefix + k) for k in keys]
+            assert tree.lookup_each(prefix, keys, KeyError) == expected
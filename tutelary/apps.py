@@ -1,6 +1,8 @@
+import atexit
 from django.apps import AppConfig
 from django.apps import apps as django_apps
 from django.conf import settings
+from django.db import DatabaseError
 
 
 class TutelaryConfig(AppConfig):
@@ -12,3 +14,40 @@ class TutelaryConfig(AppConfig):
             from .models import assign_user_policies, user_assigned_policies
             user_model.assign_policies = assign_user_policies
             user_model.assigned_policies = user_assigned_policies
+        if getattr(settings, 'TUTELARY_TREE_SNAPSHOT', None):
+            self._use_snapshot()
+        if getattr(settings, 'TUTELARY_WARM_ON_READY', False):
+            from .models import PermissionSet
+            try:
+                PermissionSet.objects.warm()
+            except DatabaseError:
+                # Tables not set up yet, e.g. when running the initial
+                # migrations.
+                pass
+
+    @staticmethod
+    def _use_snapshot():
+        # Restore the tree cache from the snapshot file, if there is one.
+        # Saving a new snapshot when the process exits is opt-in, so
+        # that short-lived processes (management commands, test runs)
+        # don't replace a good snapshot with their own nearly empty
+        # caches.
+        from .models import PermissionSet
+        try:
+            PermissionSet.objects.restore_snapshot()
+        except (DatabaseError, OSError, ValueError):
+            # No snapshot yet, an unreadable one, or no tables: the
+            # trees will be built as they are needed.
+            pass
+        if getattr(settings, 'TUTELARY_SAVE_SNAPSHOT_ON_EXIT', False):
+            atexit.register(_save_snapshot)
+
+
+def _save_snapshot():
+    from .models import PermissionSet
+    if len(PermissionSet.ptree_cache) == 0:
+        return
+    try:
+        PermissionSet.objects.save_snapshot()
+    except (DatabaseError, OSError):
+        pass
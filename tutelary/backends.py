@@ -1,6 +1,6 @@
 from django.core.exceptions import ObjectDoesNotExist
 from .exceptions import InvalidPermissionObjectException
-from .models import PermissionSet
+from .models import PermissionSet, shared_store
 from .engine import Action, Object
 
 
@@ -12,12 +12,26 @@ class Backend:
     def _get_pset(self, user):
         try:
             if user.is_authenticated():
-                return user.permissionset.first().tree()
+                pset = user.permissionset.first()
             else:
-                return PermissionSet.objects.get(anonymous_user=True).tree()
+                pset = PermissionSet.objects.get(anonymous_user=True)
+            return self._shared_tree(pset.pk) or pset.tree()
         except AttributeError:
             raise ObjectDoesNotExist
 
+    @staticmethod
+    def _shared_tree(psetid):
+        # Trees from the shared store are used unless the permission
+        # set has been invalidated in this process since the store was
+        # loaded.
+        store = shared_store()
+        if store is None:
+            return None
+        invalidated = PermissionSet.ptree_cache.invalidated_at(psetid)
+        if invalidated is not None and invalidated >= store.loaded_at:
+            return None
+        return store.get(psetid)
+
     @staticmethod
     def _obj_ok(obj):
         return obj is None or callable(obj) or isinstance(obj, Object)
@@ -0,0 +1,307 @@
+# coding:utf-8
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+logger = logging.getLogger(__name__)
+
+
+class _Flight:
+    """
+    A permission tree build in progress.  The thread that starts the
+    build (the "leader") publishes its result or exception here, and
+    any other threads wanting the same tree wait for it instead of
+    building their own copy.
+
+    """
+    def __init__(self):
+        self.done = threading.Event()
+        self.tree = None
+        self.error = None
+
+    def finish(self, tree=None, error=None):
+        self.tree = tree
+        self.error = error
+        self.done.set()
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.tree
+
+
+class TreeCache:
+    """
+    Thread-safe cache of permission trees keyed by permission set ID.
+
+    Cached trees are treated as immutable snapshots: they are never
+    modified in place, but replaced wholesale (with ``swap`` or
+    ``replace``).  Reads of cached trees therefore take no locks.
+
+    Cache misses are "single-flight": when several threads ask for the
+    same missing tree at the same time, only one of them runs the
+    build function and the others wait for its result.  All mutation
+    of the cache is done under a lock.  Each key has a generation
+    number that is bumped on invalidation, so that a build that was
+    started before an invalidation never overwrites the cache with a
+    tree built from stale inputs.
+
+    If the cache has a staleness window (``stale``, given in seconds or
+    as a function returning the number of seconds), invalidated trees
+    are remembered for that long, along with the time of their
+    invalidation, so that callers can be served the old tree while a
+    new one is built in the background (see ``get``).
+
+    """
+    def __init__(self, rebuild_threads=2, stale=0):
+        self.rebuild_threads = rebuild_threads
+        self.stale = stale
+        self._lock = threading.Lock()
+        self._update_lock = threading.Lock()
+        self._executor = None
+        self._executor_pid = None
+        self._trees = {}
+        self._stale = {}
+        self._flights = {}
+        self._generations = {}
+        self._invalidated = {}
+        self._cleared_at = None
+
+    def __contains__(self, key):
+        return key in self._trees
+
+    def __getitem__(self, key):
+        return self._trees[key]
+
+    def __delitem__(self, key):
+        if key not in self._trees:
+            raise KeyError(key)
+        self.invalidate(key)
+
+    def __len__(self):
+        return len(self._trees)
+
+    def get(self, key, build, rebuild=None):
+        """
+        Return the cached tree for ``key``, calling ``build`` to construct
+        it if there is no cached tree.  Concurrent callers for the same
+        key share a single call to ``build``; exceptions raised by
+        ``build`` are propagated to all of them.
+
+        If the key was invalidated within the cache's staleness window,
+        the tree that was invalidated is returned immediately and a
+        replacement is built in a background thread (using
+        ``rebuild`` if it is given, or ``build`` otherwise).  Once the
+        staleness window has expired, callers wait for the new tree as
+        usual.
+
+        """
+        tree = self._trees.get(key)
+        if tree is not None:
+            return tree
+        with self._lock:
+            tree = self._trees.get(key)
+            if tree is not None:
+                return tree
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                generation = self._generations.get(key, 0)
+            old = self._stale.get(key)
+            use_stale = (old is not None and
+                         time.monotonic() - old[1] <= self._stale_window())
+            if use_stale and leader:
+                self._rebuild_executor().submit(
+                    self._build, key, flight, generation, rebuild or build
+                )
+        if use_stale:
+            return old[0]
+        if not leader:
+            return flight.wait()
+        return self._build(key, flight, generation, build)
+
+    def _stale_window(self):
+        return self.stale() if callable(self.stale) else self.stale
+
+    def _retire(self, key, tree):
+        # Remember an invalidated tree for the staleness window, if there
+        # is one, and forget the trees whose windows have passed.  Must
+        # be called with the lock held.
+        window = self._stale_window()
+        now = time.monotonic()
+        for k, (_, at) in list(self._stale.items()):
+            if now - at > window:
+                del self._stale[k]
+        if tree is not None and window > 0 and key not in self._stale:
+            self._stale[key] = (tree, now)
+
+    def _rebuild_executor(self):
+        # Threads don't survive a fork, so processes forked from one
+        # that has already created the executor need their own.
+        if self._executor is None or self._executor_pid != os.getpid():
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.rebuild_threads
+            )
+            self._executor_pid = os.getpid()
+        return self._executor
+
+    def _build(self, key, flight, generation, build):
+        """
+        Run a build as the leader of ``flight`` and publish the result.
+        """
+        try:
+            tree = build()
+        except BaseException as exc:
+            with self._lock:
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+            flight.finish(error=exc)
+            raise
+        with self._lock:
+            # Results of builds that have been detached (by invalidation
+            # or ``forget``) are discarded.
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+                if self._generations.get(key, 0) == generation:
+                    self._trees[key] = tree
+                    self._stale.pop(key, None)
+        flight.finish(tree=tree)
+        return tree
+
+    def generation(self, key):
+        """
+        Current generation number for ``key``.
+        """
+        with self._lock:
+            return self._generations.get(key, 0)
+
+    def swap(self, key, tree):
+        """
+        Atomically replace the cached tree for ``key``.  Builds in flight
+        for the key are detached and their results discarded.
+
+        """
+        with self._lock:
+            self._flights.pop(key, None)
+            self._generations[key] = self._generations.get(key, 0) + 1
+            self._trees[key] = tree
+            self._stale.pop(key, None)
+
+    def replace(self, key, replace):
+        """
+        Replace the cached tree for ``key`` with the result of calling
+        ``replace`` on it.  Replacements are serialised with respect to
+        each other.  If there is no cached tree for the key, if the key
+        is invalidated or swapped while ``replace`` runs, or if
+        ``replace`` raises an exception (which is logged), the key is
+        invalidated instead, so that no tree built from stale inputs is
+        kept.  Returns the new tree, or ``None`` if the key was
+        invalidated.
+
+        """
+        with self._update_lock:
+            with self._lock:
+                current = self._trees.get(key)
+                generation = self._generations.get(key, 0)
+            tree = None
+            if current is not None:
+                try:
+                    tree = replace(current)
+                except Exception:
+                    logger.exception('Replacing the permission tree for %r '
+                                     'failed', key)
+                    tree = None
+            with self._lock:
+                if (tree is None or
+                        self._generations.get(key, 0) != generation):
+                    tree = None
+                    self._retire(key, self._trees.pop(key, None))
+                    self._flights.pop(key, None)
+                else:
+                    self._trees[key] = tree
+                    self._stale.pop(key, None)
+                self._generations[key] = self._generations.get(key, 0) + 1
+                self._invalidated[key] = time.monotonic()
+            return tree
+
+    def snapshot(self):
+        """
+        Return the current contents of the cache, as a dictionary mapping
+        keys to (generation, tree) pairs.
+
+        """
+        with self._lock:
+            return {key: (self._generations.get(key, 0), tree)
+                    for key, tree in self._trees.items()}
+
+    def restore(self, trees):
+        """
+        Install trees from a dictionary mapping keys to trees, for keys
+        that don't already have cached trees or builds in flight.
+        Returns the number of trees installed.
+
+        """
+        n = 0
+        with self._lock:
+            for key, tree in trees.items():
+                if key not in self._trees and key not in self._flights:
+                    self._trees[key] = tree
+                    self._stale.pop(key, None)
+                    n += 1
+        return n
+
+    def invalidate(self, key):
+        """
+        Discard any cached tree for ``key``.  Builds already in flight for
+        the key are detached, so that later callers start a fresh build
+        from current inputs.
+
+        """
+        with self._lock:
+            self._retire(key, self._trees.pop(key, None))
+            self._flights.pop(key, None)
+            self._generations[key] = self._generations.get(key, 0) + 1
+            self._invalidated[key] = time.monotonic()
+
+    def forget(self, key):
+        """
+        Discard everything known about ``key`` (for example, when its
+        permission set is deleted), including its invalidation time and
+        any invalidated tree.  Builds in flight for the key are
+        detached and their results discarded.
+
+        """
+        with self._lock:
+            self._trees.pop(key, None)
+            self._stale.pop(key, None)
+            self._flights.pop(key, None)
+            self._generations.pop(key, None)
+            self._invalidated.pop(key, None)
+
+    def invalidated_at(self, key):
+        """
+        Time (from ``time.monotonic``) of the last invalidation of
+        ``key``, or ``None`` if it has never been invalidated.
+
+        """
+        times = [t for t in (self._invalidated.get(key), self._cleared_at)
+                 if t is not None]
+        return max(times) if times else None
+
+    def clear(self):
+        """
+        Discard all cached trees.
+        """
+        with self._lock:
+            for key in set(self._trees) | set(self._flights):
+                self._generations[key] = self._generations.get(key, 0) + 1
+            self._trees.clear()
+            self._stale.clear()
+            self._flights.clear()
+            self._invalidated.clear()
+            self._cleared_at = time.monotonic()
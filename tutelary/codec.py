@@ -0,0 +1,234 @@
+# coding:utf-8
+"""
+Compact binary serialisation of ``WildTree`` and ``PermissionTree``
+objects.
+
+The JSON serialisation provided by ``repr`` repeats the ``"item"`` and
+``"subtrees"`` keys for every node and every key string wherever it
+appears, and is slow to load.  The binary format stores each distinct
+string once, in a string table, and represents the tree as a flat
+array of 32-bit little-endian words.  Each node record is laid out in
+preorder as::
+
+  item code, number of children,
+  (key index, child record size in words, child record) ...
+
+Item codes index the string table (offset by one, with zero meaning
+"no item"): items are stored as their JSON representation so that any
+JSON-serialisable value can be used.  Because each child record is
+preceded by its size, a loader can skip over subtrees without decoding
+them, which is what the lazy loading mode does.
+
+A file consists of a header (the magic bytes ``TUTW``, a 16-bit format
+version and 16 bits of flags, of which the lowest is set for
+permission trees with object-first keys), the string table (string count, UTF-8
+byte count, string end offsets, UTF-8 bytes), and the word count and
+words of the node records.
+
+"""
+import json
+import struct
+import sys
+from array import array
+
+from .wildtree import WildTree, canonical_node
+
+
+MAGIC = b'TUTW'
+VERSION = 1
+
+_HEADER = struct.Struct('<4sHH')
+_COUNTS = struct.Struct('<II')
+_WORD = 'I' if array('I').itemsize == 4 else 'L'
+
+_OBJECT_FIRST = 1
+
+
+def dump_tree(tree):
+    """Serialise a ``WildTree`` or ``PermissionTree`` to bytes.
+
+    """
+    root = _wildtree(tree).root
+    strings = []
+    index = {}
+
+    def intern(s):
+        i = index.get(s)
+        if i is None:
+            i = index[s] = len(strings)
+            strings.append(s)
+        return i
+
+    def encode(node):
+        item = node[0]
+        rec = [0 if item is None else
+               intern(json.dumps(item, sort_keys=True)) + 1, len(node[1])]
+        for k, st in node[1]:
+            sub = encode(st)
+            rec.append(intern(k))
+            rec.append(len(sub))
+            rec.extend(sub)
+        return rec
+
+    words = array(_WORD, encode(root))
+    flags = _OBJECT_FIRST if getattr(tree, 'object_first', False) else 0
+    blobs = [s.encode('utf-8') for s in strings]
+    ends = []
+    end = 0
+    for b in blobs:
+        end += len(b)
+        ends.append(end)
+    return b''.join([_HEADER.pack(MAGIC, VERSION, flags),
+                     _COUNTS.pack(len(strings), end),
+                     _to_bytes(array(_WORD, ends)),
+                     b''.join(blobs),
+                     struct.pack('<I', len(words)),
+                     _to_bytes(words)])
+
+
+def load_tree(data, lazy=False):
+    """Deserialise a frozen ``WildTree`` from bytes produced by
+    ``dump_tree``.  In lazy mode, the nodes of the tree are only
+    decoded when a lookup first touches them.
+
+    """
+    words, strings, _ = _parse(data)
+    items = _Items(strings)
+    tree = WildTree()
+    if lazy:
+        tree.root = _LazyNode(words, 0, strings, items)
+    else:
+        tree.root = _decode(words, 0, strings, items)[0]
+    tree.frozen = True
+    return tree
+
+
+def load_permission_tree(data, lazy=False):
+    """Deserialise a frozen ``PermissionTree`` from bytes produced by
+    ``dump_tree``.
+
+    """
+    from .engine import PermissionTree
+    tree = load_tree(data, lazy)
+    flags = _HEADER.unpack_from(data)[2]
+    ptree = PermissionTree(object_first=bool(flags & _OBJECT_FIRST))
+    ptree.tree = tree
+    return ptree
+
+
+def _wildtree(tree):
+    return tree if isinstance(tree, WildTree) else tree.tree
+
+
+def _to_bytes(words):
+    if sys.byteorder == 'big':
+        words = array(_WORD, words)
+        words.byteswap()
+    return words.tobytes()
+
+
+def _from_bytes(data):
+    words = array(_WORD)
+    words.frombytes(data)
+    if sys.byteorder == 'big':
+        words.byteswap()
+    return words
+
+
+def _parse(data):
+    """Split serialised data into the node record words, the string
+    table and the header flags.
+
+    """
+    data = memoryview(data)
+    if len(data) < _HEADER.size + _COUNTS.size:
+        raise ValueError('truncated tree encoding')
+    magic, version, flags = _HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError('not a binary tree encoding')
+    if version != VERSION:
+        raise ValueError('unsupported tree encoding version ' + str(version))
+    pos = _HEADER.size
+    nstrings, nbytes = _COUNTS.unpack_from(data, pos)
+    pos += _COUNTS.size
+    ends = _from_bytes(data[pos:pos + 4 * nstrings])
+    pos += 4 * nstrings
+    blob = bytes(data[pos:pos + nbytes])
+    pos += nbytes
+    strings = []
+    start = 0
+    for end in ends:
+        strings.append(blob[start:end].decode('utf-8'))
+        start = end
+    nwords, = struct.unpack_from('<I', data, pos)
+    pos += 4
+    words = _from_bytes(data[pos:pos + 4 * nwords])
+    if len(words) != nwords:
+        raise ValueError('truncated tree encoding')
+    return words, strings, flags
+
+
+class _Items:
+    """Decoded item values, indexed by item code.
+
+    """
+    def __init__(self, strings):
+        self.strings = strings
+        self.values = {0: None}
+
+    def __getitem__(self, code):
+        try:
+            return self.values[code]
+        except KeyError:
+            v = self.values[code] = json.loads(self.strings[code - 1])
+            return v
+
+
+def _decode(words, pos, strings, items):
+    """Decode the node record at ``pos``, returning the frozen node and
+    the position following the record.
+
+    """
+    item = items[words[pos]]
+    n = words[pos + 1]
+    pos += 2
+    subtrees = []
+    for _ in range(n):
+        k = strings[words[pos]]
+        st, pos = _decode(words, pos + 2, strings, items)
+        subtrees.append((k, st))
+    return canonical_node((item, tuple(subtrees))), pos
+
+
+class _LazyNode:
+    """Read-only tree node that decodes its subtrees from the serialised
+    node records the first time they are needed.
+
+    """
+    __slots__ = ('words', 'pos', 'strings', 'items', 'subtrees')
+
+    def __init__(self, words, pos, strings, items):
+        self.words = words
+        self.pos = pos
+        self.strings = strings
+        self.items = items
+        self.subtrees = None
+
+    def __getitem__(self, idx):
+        if idx == 0:
+            return self.items[self.words[self.pos]]
+        if self.subtrees is None:
+            words = self.words
+            n = words[self.pos + 1]
+            pos = self.pos + 2
+            subtrees = []
+            for _ in range(n):
+                subtrees.append((self.strings[words[pos]],
+                                 _LazyNode(words, pos + 2,
+                                           self.strings, self.items)))
+                pos += 2 + words[pos + 1]
+            self.subtrees = tuple(subtrees)
+        return self.subtrees
+
+    def __len__(self):
+        return 2
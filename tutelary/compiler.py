@@ -0,0 +1,496 @@
+# coding:utf-8
+"""
+Compilation of permission trees from policy bodies, either one at a
+time or in bulk across a pool of worker processes.
+
+Many permission sets share a common prefix of policy instances (for
+example, the default policy followed by an organisation-level role),
+so the trees for every prefix compiled are remembered, keyed by a
+hash chain over the policy instances.  Compiling a new permission set
+then starts from the tree for the longest prefix already compiled and
+only adds the remaining policies to it.  Complete trees are minimised
+(see ``PermissionTree.minimise``) and remembered separately from the
+prefix trees they are made from.
+
+Each policy instance is itself compiled only once into its own tree
+(cached by policy body hash and variable assignments), and policies
+are added to a prefix tree by a structural merge of the two trees
+(see ``WildTree.overlay``), rather than by inserting the policy's
+clauses one at a time.  Since trees are frozen, the merged trees
+share all the subtrees that the merge leaves unchanged.
+
+Policy instances of the same body that differ only in their variable
+assignments (for instance, one role instantiated for thousands of
+projects) share a parametric template tree: the body is compiled once
+with placeholders standing in for its variables, and the tree for each
+instance is made by substituting the variable values into the keys of
+the template tree, copying only the paths that lead to keys containing
+placeholders.
+
+Parsed policy instances (``PolicyBody`` objects and their lists of
+clauses) are also remembered, so that policy instances shared between
+permission sets are parsed only once.
+
+When a policy body is edited, the trees that were compiled from the
+old version of the policy are brought up to date by
+``recompile_tree``, which only redoes the work that the edit makes
+necessary.
+
+This module deliberately doesn't depend on Django, so that worker
+processes can be started cheaply whatever multiprocessing start method
+is in use.
+
+"""
+import hashlib
+import itertools
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from . import codec
+from .codec import dump_tree, load_permission_tree
+from .engine import LayeredPermissionTree, PermissionTree, PolicyBody
+from .wildtree import WildTree, canonical_node, id_set, is_id
+
+
+PREFIX_CACHE_SIZE = 1024
+"""Maximum number of policy instance prefix trees remembered."""
+
+COMPILED_CACHE_SIZE = 1024
+"""Maximum number of complete (minimised) permission trees remembered."""
+
+POLICY_CACHE_SIZE = 1024
+"""Maximum number of single policy instance trees remembered."""
+
+TEMPLATE_CACHE_SIZE = 1024
+"""Maximum number of policy body templates remembered."""
+
+POLICY_BODY_CACHE_SIZE = 1024
+"""Maximum number of parsed policy instances remembered."""
+
+_prefix_trees = OrderedDict()
+_compiled_trees = OrderedDict()
+_policy_trees = OrderedDict()
+_templates = OrderedDict()
+_policy_bodies = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def compile_tree(instances, object_first=False):
+    """Compile a frozen permission tree from a sequence of policy
+    instances, each given as a (JSON policy body, variable assignment
+    dictionary) pair.  The result may be shared with other callers
+    compiling the same sequence of policy instances.  If
+    ``object_first`` is true, the tree has object-first keys (see
+    ``tutelary.engine.PermissionTree``).
+
+    """
+    instances = list(instances)
+    keys = _prefix_keys(instances, object_first)
+    if not keys:
+        return PermissionTree(object_first=object_first).freeze()
+    compiled = _recall(_compiled_trees, keys[-1])
+    if compiled is not None:
+        return compiled
+    start, tree = 0, None
+    with _cache_lock:
+        for i in range(len(keys), 0, -1):
+            tree = _prefix_trees.get(keys[i - 1])
+            if tree is not None:
+                _prefix_trees.move_to_end(keys[i - 1])
+                start = i
+                break
+    if tree is None:
+        tree = PermissionTree(object_first=object_first).freeze()
+    for i in range(start, len(instances)):
+        body, variables = instances[i]
+        tree = tree.overlay(policy_tree(body, variables, object_first))
+        _remember(_prefix_trees, keys[i], tree, PREFIX_CACHE_SIZE)
+
+    # Rules that don't affect any permission checks are dropped from
+    # complete trees.  Prefix trees are kept as they are, so that a
+    # tree is the same whichever prefixes happened to be compiled
+    # before it (as they are when compiling serially, but not in a
+    # fresh worker process).
+    compiled = tree.copy().freeze()
+    compiled.minimise()
+    _remember(_compiled_trees, keys[-1], compiled, COMPILED_CACHE_SIZE)
+    return compiled
+
+
+def compile_layered_tree(instances, object_first=False):
+    """Build a ``LayeredPermissionTree`` for a sequence of policy
+    instances (given as for ``compile_tree``) from the shared trees of
+    the individual policy instances.
+
+    """
+    return LayeredPermissionTree(policy_tree(body, variables, object_first)
+                                 for body, variables in instances)
+
+
+def policy_tree(body, variables, object_first=False):
+    """Frozen permission tree for a single policy instance (given as a
+    JSON policy body and a variable assignment dictionary), compiled
+    once and shared between all callers.
+
+    """
+    key = _instance_key(body, variables) + (object_first,)
+    tree = _recall(_policy_trees, key)
+    if tree is not None:
+        return tree
+    tree = _policy_template(body, key[0], object_first).bind(variables)
+    if tree is None:
+        tree = PermissionTree(object_first=object_first)
+        for e, a, o in policy_clauses(body, variables):
+            tree.add(e, a, o)
+        tree.freeze()
+    _remember(_policy_trees, key, tree, POLICY_CACHE_SIZE)
+    return tree
+
+
+def policy_body(body, variables):
+    """Parsed ``PolicyBody`` for a single policy instance (given as a
+    JSON policy body and a variable assignment dictionary), parsed
+    once and shared between all callers, who must not modify it.
+
+    """
+    return _parsed(body, variables)[0]
+
+
+def policy_clauses(body, variables):
+    """The (effect, action, object) triples of a single policy instance
+    (given as for ``policy_body``) as a tuple, computed once and
+    shared between all callers.
+
+    """
+    return _parsed(body, variables)[1]
+
+
+def _parsed(body, variables):
+    key = _instance_key(body, variables)
+    parsed = _recall(_policy_bodies, key)
+    if parsed is None:
+        policy = PolicyBody(json=body, variables=variables)
+        parsed = (policy, tuple(policy))
+        _remember(_policy_bodies, key, parsed, POLICY_BODY_CACHE_SIZE)
+    return parsed
+
+
+def _instance_key(body, variables):
+    """Cache key for a policy instance: the MD5 hash of the policy body
+    and the canonical JSON form of the variable assignments.
+
+    """
+    return (hashlib.md5(body.encode()).digest(),
+            json.dumps(variables, sort_keys=True))
+
+
+_PLACEHOLDER = '\ufdd0'
+_PLACEHOLDER_RE = re.compile(_PLACEHOLDER + r'(\w+)' + _PLACEHOLDER)
+_PLAIN_VALUE = re.compile(r'[\w\-@+]+\Z')
+
+
+class _Placeholders(dict):
+    """Variable assignment giving a placeholder for every variable, and
+    recording the names of the variables used.
+
+    """
+    def __init__(self):
+        super().__init__()
+        self.names = set()
+
+    def __missing__(self, name):
+        self.names.add(name)
+        return _PLACEHOLDER + name + _PLACEHOLDER
+
+
+class _PolicyTemplate:
+    """A policy body compiled with placeholders in place of its
+    variables.
+
+    Substituting variable values into the keys of the template tree
+    gives exactly the tree that compiling the body with those values
+    would, as long as the substitution doesn't change the outcome of
+    any of the comparisons between pattern components made in
+    building the tree: that is, as long as the values contain no
+    separator or special characters, distinct components containing
+    placeholders remain distinct, none of them becomes equal to a
+    component of the body that doesn't contain placeholders, and none
+    of them becomes an ID set, or a numeric ID when the body contains
+    ID sets.  In any
+    other case (or if the body can't be compiled with placeholders),
+    ``bind`` returns ``None`` and the body must be compiled with the
+    actual values.
+
+    """
+    def __init__(self, body, object_first=False):
+        self.tree = None
+        if _PLACEHOLDER in body:
+            return
+        placeholders = _Placeholders()
+        try:
+            policy = PolicyBody(json=body, variables=placeholders)
+        except Exception:
+            # Compiling with the actual values reports the error.
+            return
+        components = set()
+        for _, act, obj in policy:
+            components.update(act.components)
+            if obj is not None:
+                components.update(obj.components)
+        self.names = placeholders.names
+        self.params = {c for c in components if _PLACEHOLDER in c}
+        self.concrete = components - self.params
+        self.id_sets = any(id_set(c) is not None for c in self.concrete)
+        self.tree = PermissionTree(policies=[policy],
+                                   object_first=object_first).freeze()
+
+        # IDs of the nodes with keys containing placeholders somewhere
+        # below them: only these need to be copied when binding.
+        self.dirty = set()
+
+        def mark(node):
+            dirty = False
+            for k, st in node[1]:
+                if mark(st) or k in self.params:
+                    dirty = True
+            if dirty:
+                self.dirty.add(id(node))
+            return dirty
+        mark(self.tree.tree.root)
+
+    def bind(self, variables):
+        """Frozen permission tree for the policy with the given variable
+        assignments, or ``None`` if it must be compiled directly.
+
+        """
+        if self.tree is None:
+            return None
+        if not self.params:
+            return self.tree
+        values = {}
+        for name in self.names:
+            if name not in variables:
+                return None
+            value = '%s' % (variables[name],)
+            if not _PLAIN_VALUE.match(value):
+                return None
+            values[name] = value
+        subst = {p: _PLACEHOLDER_RE.sub(lambda m: values[m.group(1)], p)
+                 for p in self.params}
+        bound = set(subst.values())
+        if len(bound) != len(subst) or bound & self.concrete:
+            return None
+        if any(id_set(b) is not None or self.id_sets and is_id(b)
+               for b in bound):
+            return None
+        wt = WildTree()
+        wt.root = self._bind(self.tree.tree.root, subst)
+        wt.frozen = True
+        tree = PermissionTree(object_first=self.tree.object_first)
+        tree.tree = wt
+        return tree
+
+    def _bind(self, node, subst):
+        if id(node) not in self.dirty:
+            return node
+        return canonical_node(
+            (node[0], tuple((subst.get(k, k), self._bind(st, subst))
+                            for k, st in node[1]))
+        )
+
+
+def _policy_template(body, digest, object_first):
+    key = (digest, object_first)
+    template = _recall(_templates, key)
+    if template is not None:
+        return template
+    template = _PolicyTemplate(body, object_first)
+    _remember(_templates, key, template, TEMPLATE_CACHE_SIZE)
+    return template
+
+
+def recompile_tree(tree, old, new):
+    """Bring a permission tree compiled from the policy instances ``old``
+    up to date for the policy instances ``new`` (both given as for
+    ``compile_tree``), typically after a policy body has been edited.
+
+    Policy instances that are unchanged at the start of the sequence
+    don't need to be compiled again.  If the only change is that
+    clauses have been appended to the last policy instance, the new
+    clauses are inserted into a copy of the existing tree.  Otherwise,
+    the tree is composed again from the tree for the unchanged prefix
+    of policy instances and the trees for the later policy instances:
+    since each policy instance has its own tree, this re-derives the
+    rules that were overridden by removed or changed clauses from the
+    policies that now take precedence.
+
+    """
+    old, new = list(old), list(new)
+    if isinstance(tree, LayeredPermissionTree):
+        return compile_layered_tree(new, tree.object_first)
+    n = 0
+    while n < min(len(old), len(new)) and old[n] == new[n]:
+        n += 1
+    if n == len(old) == len(new):
+        return tree
+    if len(old) == len(new) == n + 1:
+        added = _appended_clauses(old[n], new[n])
+        if added is not None:
+            t = tree.copy()
+            for e, a, o in added:
+                t.add(e, a, o)
+            t.freeze()
+            t.minimise()
+            # Not remembered for ``compile_tree``: the result can differ
+            # structurally from the tree compiled from scratch.
+            return t
+    return compile_tree(new, tree.object_first)
+
+
+def _appended_clauses(old, new):
+    """The (effect, action, object) triples added at the end of the
+    policy instance ``old`` to give ``new``, or ``None`` if ``new``
+    isn't just an extension of ``old``.
+
+    """
+    if old[1] != new[1]:
+        return None
+    olds = policy_clauses(*old)
+    news = policy_clauses(*new)
+
+    def key(clause):
+        e, a, o = clause
+        return e, a.components, o.components if o is not None else None
+    if list(map(key, olds)) != list(map(key, news[:len(olds)])):
+        return None
+    return news[len(olds):]
+
+
+def clear_caches():
+    """Forget all remembered parsed policies, policy templates, policy
+    instance trees, prefix trees and complete trees.
+
+    """
+    with _cache_lock:
+        _prefix_trees.clear()
+        _compiled_trees.clear()
+        _policy_trees.clear()
+        _templates.clear()
+        _policy_bodies.clear()
+
+
+def _recall(cache, key):
+    with _cache_lock:
+        value = cache.get(key)
+        if value is not None:
+            cache.move_to_end(key)
+        return value
+
+
+def _remember(cache, key, value, size):
+    with _cache_lock:
+        cache[key] = value
+        if len(cache) > size:
+            cache.popitem(last=False)
+
+
+def _prefix_keys(instances, object_first=False):
+    """Hash chain identifying each prefix of a sequence of policy
+    instances: the key for a prefix is a hash of the key for the
+    prefix one shorter and the hashes of the last policy body and its
+    variable assignments.  (The chains for trees with object-first
+    keys start from a different value.)
+
+    """
+    keys = []
+    key = b'object-first' if object_first else b''
+    for body, variables in instances:
+        h = hashlib.md5(key)
+        h.update(hashlib.md5(body.encode()).digest())
+        h.update(json.dumps(variables, sort_keys=True).encode())
+        key = h.digest()
+        keys.append(key)
+    return keys
+
+
+def fingerprint(instances, object_first=False):
+    """Fingerprint of a sequence of policy instances (given as for
+    ``compile_tree``), identifying the permission tree compiled from
+    them: an MD5 hash of the policy body hashes and variable
+    assignments (and the version of the binary serialisation format
+    used for storing compiled trees, and the key order of the tree).
+
+    """
+    canon = [[hashlib.md5(body.encode()).hexdigest(), variables]
+             for body, variables in instances]
+    data = [codec.VERSION, canon]
+    if object_first:
+        data.append('object-first')
+    return hashlib.md5(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+
+def compile_trees(specs, workers=None, timings=None, layered=False,
+                  object_first=False):
+    """Compile permission trees for a list of permission sets, each given
+    as a sequence of policy instances as for ``compile_tree``.  If
+    ``workers`` is greater than one (or ``None``, meaning one worker
+    per CPU), composition is done in a pool of worker processes that
+    return trees in the compact binary serialisation of
+    ``tutelary.codec``.  Trees are returned in the same order as
+    the input specifications and are identical to those produced by
+    compiling serially.  If a list is passed as ``timings``, the
+    compilation time of each tree (in seconds) is appended to it.  If
+    ``layered`` is true, ``LayeredPermissionTree`` objects are built
+    instead (always in the current process, since they share their
+    layers with other trees).  If ``object_first`` is true, the trees
+    have object-first keys.
+
+    """
+    specs = [list(spec) for spec in specs]
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(specs))
+    if workers <= 1 or layered:
+        results = map(_timed_layered if layered else _timed_compile, specs,
+                      itertools.repeat(object_first))
+        trees = []
+        for tree, secs in results:
+            trees.append(tree)
+            if timings is not None:
+                timings.append(secs)
+        return trees
+
+    # Hand out work in chunks to amortise the cost of inter-process
+    # communication, while keeping enough chunks to balance the load.
+    chunksize = max(1, len(specs) // (workers * 4))
+    trees = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for data, secs in executor.map(_serialised_compile, specs,
+                                       itertools.repeat(object_first),
+                                       chunksize=chunksize):
+            trees.append(load_permission_tree(data))
+            if timings is not None:
+                timings.append(secs)
+    return trees
+
+
+def _timed_compile(spec, object_first):
+    start = time.perf_counter()
+    tree = compile_tree(spec, object_first)
+    return tree, time.perf_counter() - start
+
+
+def _timed_layered(spec, object_first):
+    start = time.perf_counter()
+    tree = compile_layered_tree(spec, object_first)
+    return tree, time.perf_counter() - start
+
+
+def _serialised_compile(spec, object_first):
+    tree, secs = _timed_compile(spec, object_first)
+    return dump_tree(tree), secs
@@ -6,7 +6,7 @@ from string import Template
 import hashlib
 from collections import Sequence
 
-from .wildtree import WildTree
+from .wildtree import WildTree, component_overlap, id_set
 from .exceptions import (
     EffectException,
     PatternOverlapException,
@@ -24,7 +24,10 @@ class SimpleSeparated(Sequence):
     wildcarding.
 
     A wildcard component is represented by a ``*`` string and matches
-    any single string component.  Equality comparison between
+    any single string component, a ``**`` component matches any
+    number of components (including none), and an ID set component
+    (like ``[1000-1999]``: see ``tutelary.wildtree.IdSet``) matches the
+    numeric IDs in the set.  Equality comparison between
     sequences is exact comparison of components; matching between
     wildcarded components can be tested using the ``match`` method.
 
@@ -59,16 +62,44 @@ class SimpleSeparated(Sequence):
 
     def match(self, other):
         # Two sequences match if they are the same length and
-        # corresponding components are either equal, or at least one
-        # is a wildcard.
+        # corresponding components can match a common component (they
+        # are equal, at least one is a wildcard, or they are
+        # intersecting ID sets or an ID set and one of its members).
+        # Sequences with ``**`` components can match sequences of other
+        # lengths.
+        if '**' in self.components or '**' in other.components:
+            return _sequence_overlap(self.components, other.components)
         if len(self) != len(other):
             return False
         for cself, cother in zip(self.components, other.components):
-            if not (cself == cother or cself == '*' or cother == '*'):
+            if not component_overlap(cself, cother):
                 return False
         return True
 
 
+def _sequence_overlap(a, b):
+    # Whether the component sequences ``a`` and ``b`` can match a common
+    # sequence, where ``**`` components can absorb any number of
+    # components of the other sequence.
+    memo = {}
+
+    def overlap(i, j):
+        if (i, j) in memo:
+            return memo[i, j]
+        if i == len(a) or j == len(b):
+            rest = list(a[i:]) + list(b[j:])
+            res = all(c == '**' for c in rest)
+        elif a[i] == '**':
+            res = overlap(i + 1, j) or overlap(i, j + 1)
+        elif b[j] == '**':
+            res = overlap(i, j + 1) or overlap(i + 1, j)
+        else:
+            res = component_overlap(a[i], b[j]) and overlap(i + 1, j + 1)
+        memo[i, j] = res
+        return res
+    return overlap(0, 0)
+
+
 class EscapeSeparated(SimpleSeparated):
     """Sequences of strings delimited by a separator that can be
     backslash-escaped.  Backslashes can also be backslash-escaped; no
@@ -121,8 +152,13 @@ class Object(EscapeSeparated):
     """Objects are represented by slash-separated sequences of elements
     (e.g. ``Cadasta/Batangas/parcel/123``, ``H4H/PaP/party/118``) with
     wildcard elements indicated by ``*``
-    (e.g. ``Cadasta/*/parcel/*``).  Slashes can be backslash-escaped,
-    as can backslashes (e.g. ``Cadasta/Village-X\/Y/parcel/943``).
+    (e.g. ``Cadasta/*/parcel/*``), multi-element wildcards indicated
+    by ``**``, matching any number of elements, including none
+    (e.g. ``Cadasta/**/parcel/*``), and ranges of numeric IDs
+    indicated by ID set elements (e.g. ``Cadasta/*/parcel/[1000-1999]``
+    or ``Cadasta/*/parcel/[12,40-49]``).  Slashes can be
+    backslash-escaped, as can backslashes
+    (e.g. ``Cadasta/Village-X\/Y/parcel/943``).
 
     """
     separator = '/'
@@ -141,6 +177,11 @@ class Clause:
     the different action/object combinations within a clause.
     Overlapping patterns are thus potentially ambiguous.)
 
+    Multi-element ``**`` wildcards are only allowed in object patterns:
+    since permission tree keys are action components followed by
+    object components, a ``**`` in an action pattern would match
+    object components too.
+
     """
     def __init__(self, effect=None, act=None, obj=None, dict=None):
         """A clause can be created either by giving explicit lists of
@@ -159,10 +200,17 @@ class Clause:
                    for o in dict['object']] if 'object' in dict else []
         if effect not in ['allow', 'deny']:
             raise EffectException(effect)
-        if any(a1.match(a2) for a1 in act for a2 in act if a1 != a2):
-            raise PatternOverlapException('action')
-        if any(o1.match(o2) for o1 in obj for o2 in obj if o1 != o2):
-            raise PatternOverlapException('object')
+        for a in act:
+            if '**' in a.components:
+                raise PolicyBodyException(
+                    msg="'**' wildcard in action pattern '" + str(a) + "'"
+                )
+        conflicts = overlapping_patterns(act)
+        if conflicts:
+            raise PatternOverlapException('action', conflicts)
+        conflicts = overlapping_patterns(obj)
+        if conflicts:
+            raise PatternOverlapException('object', conflicts)
         self.effect = effect
         self.action = act
         self.object = obj
@@ -180,10 +228,15 @@ class PolicyBody(Sequence):
 
     """
     def __init__(self, json, variables=None):
+        # Comments are stripped before variable substitution, so that
+        # variable values can't introduce comments, and variables
+        # mentioned in comments needn't be assigned.
+        text = strip_comments(json)
         try:
-            d = loads(strip_comments(Template(json).substitute(variables)))
+            d = loads(Template(text).substitute(variables))
         except JSONDecodeError as e:
-            raise PolicyBodyException(lineno=e.lineno, colno=e.colno)
+            lineno, colno = _source_position(text, variables, e.pos)
+            raise PolicyBodyException(lineno=lineno, colno=colno)
         except (KeyError, TypeError, ValueError):
             raise VariableSubstitutionException()
         self.version = 'version' in d and d['version'] or '2015-12-10'
@@ -243,18 +296,34 @@ class PermissionTree:
      - Test an (action, object) pair against a permission tree.
      - Determine the list of allowed actions for an object pattern from
        a permission tree.
+     - Freeze a permission tree into an immutable snapshot, and make
+       cheap copy-on-write copies of frozen trees for updating.
 
     Most of the functionality needed here is implemented in the
     ``WildTree`` class.
 
+    The keys of the tree are normally the action components followed
+    by the object components, so the tree branches on actions first.
+    Trees made with ``object_first`` set instead use keys made of the
+    object components, a separator component (an empty string, which
+    can't be an object component) and the action components.  Checks
+    of many actions on the same object, as in ``permitted_actions``,
+    can then share a single descent through the object components.
+    Both orders give the same answers as long as actions are only
+    checked against action patterns with the same number of
+    components.  (With the action first, a pattern like ``*.*`` also
+    matches a single-component action followed by the first component
+    of an object.)
+
     """
 
-    def __init__(self, policies=None, json=None):
+    def __init__(self, policies=None, json=None, object_first=False):
         """Permission trees are all by default empty, with an optional list of
         policies added.  They can also be deserialised from JSON.
 
         """
         self.tree = WildTree(json)
+        self.object_first = object_first
         if policies is not None:
             self.add(policies=policies)
 
@@ -264,6 +333,54 @@ class PermissionTree:
         """
         return repr(self.tree)
 
+    @property
+    def frozen(self):
+        return self.tree.frozen
+
+    def freeze(self):
+        """Make the permission tree immutable.  Returns the permission tree
+        itself for convenience.
+
+        """
+        self.tree.freeze()
+        return self
+
+    def copy(self):
+        """Mutable copy of the permission tree, sharing structure with the
+        original if it is frozen.
+
+        """
+        t = PermissionTree(object_first=self.object_first)
+        t.tree = self.tree.copy()
+        return t
+
+    def overlay(self, other):
+        """Frozen permission tree equivalent to adding all the clauses of
+        another permission tree after those of this one, built by
+        merging the two trees (see ``WildTree.overlay``).  Both trees
+        must have the same key order.
+
+        """
+        if other.object_first != self.object_first:
+            raise ValueError('permission trees have different key orders')
+        t = PermissionTree(object_first=self.object_first)
+        t.tree = self.tree.overlay(other.tree)
+        return t
+
+    def minimise(self):
+        """Remove the rules that don't affect the result of ``allow`` for
+        any action and object: for example, an ``allow`` rule for
+        a pattern that is covered by a more general ``allow`` rule
+        with nothing overriding it in between, or ``deny`` rules that
+        override nothing.  (See ``WildTree.minimise``.)  Frozen trees
+        can also be minimised, but only before they are shared, since
+        other users may depend on the rules that are removed.  Returns
+        the ratio of the number of tree nodes after minimisation to
+        the number before.
+
+        """
+        return self.tree.minimise(lambda item: item == 'allow')
+
     def add(self, effect=None, act=None, obj=None,
             policy=None, policies=None):
         """Insert an individual (effect, action, object) triple or all
@@ -276,9 +393,25 @@ class PermissionTree:
         elif policy is not None:
             for e, a, o in policy:
                 self.add(e, a, o)
-        else:
+        elif not self.object_first:
             objc = obj.components if obj is not None else []
             self.tree[act.components + objc] = effect
+        else:
+            objc = list(obj.components) if obj is not None else []
+            self.tree[self._key(act, objc)] = effect
+            # Keys with the action first match keys that stop short of
+            # trailing object wildcards, and so, in particular, queries
+            # without an object match clauses whose object patterns are
+            # all wildcards.  Here that needs a rule for each shorter
+            # object pattern.
+            while objc and objc[-1] in ('*', '**'):
+                objc.pop()
+                self.tree[self._key(act, objc)] = effect
+
+    def _key(self, act, objc):
+        if self.object_first:
+            return list(objc) + [OBJECT_END] + list(act.components)
+        return act.components + objc
 
     def allow(self, act, obj=None):
         """Determine where a given action on a given object is allowed.
@@ -286,7 +419,7 @@ class PermissionTree:
         """
         objc = obj.components if obj is not None else []
         try:
-            return self.tree[act.components + objc] == 'allow'
+            return self.tree[self._key(act, objc)] == 'allow'
         except KeyError:
             return False
 
@@ -294,8 +427,127 @@ class PermissionTree:
         """Determine permitted actions for a given object pattern.
 
         """
-        return [a for a in Action.registered
-                if self.allow(a, obj(str(a)) if obj is not None else None)]
+        if not self.object_first:
+            return [a for a in Action.registered
+                    if self.allow(a, obj(str(a))
+                                  if obj is not None else None)]
+        return _permitted_actions([self], obj)
+
+
+class LayeredPermissionTree:
+    """A permission tree represented as a sequence of layers (frozen
+    permission trees, typically one per policy instance, shared with
+    other permission sets) that is never composed into a single tree.
+
+    Queries consult the layers from last to first and stop at the
+    first layer with a matching rule, which gives the same answers as
+    the composed tree, since later rules take precedence over earlier
+    ones.  The memory used by each permission set is then just the
+    list of layers.
+
+    """
+
+    def __init__(self, layers=()):
+        self.layers = tuple(layers)
+        self._tree = None
+        if any(layer.object_first != self.object_first
+               for layer in self.layers):
+            raise ValueError('permission tree layers have different '
+                             'key orders')
+
+    @property
+    def object_first(self):
+        return bool(self.layers) and self.layers[0].object_first
+
+    def __repr__(self):
+        return repr(self.tree)
+
+    @property
+    def frozen(self):
+        return True
+
+    def freeze(self):
+        return self
+
+    @property
+    def tree(self):
+        """The composed ``WildTree``, built when first needed (for
+        example, for serialisation).
+
+        """
+        if self._tree is None:
+            tree = WildTree().freeze()
+            for layer in self.layers:
+                tree = tree.overlay(layer.tree)
+            self._tree = tree
+        return self._tree
+
+    def copy(self):
+        """Mutable copy of the composed permission tree.
+
+        """
+        t = PermissionTree(object_first=self.object_first)
+        t.tree = self.tree.copy()
+        return t
+
+    def allow(self, act, obj=None):
+        """Determine where a given action on a given object is allowed.
+
+        """
+        objc = obj.components if obj is not None else []
+        for layer in reversed(self.layers):
+            try:
+                return layer.tree[layer._key(act, objc)] == 'allow'
+            except KeyError:
+                pass
+        return False
+
+    def permitted_actions(self, obj=None):
+        """Determine permitted actions for a given object pattern.
+
+        """
+        if not self.object_first:
+            return [a for a in Action.registered
+                    if self.allow(a, obj(str(a))
+                                  if obj is not None else None)]
+        return _permitted_actions(self.layers, obj)
+
+
+OBJECT_END = ''
+"""Separator between the object and action components of the keys of
+object-first permission trees."""
+
+
+def _permitted_actions(layers, obj):
+    """Permitted actions for an object pattern (given as for
+    ``permitted_actions``), from a sequence of object-first permission
+    tree layers, of which the last with a rule for an action decides.
+    The registered actions are grouped by the object they are checked
+    against, and each group shares the lookup of its object in each
+    layer (see ``WildTree.lookup_each``).
+
+    """
+    groups = {}
+    for a in Action.registered:
+        o = obj(str(a)) if obj is not None else None
+        objc = o.components if o is not None else []
+        groups.setdefault(tuple(objc), []).append(a)
+    allowed = set()
+    for objc, acts in groups.items():
+        for layer in reversed(layers):
+            prefix = objc + (OBJECT_END,)
+            found = layer.tree.lookup_each(prefix,
+                                           [a.components for a in acts])
+            undecided = []
+            for a, item in zip(acts, found):
+                if item is None:
+                    undecided.append(a)
+                elif item == 'allow':
+                    allowed.add(a)
+            acts = undecided
+            if not acts:
+                break
+    return [a for a in Action.registered if a in allowed]
 
 
 # ------------------------------------------------------------------------------
@@ -326,19 +578,139 @@ def escape(s, sep):
     return s.replace("\\", "\\\\").replace(sep, "\\" + sep)
 
 
+def overlapping_patterns(patterns):
+    """Find all the pairs of patterns in a list of actions or objects that
+    match each other (see ``SimpleSeparated.match``) without being
+    identical.  Returns a list of (pattern, pattern) pairs, with the
+    patterns in each pair in the order they appear in the list.
+
+    Rather than comparing every pair of patterns, the patterns are
+    inserted into a trie keyed by their components, and each pattern
+    is looked up in the trie following only the branches it can
+    match: the branch for the same component, the wildcard branch and
+    the branches for ID sets, or every branch for a wildcard or ID set
+    component.  For lists of mostly literal patterns, this takes close
+    to linear time.  Patterns containing ``**`` wildcards, which can
+    match patterns of any length, are compared with every other
+    pattern instead.
+
+    """
+    multi = {i for i, p in enumerate(patterns) if '**' in p.components}
+    conflicts = []
+    for i in multi:
+        p = patterns[i]
+        for j, q in enumerate(patterns):
+            if (j != i and (j not in multi or j > i) and
+                    p.components != q.components and p.match(q)):
+                conflicts.append((min(i, j), max(i, j)))
+
+    trie = {}
+    for i, p in enumerate(patterns):
+        if '**' in p.components:
+            continue
+        node = trie
+        for c in p.components:
+            # Components are strings, so None can mark the end of a
+            # pattern, and False can hold the ID set components of a
+            # node's branches.
+            if c not in node and id_set(c) is not None:
+                node.setdefault(False, []).append(c)
+            node = node.setdefault(c, {})
+        node.setdefault(None, []).append(i)
+
+    for i, p in enumerate(patterns):
+        if i in multi:
+            continue
+        n = len(p.components)
+        stack = [(trie, 0, True)]
+        while stack:
+            node, depth, exact = stack.pop()
+            if depth == n:
+                # Patterns reached by following exactly the components
+                # of the pattern itself are identical to it.
+                if not exact:
+                    conflicts.extend((i, j) for j in node.get(None, ())
+                                     if j > i)
+                continue
+            c = p.components[depth]
+            if c == '*' or id_set(c) is not None:
+                for k, child in node.items():
+                    if isinstance(k, str) and component_overlap(c, k):
+                        stack.append((child, depth + 1, exact and k == c))
+            else:
+                for k in [c, '*'] + [k for k in node.get(False, ())
+                                     if component_overlap(c, k)]:
+                    child = node.get(k)
+                    if child is not None:
+                        stack.append((child, depth + 1, exact and k == c))
+
+    conflicts.sort()
+    return [(patterns[i], patterns[j]) for i, j in conflicts]
+
+
+# String literals (which can't span lines in JSON, and may be
+# unterminated in malformed input) are matched and kept, so that
+# comment markers inside them are left alone; comments run to the end
+# of the line and are removed.
+_COMMENT_TOKENS = re.compile(r'("(?:[^"\\\n]|\\.)*"?)|(?:#|//)[^\n]*')
+
+
 def strip_comments(text):
-    """Comment stripper for JSON.
+    """Comment stripper for JSON: removes ``#`` and ``//`` comments
+    (running to the end of the line) outside string literals, in a
+    single pass over the text.  Line breaks and the text before each
+    comment are untouched, so line and column positions in the
+    stripped text are the same as in the original.
+
+    """
+    return _COMMENT_TOKENS.sub(r'\1', text)
+
+
+class CommentStripper:
+    """Incremental comment stripper for JSON text arriving in pieces (for
+    instance, a very large policy body read from a file in blocks).
+    Neither comments nor string literals can span lines, so each
+    complete line is stripped as soon as it has been received.
+
+    """
+    def __init__(self):
+        self.pending = []
+
+    def feed(self, text):
+        """Add a piece of text, returning the stripped text for all the
+        lines completed by it.
+
+        """
+        end = text.rfind('\n') + 1
+        if end == 0:
+            self.pending.append(text)
+            return ''
+        lines = ''.join(self.pending) + text[:end]
+        self.pending = [text[end:]]
+        return strip_comments(lines)
+
+    def close(self):
+        """Return the stripped text for any final incomplete line."""
+        rest = ''.join(self.pending)
+        self.pending = []
+        return strip_comments(rest)
+
+
+def _source_position(text, variables, pos):
+    """Line and column in ``text`` corresponding to position ``pos`` in
+    the result of substituting ``variables`` into ``text``.
 
     """
-    regex = r'\s*(#|\/{2}).*$'
-    regex_inline = r'(:?(?:\s)*([A-Za-z\d\.{}]*)|((?<=\").*\"),?)(?:\s)*(((#|(\/{2})).*)|)$'  # noqa
-    lines = text.split('\n')
-
-    for index, line in enumerate(lines):
-        if re.search(regex, line):
-            if re.search(r'^' + regex, line, re.IGNORECASE):
-                lines[index] = ""
-            elif re.search(regex_inline, line):
-                lines[index] = re.sub(regex_inline, r'\1', line)
-
-    return '\n'.join(lines)
+    shift = 0
+    for m in Template.pattern.finditer(text):
+        name = m.group('named') or m.group('braced')
+        value = '%s' % (variables[name],) if name else '$'
+        if m.start() + shift + len(value) > pos:
+            if m.start() + shift <= pos:
+                # Inside a substituted value: report its start.
+                shift = pos - m.start()
+            break
+        shift += len(value) - (m.end() - m.start())
+    pos -= shift
+    return (text.count('\n', 0, pos) + 1,
+            pos - text.rfind('\n', 0, pos))
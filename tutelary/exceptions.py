@@ -13,13 +13,18 @@ class EffectException(TutelaryException):
 
 class PatternOverlapException(TutelaryException):
     """Exception raised when overlapping action or object patterns are
-    used in a single policy clause.
+    used in a single policy clause.  The ``conflicts`` attribute lists
+    all the pairs of overlapping patterns.
 
     """
-    def __init__(self, exc_type):
-        super().__init__(
-            "overlapping " + exc_type + " patterns in policy clause"
-        )
+    def __init__(self, exc_type, conflicts=()):
+        self.conflicts = list(conflicts)
+        msg = "overlapping " + exc_type + " patterns in policy clause"
+        if self.conflicts:
+            msg += ": '{}' and '{}'".format(*self.conflicts[0])
+            if len(self.conflicts) > 1:
+                msg += " (and {} more)".format(len(self.conflicts) - 1)
+        super().__init__(msg)
 
 
 class PolicyBodyException(TutelaryException):
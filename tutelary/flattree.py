@@ -0,0 +1,485 @@
+# coding:utf-8
+"""
+Flat, array-backed alternative to ``tutelary.wildtree.WildTree``.
+
+The nodes of a ``WildTree`` are nested Python lists (or tuples) and
+subtree pairs, which costs several Python objects per node.  A
+``FlatWildTree`` instead stores its nodes in five parallel columns of
+machine integers (``array`` objects), indexed by node number:
+
+  * ``parent``: the parent node (-1 for the root);
+  * ``first``: the first child (-1 for leaf nodes);
+  * ``next``: the next sibling (-1 for the last child);
+  * ``key``: interned key string ID (-1 for the root);
+  * ``value``: value code (-1 for nodes with no value).
+
+Key strings and values are interned in tables shared by all the nodes
+of the tree, so each node costs only 20 bytes, and lookups are integer
+comparisons and array indexing.  (Each component of a lookup key is
+mapped to its key string ID, and to its numeric value if it is an ID,
+which is tested against the ID set keys of the nodes the lookup
+visits.)  Node 0 is the root.  Nodes removed from the tree are kept
+on a free list for reuse.
+
+The semantics of all operations, including the order of children,
+override and domination purging, are exactly those of ``WildTree``:
+the two produce the same JSON representation for the same sequence
+of operations.
+
+The saving is in memory rather than time: for trees shaped like large
+permission trees, ``experiments/flattree-memory.py`` measures a
+``FlatWildTree`` as 2.5 to 5.5 times smaller than the equivalent
+frozen ``WildTree`` (whose hash-consing already shares identical
+subtrees), with lookups 1.2 to 1.5 times slower.
+
+"""
+from array import array
+from collections import MutableMapping
+from json import loads, dumps
+
+from .wildtree import (
+    component_overlap, dominates, id_set, is_id
+)
+
+
+class FlatWildTree(MutableMapping):
+    """
+    Array-backed mapping between segmented paths and values, with
+    wildcards, with the same interface as ``WildTree``.
+
+    """
+    def __init__(self, json=None):
+        self.parent = array('i', [-1])
+        self.first = array('i', [-1])
+        self.next = array('i', [-1])
+        self.key = array('i', [-1])
+        self.value = array('i', [-1])
+        self.keys = []
+        self.key_ids = {}
+        self.values = []
+        self.value_ids = {}
+        self.id_sets = {}
+        self.free = []
+        self.frozen = False
+        self.wildcard = self._key_id('*')
+        self.multi_wildcard = self._key_id('**')
+        if json is not None:
+            self._load(0, loads(json))
+
+    @classmethod
+    def from_tree(cls, tree):
+        """
+        Build a flat tree with the same contents and structure as a
+        ``WildTree``.
+
+        """
+        flat = cls()
+
+        def load(n, node):
+            if node[0] is not None:
+                flat.value[n] = flat._value_code(node[0])
+            last = -1
+            for k, st in node[1]:
+                c = flat._new_node(n, k)
+                flat._link_after(n, last, c)
+                last = c
+                load(c, st)
+        load(0, tree.root)
+        return flat
+
+    def __repr__(self):
+        return dumps(self._to_json(0))
+
+    def __contains__(self, key):
+        """
+        Exact path membership: wildcards must be matched explicitly.
+        """
+        n = self._exact(key)
+        return n >= 0 and self.value[n] >= 0
+
+    def __len__(self):
+        return sum(1 for n in self._nodes(0) if self.value[n] >= 0)
+
+    def __iter__(self):
+        """
+        Iterate over keys in the tree in "domination order".
+        """
+        def _iter_help(n):
+            if self.value[n] >= 0:
+                yield ()
+            for c in self._children(n):
+                k = self.keys[self.key[c]]
+                for tail in _iter_help(c):
+                    yield (k,) + tail
+        yield from _iter_help(0)
+
+    def __getitem__(self, key):
+        """
+        Key lookup with wildcards.
+        """
+        n = self._match(0, self._heads(key), 0)
+        if n < 0:
+            raise KeyError(key)
+        return self.values[self.value[n]]
+
+    def __setitem__(self, key, value):
+        """
+        Insert a new key path, potentially overriding and hence purging
+        existing key paths.
+
+        """
+        self._check_mutable()
+        dels = [p for p in self if dominates(key, p)]
+        for p in dels:
+            self._delete(p)
+        n = 0
+        multi = False
+        for i, head in enumerate(key):
+            kid = self._key_id(head)
+            wild = self._is_wild(kid)
+            multi = multi or kid == self.multi_wildcard
+            found = -1
+            c = self.first[n]
+            while c >= 0:
+                k = self.key[c]
+                if k == kid:
+                    if not multi or i == len(key) - 1 or self.value[c] < 0:
+                        found = c
+                    break
+                elif multi or ((wild or self._is_wild(k)) and
+                               component_overlap(self.keys[k], head)):
+                    break
+                c = self.next[c]
+            if found < 0:
+                found = self._new_node(n, head)
+                self._link_after(n, -1, found)
+            n = found
+        self.value[n] = self._value_code(value)
+
+    def __delitem__(self, key):
+        """
+        Key deletion: wildcards must be matched explicitly.
+        """
+        self._check_mutable()
+        self._delete(key)
+
+    def find(self, key, perfect=False):
+        """
+        Find a key path in the tree, matching wildcards.  Return value for
+        key, along with index path through subtree lists to the result.
+        Throw ``KeyError`` if the key path doesn't exist in the tree.
+
+        """
+        if perfect:
+            ids = [(self.key_ids.get(k, -2), None) for k in key]
+        else:
+            ids = self._heads(key)
+        res = self._find(0, ids, 0, perfect)
+        if res is None:
+            raise KeyError(key)
+        n, trace = res
+        return self.values[self.value[n]], tuple(trace)
+
+    def freeze(self):
+        """
+        Make the tree immutable.  Returns the tree itself for convenience.
+        """
+        self.frozen = True
+        return self
+
+    def copy(self):
+        """
+        Return a mutable, compacted copy of the tree.
+        """
+        t = FlatWildTree()
+        t.keys = list(self.keys)
+        t.key_ids = dict(self.key_ids)
+        t.id_sets = dict(self.id_sets)
+        t.wildcard = self.wildcard
+        t.multi_wildcard = self.multi_wildcard
+
+        def load(src, dst):
+            if self.value[src] >= 0:
+                t.value[dst] = t._value_code(self.values[self.value[src]])
+            last = -1
+            for c in self._children(src):
+                d = t._new_node(dst, self.keys[self.key[c]])
+                t._link_after(dst, last, d)
+                last = d
+                load(c, d)
+        load(0, 0)
+        return t
+
+    def node_count(self):
+        """
+        Number of nodes in use, including the root.
+        """
+        return len(self.key) - len(self.free)
+
+    def _check_mutable(self):
+        if self.frozen:
+            raise TypeError('frozen FlatWildTree does not support '
+                            'modification')
+
+    def _key_id(self, k):
+        kid = self.key_ids.get(k)
+        if kid is None:
+            kid = self.key_ids[k] = len(self.keys)
+            self.keys.append(k)
+            ids = id_set(k)
+            if ids is not None:
+                self.id_sets[kid] = ids
+        return kid
+
+    def _is_wild(self, kid):
+        return (kid == self.wildcard or kid == self.multi_wildcard or
+                kid in self.id_sets)
+
+    def _heads(self, key):
+        """
+        The (key string ID, numeric ID) pairs for the components of a
+        lookup key: the numeric ID is ``None`` unless the component can
+        be matched by ID set keys.
+
+        """
+        return [(self.key_ids.get(k, -2), int(k) if is_id(k) else None)
+                for k in key]
+
+    def _matches(self, kid, head):
+        """
+        Does the key with ID ``kid`` match a lookup key component given
+        as a pair from ``_heads`` (apart from the wildcard)?
+
+        """
+        if kid == head[0]:
+            return True
+        ids = self.id_sets.get(kid) if head[1] is not None else None
+        return ids is not None and head[1] in ids
+
+    def _value_code(self, v):
+        if v is None:
+            return -1
+        try:
+            # The type is part of the key so that, for example, 1 and
+            # True aren't conflated.
+            vkey = (type(v), v)
+            code = self.value_ids.get(vkey)
+        except TypeError:
+            vkey = code = None
+        if code is None:
+            code = len(self.values)
+            self.values.append(v)
+            if vkey is not None:
+                self.value_ids[vkey] = code
+        return code
+
+    def _new_node(self, parent, k):
+        kid = self._key_id(k)
+        if self.free:
+            n = self.free.pop()
+            self.parent[n] = parent
+            self.first[n] = -1
+            self.next[n] = -1
+            self.key[n] = kid
+            self.value[n] = -1
+        else:
+            n = len(self.key)
+            self.parent.append(parent)
+            self.first.append(-1)
+            self.next.append(-1)
+            self.key.append(kid)
+            self.value.append(-1)
+        return n
+
+    def _link_after(self, parent, prev, n):
+        """
+        Link node ``n`` into the children of ``parent`` after ``prev`` (or
+        as the first child if ``prev`` is -1).
+
+        """
+        if prev < 0:
+            self.next[n] = self.first[parent]
+            self.first[parent] = n
+        else:
+            self.next[n] = self.next[prev]
+            self.next[prev] = n
+
+    def _unlink(self, n):
+        """
+        Remove node ``n`` and all its descendants from the tree.
+        """
+        p = self.parent[n]
+        if self.first[p] == n:
+            self.first[p] = self.next[n]
+        else:
+            c = self.first[p]
+            while self.next[c] != n:
+                c = self.next[c]
+            self.next[c] = self.next[n]
+        self._free_children(n)
+        self._free_node(n)
+
+    def _free_children(self, n):
+        c = self.first[n]
+        while c >= 0:
+            nxt = self.next[c]
+            self._free_children(c)
+            self._free_node(c)
+            c = nxt
+        self.first[n] = -1
+
+    def _free_node(self, n):
+        self.parent[n] = -1
+        self.first[n] = -1
+        self.next[n] = -1
+        self.value[n] = -1
+        self.free.append(n)
+
+    def _children(self, n):
+        c = self.first[n]
+        while c >= 0:
+            yield c
+            c = self.next[c]
+
+    def _nodes(self, n):
+        yield n
+        for c in self._children(n):
+            yield from self._nodes(c)
+
+    def _exact(self, key):
+        n = 0
+        for head in key:
+            kid = self.key_ids.get(head)
+            if kid is None:
+                return -1
+            c = self.first[n]
+            while c >= 0 and self.key[c] != kid:
+                c = self.next[c]
+            if c < 0:
+                return -1
+            n = c
+        return n
+
+    def _find(self, n, ids, i, perfect):
+        """
+        Helper to perform find, mirroring ``wildtree.find_in_tree``.
+        Returns the matching node and the trace of child indexes to it,
+        or ``None`` if there is no match.
+
+        """
+        if i == len(ids):
+            if self.value[n] >= 0:
+                return n, []
+            if not perfect:
+                for idx, c in enumerate(self._children(n)):
+                    if self.key[c] in (self.wildcard, self.multi_wildcard):
+                        res = self._find(c, ids, i, perfect)
+                        if res is not None:
+                            return res[0], [idx] + res[1]
+            return None
+        head = ids[i]
+        for idx, c in enumerate(self._children(n)):
+            k = self.key[c]
+            if k == self.multi_wildcard and not perfect:
+                res = self._find_multi(c, ids, tuple(range(i, len(ids) + 1)),
+                                       set())
+            elif self._matches(k, head) or not perfect and k == self.wildcard:
+                res = self._find(c, ids, i + 1, perfect)
+            else:
+                continue
+            if res is not None:
+                return res[0], [idx] + res[1]
+        return None
+
+    def _find_multi(self, n, ids, positions, failed):
+        """
+        Helper to perform find below a ``**`` wildcard, mirroring
+        ``wildtree._find_multi``.
+
+        """
+        if (n, positions) in failed:
+            return None
+        end = len(ids)
+        if self.value[n] >= 0 and positions[-1] == end:
+            return n, []
+        for idx, c in enumerate(self._children(n)):
+            k = self.key[c]
+            if k == self.multi_wildcard:
+                nxt = tuple(range(positions[0], end + 1))
+            elif k == self.wildcard:
+                nxt = tuple(sorted({min(p + 1, end) for p in positions}))
+            else:
+                nxt = tuple(p + 1 for p in positions
+                            if p < end and self._matches(k, ids[p]))
+            if nxt:
+                res = self._find_multi(c, ids, nxt, failed)
+                if res is not None:
+                    return res[0], [idx] + res[1]
+        failed.add((n, positions))
+        return None
+
+    def _match(self, n, ids, i):
+        """
+        Faster version of ``_find`` for lookups: returns only the matching
+        node, or -1 if there is no match.
+
+        """
+        first, nxt, keyc, wild = self.first, self.next, self.key, self.wildcard
+        multi = self.multi_wildcard
+        if i == len(ids):
+            if self.value[n] >= 0:
+                return n
+            c = first[n]
+            while c >= 0:
+                if keyc[c] == wild or keyc[c] == multi:
+                    m = self._match(c, ids, i)
+                    if m >= 0:
+                        return m
+                c = nxt[c]
+            return -1
+        head = ids[i]
+        c = first[n]
+        while c >= 0:
+            k = keyc[c]
+            if k == multi:
+                res = self._find_multi(c, ids, tuple(range(i, len(ids) + 1)),
+                                       set())
+                if res is not None:
+                    return res[0]
+            elif k == wild or self._matches(k, head):
+                m = self._match(c, ids, i + 1)
+                if m >= 0:
+                    return m
+            c = nxt[c]
+        return -1
+
+    def _delete(self, key):
+        """
+        Delete a key path, mirroring ``wildtree.del_by_idx``.
+        """
+        res = self._find(0, [(self.key_ids.get(k, -2), None) for k in key],
+                         0, True)
+        if res is None:
+            raise KeyError(key)
+        n = res[0]
+        self.value[n] = -1
+        while n != 0 and self.first[n] < 0 and self.value[n] < 0:
+            p = self.parent[n]
+            self._unlink(n)
+            n = p
+
+    def _load(self, n, d):
+        if d['item'] is not None:
+            self.value[n] = self._value_code(d['item'])
+        last = -1
+        for k, st in d['subtrees']:
+            c = self._new_node(n, k)
+            self._link_after(n, last, c)
+            last = c
+            self._load(c, st)
+
+    def _to_json(self, n):
+        v = self.value[n]
+        return {'item': self.values[v] if v >= 0 else None,
+                'subtrees': [(self.keys[self.key[c]], self._to_json(c))
+                             for c in self._children(n)]}
@@ -0,0 +1,28 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from tutelary.models import PermissionSet
+
+
+class Command(BaseCommand):
+    help = ('Build the permission trees for all permission sets and save '
+            'them as a tree cache snapshot.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'path', nargs='?', default=None,
+            help='Snapshot file (default: the TUTELARY_TREE_SNAPSHOT '
+            'setting).'
+        )
+        parser.add_argument(
+            '--workers', type=int, default=None,
+            help='Number of worker processes to use for building trees.'
+        )
+
+    def handle(self, *args, **options):
+        path = options['path'] or getattr(settings, 'TUTELARY_TREE_SNAPSHOT',
+                                          None)
+        if not path:
+            raise CommandError('no snapshot path given')
+        PermissionSet.objects.warm(workers=options['workers'])
+        n = PermissionSet.objects.save_snapshot(path)
+        self.stdout.write('saved {} permission trees to {}'.format(n, path))
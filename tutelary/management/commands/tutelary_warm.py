@@ -0,0 +1,25 @@
+import time
+from django.core.management.base import BaseCommand
+from tutelary.models import PermissionSet
+
+
+class Command(BaseCommand):
+    help = 'Build and cache the permission trees for all permission sets.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers', type=int, default=None,
+            help='Number of worker processes to use for building trees.'
+        )
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        timings = PermissionSet.objects.warm(workers=options['workers'])
+        total = time.perf_counter() - start
+        for psetid, secs in timings:
+            self.stdout.write(
+                'permission set {}: {:.1f} ms'.format(psetid, secs * 1000)
+            )
+        self.stdout.write('built {} permission trees in {:.1f} ms'.format(
+            len(timings), total * 1000
+        ))
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9 on 2026-10-18 21:29
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tutelary', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='permissionset',
+            name='compiled_tree',
+            field=models.BinaryField(null=True),
+        ),
+        migrations.AddField(
+            model_name='permissionset',
+            name='tree_fingerprint',
+            field=models.CharField(blank=True, max_length=32),
+        ),
+    ]
@@ -1,14 +1,23 @@
 import json
 import itertools
 import re
-from django.db import models
+import time
+import weakref
+from django.db import models, connection
 from django.conf import settings
-from django.db.models.signals import pre_delete
+from django.db.models.signals import post_delete, post_save, pre_delete
 from django.dispatch import receiver
 from django.core.exceptions import ObjectDoesNotExist
 from audit_log.models.managers import AuditLog
-import tutelary.engine as engine
+from tutelary.cache import TreeCache
+from tutelary.codec import dump_tree, load_permission_tree
+from tutelary.compiler import (
+    compile_tree, compile_trees, compile_layered_tree, fingerprint,
+    recompile_tree
+)
 from tutelary.exceptions import RoleVariableException
+from tutelary.snapshot import read_snapshot, write_snapshot
+from tutelary.store import SharedStore, write_store
 
 
 class Policy(models.Model):
@@ -24,9 +33,16 @@ class Policy(models.Model):
     """Policy JSON body."""
 
     def __setattr__(self, attrname, val):
+        # Only changes to the body of an existing policy object affect
+        # permission trees: the initial assignment made when a policy
+        # is loaded from the database must not invalidate anything.
+        # The body as it was before the first change is remembered, so
+        # that cached trees can be updated incrementally when the
+        # policy is saved (see ``policy_save``).
+        old = self.__dict__.get('body') if attrname == 'body' else None
         super().__setattr__(attrname, val)
-        if attrname == 'body':
-            self.refresh()
+        if old is not None and old != val:
+            self.__dict__.setdefault('_saved_body', old)
 
     audit_log = AuditLog()
 
@@ -172,12 +188,113 @@ def _policy_psets(policies):
         return [] if psetids is None else list(psetids)
 
 
+def _layered_trees():
+    return getattr(settings, 'TUTELARY_LAYERED_TREES', False)
+
+
+def _object_first():
+    return getattr(settings, 'TUTELARY_OBJECT_FIRST', False)
+
+
+def _persist_trees():
+    # Layered trees are cheap to build from the shared policy trees,
+    # so there is nothing to gain from storing them.
+    return (getattr(settings, 'TUTELARY_PERSIST_TREES', False) and
+            not _layered_trees())
+
+
+def _store_tree(psetid, fp, tree):
+    """Save a compiled permission tree and its input fingerprint to the
+    database.
+
+    """
+    PermissionSet.objects.filter(pk=psetid).update(
+        tree_fingerprint=fp, compiled_tree=dump_tree(tree)
+    )
+
+
+# Fingerprints of the policy instances that the trees in the tree
+# cache were built from.  Tree caches are only invalidated within their
+# own process, so this is what shows whether a cached tree still
+# matches the database (see ``PermissionSetManager.publish``).
+_tree_fingerprints = weakref.WeakKeyDictionary()
+
+
+def _fingerprinted(tree, fp):
+    """Record the fingerprint of the policy instances a tree was built
+    from.  Returns the tree for convenience.
+
+    """
+    _tree_fingerprints[tree] = fp
+    return tree
+
+
+_shared_stores = {}
+
+
+def _store_path():
+    return getattr(settings, 'TUTELARY_TREE_STORE', None)
+
+
+def shared_store():
+    """The ``tutelary.store.MappedStore`` for the file named by the
+    ``TUTELARY_TREE_STORE`` setting, or ``None`` if there is no such
+    setting or the file hasn't been published yet.
+
+    """
+    path = _store_path()
+    if not path:
+        return None
+    store = _shared_stores.get(path)
+    if store is None:
+        store = _shared_stores.setdefault(path, SharedStore(path))
+    return store.current()
+
+
+def _instances(pis):
+    """Convert a sequence of policy instances to the (policy body,
+    variable assignments) form used for compiling permission trees.
+
+    """
+    return [(pi.policy.body, json.loads(pi.variables)) for pi in pis]
+
+
+def _all_instances():
+    """Load the policy instances of all permission sets in bulk, as a
+    dictionary mapping permission set IDs to lists of (policy body,
+    variable assignments) pairs.
+
+    """
+    return {psetid: _instances(pis) for psetid, pis in
+            _grouped_instances(PolicyInstance.objects.all())}
+
+
+def _grouped_instances(pis):
+    """Group a query set of policy instances by permission set, as
+    (permission set ID, list of policy instances) pairs.
+
+    """
+    pis = pis.select_related('policy').order_by('pset_id', 'index')
+    return [(psetid, list(g)) for psetid, g in
+            itertools.groupby(pis, key=lambda pi: pi.pset_id)]
+
+
+def _snapshot_path():
+    return getattr(settings, 'TUTELARY_TREE_SNAPSHOT', None)
+
+
 class PermissionSetManager(models.Manager):
     """Permission sets have a custom manager that folds all instances with
     the same set of policy instances together in the database.
 
     """
 
+    def get_queryset(self):
+        # The compiled tree is only needed when a tree is rebuilt, and
+        # is then loaded explicitly, so it isn't fetched for every
+        # permission set lookup (including ``user.permissionset``).
+        return super().get_queryset().defer('compiled_tree')
+
     def by_policies_and_roles(self, policies_roles):
         # Canonicalise input policy list to include empty variable
         # assignments where necessary, serialise variable assignments
@@ -239,6 +356,132 @@ class PermissionSetManager(models.Manager):
         # return the newly constructed object.
         return obj
 
+    def warm(self, workers=None):
+        """Build the permission trees for all permission sets and install
+        them in the tree cache, so that later requests don't pay the
+        cost of building them.  All the policy instance and policy
+        data needed is loaded using a couple of bulk queries.  Trees
+        are compiled in ``workers`` worker processes (by default, the
+        value of the ``TUTELARY_COMPILE_WORKERS`` setting, or 1).  If
+        the ``TUTELARY_TREE_STORE`` setting is given, the trees are also
+        published to a shared store file at that path (see
+        ``tutelary.store``).  Returns a list of (permission set ID,
+        build time in seconds) pairs.
+
+        """
+        if workers is None:
+            workers = getattr(settings, 'TUTELARY_COMPILE_WORKERS', 1)
+        bypset = _all_instances()
+        persist = _persist_trees()
+        if persist:
+            rows = self.order_by('pk').values_list(
+                'pk', 'tree_fingerprint', 'compiled_tree'
+            )
+        else:
+            rows = [(psetid, None, None) for psetid in
+                    self.order_by('pk').values_list('pk', flat=True)]
+
+        # Trees stored in the database are used as they are if their
+        # fingerprints match.  Everything else is compiled.
+        timings = {}
+        trees = {}
+        tocompile = []
+        for psetid, stored_fp, stored in rows:
+            instances = bypset.get(psetid, [])
+            fp = fingerprint(instances, _object_first())
+            if persist and stored_fp == fp and stored is not None:
+                start = time.perf_counter()
+                tree = _fingerprinted(load_permission_tree(bytes(stored)), fp)
+                PermissionSet.ptree_cache.swap(psetid, tree)
+                trees[psetid] = tree
+                timings[psetid] = time.perf_counter() - start
+            else:
+                tocompile.append((psetid, fp, instances))
+        secs = []
+        compiled = compile_trees([c[2] for c in tocompile],
+                                 workers=workers, timings=secs,
+                                 layered=_layered_trees(),
+                                 object_first=_object_first())
+        for (psetid, fp, _), tree, elapsed in zip(tocompile, compiled, secs):
+            if persist:
+                _store_tree(psetid, fp, tree)
+            PermissionSet.ptree_cache.swap(psetid, _fingerprinted(tree, fp))
+            trees[psetid] = tree
+            timings[psetid] = elapsed
+        path = _store_path()
+        if path:
+            write_store(path, trees.items())
+        return sorted(timings.items())
+
+    def publish(self):
+        """Publish the trees of all permission sets to the shared store
+        file named by the ``TUTELARY_TREE_STORE`` setting (if any),
+        using the trees in the tree cache that were built from the
+        current policy instances of their permission sets.  Other
+        trees (missing ones, or ones that are out of date because the
+        policies were changed in another process) are built again.
+
+        """
+        path = _store_path()
+        if not path:
+            return
+        cache = PermissionSet.ptree_cache
+        cached = cache.snapshot()
+        bypset = _all_instances()
+        object_first = _object_first()
+        trees = []
+        for psetid in self.order_by('pk').values_list('pk', flat=True):
+            fp = fingerprint(bypset.get(psetid, []), object_first)
+            entry = cached.get(psetid)
+            if entry is not None and _tree_fingerprints.get(entry[1]) == fp:
+                tree = entry[1]
+            else:
+                if entry is not None:
+                    cache.invalidate(psetid)
+                tree = cache.get(psetid, self.model(pk=psetid)._build_tree)
+            trees.append((psetid, tree))
+        write_store(path, trees)
+
+    def save_snapshot(self, path=None):
+        """Write a snapshot of the tree cache to ``path`` (by default, the
+        value of the ``TUTELARY_TREE_SNAPSHOT`` setting), recording the
+        fingerprint of the current policy instances of each permission
+        set along with its tree.  Returns the number of trees saved.
+
+        """
+        cache = PermissionSet.ptree_cache
+        entries = cache.snapshot()
+        bypset = _all_instances()
+        psetids = set(self.values_list('pk', flat=True))
+        # Trees invalidated while the fingerprints were being computed
+        # may not match them, so they are left out.
+        saved = [(psetid, generation,
+                  fingerprint(bypset.get(psetid, []), tree.object_first),
+                  tree)
+                 for psetid, (generation, tree) in sorted(entries.items())
+                 if psetid in psetids and
+                 cache.generation(psetid) == generation]
+        write_snapshot(path or _snapshot_path(), saved)
+        return len(saved)
+
+    def restore_snapshot(self, path=None):
+        """Install the trees from a snapshot written by ``save_snapshot``
+        in the tree cache.  Trees are only restored for permission sets
+        that still exist and whose policy instances still have the
+        fingerprint recorded in the snapshot.  Returns the number of
+        trees restored.
+
+        """
+        entries = read_snapshot(path or _snapshot_path())
+        bypset = _all_instances()
+        psetids = set(self.filter(pk__in=list(entries))
+                      .values_list('pk', flat=True))
+        trees = {psetid: _fingerprinted(load_permission_tree(data), fp)
+                 for psetid, (_, fp, data) in entries.items()
+                 if psetid in psetids and
+                 fingerprint(bypset.get(psetid, []), _object_first()) == fp}
+        return PermissionSet.ptree_cache.restore(trees)
+
 
 class PermissionSet(models.Model):
     """A permission set represents the complete set of permissions
@@ -246,7 +489,16 @@ class PermissionSet(models.Model):
     The sequence of policy instances is recorded using the
     ``PolicyInstance`` model and the permission tree is constructed
     lazily from this information when the permission set is read from
-    the database.
+    the database.  If the ``TUTELARY_PERSIST_TREES`` setting is true,
+    the compiled tree is also stored in the database, along with a
+    fingerprint of the policy instances it was compiled from, and is
+    loaded from there (rather than being compiled again) as long as
+    the fingerprint still matches.  If the ``TUTELARY_LAYERED_TREES``
+    setting is true, permission sets use ``LayeredPermissionTree``
+    objects, which share the trees of individual policy instances,
+    instead of composed trees.  If the ``TUTELARY_OBJECT_FIRST``
+    setting is true, trees are built with object-first keys (see
+    ``tutelary.engine.PermissionTree``).
 
     """
     # Ordered set of policies used to generate this permission set.
@@ -259,30 +511,132 @@ class PermissionSet(models.Model):
                                    related_name='permissionset')
     anonymous_user = models.BooleanField(default=False)
 
+    # Serialised compiled permission tree (in the binary format of
+    # tutelary.codec) and fingerprint of the policy instances it was
+    # compiled from.
+    compiled_tree = models.BinaryField(null=True)
+    tree_fingerprint = models.CharField(max_length=32, blank=True)
+
     # Custom manager to deal with folding together permission sets
     # generated from identical sequences of policies.
     objects = PermissionSetManager()
 
+    # Process-wide cache of permission trees, keyed by permission set
+    # ID.
+    ptree_cache = TreeCache(
+        rebuild_threads=getattr(settings, 'TUTELARY_TREE_REBUILD_THREADS', 2),
+        stale=lambda: getattr(settings, 'TUTELARY_TREE_STALE_SECONDS', 0)
+    )
+
     def tree(self):
-        if not hasattr(PermissionSet, 'ptree_cache'):
-            PermissionSet.ptree_cache = {}
-        if self.pk not in PermissionSet.ptree_cache:
-            PermissionSet.ptree_cache[self.pk] = engine.PermissionTree(
-                policies=[engine.PolicyBody(json=pi.policy.body,
-                                            variables=json.loads(pi.variables))
-                          for pi in PolicyInstance.objects.filter(pset=self)]
+        """Return the (immutable) permission tree for this permission set,
+        building it if necessary.
+
+        By default, a permission set whose tree has been invalidated by
+        a policy or role change is rebuilt synchronously the next time
+        it is needed.  If the ``TUTELARY_TREE_STALE_SECONDS`` setting is
+        non-zero, the previous tree continues to be served for up to
+        that many seconds after the invalidation, while the new tree is
+        built in a background thread.
+
+        """
+        return PermissionSet.ptree_cache.get(
+            self.pk, self._build_tree, rebuild=self._rebuild_tree
+        )
+
+    def _build_tree(self):
+        pis = PolicyInstance.objects.filter(pset=self).select_related('policy')
+        instances = _instances(pis)
+        object_first = _object_first()
+        fp = fingerprint(instances, object_first)
+        if _layered_trees():
+            return _fingerprinted(
+                compile_layered_tree(instances, object_first), fp
             )
-        return PermissionSet.ptree_cache[self.pk]
+        if not _persist_trees():
+            return _fingerprinted(compile_tree(instances, object_first), fp)
+        stored = (PermissionSet.objects.filter(pk=self.pk)
+                  .values_list('tree_fingerprint', 'compiled_tree').first())
+        if stored is not None and stored[0] == fp and stored[1] is not None:
+            return _fingerprinted(load_permission_tree(bytes(stored[1])), fp)
+        tree = compile_tree(instances, object_first)
+        _store_tree(self.pk, fp, tree)
+        return _fingerprinted(tree, fp)
+
+    def _rebuild_tree(self):
+        # Background rebuilds run in their own threads, and so on their
+        # own database connections, which need to be closed when done.
+        try:
+            return self._build_tree()
+        finally:
+            connection.close()
 
     def refresh(self):
-        if hasattr(PermissionSet, 'ptree_cache'):
-            if self.pk in PermissionSet.ptree_cache:
-                del PermissionSet.ptree_cache[self.pk]
+        PermissionSet.ptree_cache.invalidate(self.pk)
 
     def __str__(self):
         return str(self.pk)
 
 
+@receiver(post_save, sender=Policy)
+def policy_save(sender, instance, created, **kwargs):
+    """Bring the cached trees of the permission sets using a policy up
+    to date when the policy's body changes, and publish a new shared
+    tree store with the updated trees.
+
+    """
+    old_body = instance.__dict__.pop('_saved_body', None)
+    if old_body is not None and old_body != instance.body:
+        _update_trees(instance, old_body)
+        PermissionSet.objects.publish()
+
+
+def _update_trees(policy, old_body):
+    """Incrementally update the cached trees of the permission sets
+    using a policy whose body has changed from ``old_body`` (see
+    ``tutelary.compiler.recompile_tree``).  Permission sets without
+    cached trees are just invalidated.
+
+    """
+    cache = PermissionSet.ptree_cache
+    psetids = _policy_psets([(policy, {})])
+    pis = PolicyInstance.objects.filter(pset_id__in=psetids)
+    for psetid, group in _grouped_instances(pis):
+        new = _instances(group)
+        old = [(old_body if pi.policy_id == policy.pk else body, variables)
+               for pi, (body, variables) in zip(group, new)]
+        tree = cache.replace(
+            psetid, lambda tree: _recompiled(tree, old, new)
+        )
+        if tree is None or not _persist_trees():
+            continue
+        fp = fingerprint(new, tree.object_first)
+        if _tree_fingerprints.get(tree) == fp:
+            _store_tree(psetid, fp, tree)
+
+
+def _recompiled(tree, old, new):
+    """Recompile a cached tree with ``recompile_tree``.  The result is
+    only known to match ``new`` if the cached tree matched ``old``
+    (rather than being out of date because of changes made in another
+    process).
+
+    """
+    result = recompile_tree(tree, old, new)
+    if _tree_fingerprints.get(tree) == fingerprint(old, tree.object_first):
+        _fingerprinted(result, fingerprint(new, tree.object_first))
+    return result
+
+
+@receiver(post_delete)
+def pset_delete(sender, instance, **kwargs):
+    """Forget the cached tree of a deleted permission set."""
+    # Permission sets are loaded with a deferred field, so the sender
+    # may be a subclass of ``PermissionSet``.
+    if isinstance(instance, PermissionSet):
+        PermissionSet.ptree_cache.forget(instance.pk)
+
+
 @receiver(pre_delete, sender=settings.AUTH_USER_MODEL)
 def user_delete(sender, instance, **kwargs):
     """Manage policies on user deletion."""
@@ -0,0 +1,69 @@
+# coding:utf-8
+"""
+Support for building permission trees in the master process of a
+pre-forking server (e.g. gunicorn with ``preload_app = True``), so that
+all worker processes share a single copy of the trees.
+
+The nodes of frozen permission trees are tuples (an item and a tuple
+of (key, subtree) pairs), holding only strings and other such tuples,
+which the Python garbage collector can stop tracking altogether once
+it has established that they cannot take part in reference cycles.
+(The nodes of mutable trees are lists, which stay tracked, so only
+frozen trees are shared in this way.)  Once that has happened and the remaining objects
+built in the master have been moved to the permanent generation with
+``gc.freeze()`` (Python 3.7 and later), garbage collections in the
+workers never write to the memory pages holding the trees, and those
+pages stay shared copy-on-write between all the workers.  (Reference
+count updates made while looking up permissions still touch the
+nodes visited, so pages holding heavily used nodes may be copied
+eventually, but the bulk of the tree memory stays shared.)
+
+Typical gunicorn configuration::
+
+  preload_app = True
+
+  def when_ready(server):
+      from tutelary.prefork import prepare_for_fork
+      prepare_for_fork()
+
+"""
+import gc
+from django.db import connections
+
+
+# Upper bound on the number of garbage collection passes made while
+# waiting for tree nodes to be untracked: each pass untracks one more
+# level of nested containers.
+MAX_UNTRACK_PASSES = 100
+
+
+def prepare_for_fork():
+    """Build the permission trees for all permission sets into the tree
+    cache, untrack them from the garbage collector, freeze the
+    garbage collector's view of all existing objects and close
+    database connections (which must not be shared with forked
+    worker processes).  Returns the per-permission set timings from
+    ``PermissionSet.objects.warm``.
+
+    """
+    from .models import PermissionSet
+    timings = PermissionSet.objects.warm()
+    untrack_garbage()
+    if hasattr(gc, 'freeze'):
+        gc.freeze()
+    connections.close_all()
+    return timings
+
+
+def untrack_garbage():
+    """Run garbage collections until the number of objects tracked by the
+    garbage collector stops decreasing.
+
+    """
+    ntracked = len(gc.get_objects())
+    for _ in range(MAX_UNTRACK_PASSES):
+        gc.collect()
+        n = len(gc.get_objects())
+        if n >= ntracked:
+            break
+        ntracked = n
@@ -0,0 +1,80 @@
+# coding:utf-8
+"""
+Snapshots of the permission tree cache.
+
+A snapshot file records the permission trees in a process's tree cache
+so that a new process can start with a populated cache instead of
+rebuilding every tree on first use.  Each tree is stored in the binary
+format of ``tutelary.codec``, along with its permission set ID, its
+cache generation number at the time of the snapshot and the
+fingerprint of the policy instances it was compiled from (see
+``tutelary.compiler.fingerprint``).
+
+Generation numbers are private to the process that took the snapshot,
+so they can't tell a restoring process whether a tree is still
+current: the fingerprints are used for that, by comparing them with
+fingerprints computed from the current contents of the database.
+
+The file consists of a header (the magic bytes ``TUTC``, a 16-bit
+format version, 16 reserved bits and a 32-bit entry count) followed by
+the entries, each of which is a fixed-size record (permission set ID,
+generation, fingerprint, data length) followed by the serialised tree.
+
+"""
+import struct
+
+from .codec import dump_tree
+from .store import write_atomically
+
+
+MAGIC = b'TUTC'
+VERSION = 1
+
+_HEADER = struct.Struct('<4sHHI')
+_ENTRY = struct.Struct('<QQ32sI')
+
+
+def write_snapshot(path, entries):
+    """Atomically write a snapshot file at ``path`` containing entries
+    given as (permission set ID, generation, fingerprint, tree)
+    tuples.
+
+    """
+    chunks = []
+    for psetid, generation, fp, tree in entries:
+        data = dump_tree(tree)
+        chunks.append(_ENTRY.pack(psetid, generation, fp.encode('ascii'),
+                                  len(data)))
+        chunks.append(data)
+    write_atomically(path, [_HEADER.pack(MAGIC, VERSION, 0,
+                                         len(chunks) // 2)] + chunks)
+
+
+def read_snapshot(path):
+    """Read a snapshot file, returning a dictionary mapping permission set
+    IDs to (generation, fingerprint, serialised tree) tuples.  The
+    trees can be loaded with ``tutelary.codec.load_permission_tree``.
+
+    """
+    with open(path, 'rb') as fp:
+        data = memoryview(fp.read())
+    if len(data) < _HEADER.size:
+        raise ValueError('truncated tree snapshot')
+    magic, version, _, count = _HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError('not a tree snapshot')
+    if version != VERSION:
+        raise ValueError('unsupported tree snapshot version ' + str(version))
+    pos = _HEADER.size
+    entries = {}
+    for _ in range(count):
+        if pos + _ENTRY.size > len(data):
+            raise ValueError('truncated tree snapshot')
+        psetid, generation, fp, size = _ENTRY.unpack_from(data, pos)
+        pos += _ENTRY.size
+        if pos + size > len(data):
+            raise ValueError('truncated tree snapshot')
+        entries[psetid] = (generation, fp.rstrip(b'\0').decode('ascii'),
+                           bytes(data[pos:pos + size]))
+        pos += size
+    return entries
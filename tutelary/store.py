@@ -0,0 +1,458 @@
+# coding:utf-8
+"""
+Shared read-only store of compiled permission trees.
+
+All the permission trees for an installation are exported into a
+single file with an offset-based layout that can be used in place:
+each process maps the file into memory and evaluates permission
+queries directly against the mapped bytes, so there is no per-process
+deserialisation, and the operating system's page cache holds a single
+copy of the trees however many processes use them.
+
+The file is an array of 32-bit little-endian words::
+
+  header:  magic, version, number of permission sets, index offset,
+           number of strings, string table offset, string data
+           offset (in bytes), file length (in words)
+  index:   (ID low word, ID high word, root node offset, flags) for
+           each permission set, sorted by ID
+  strings: (byte offset, byte length) for each string, sorted by the
+           UTF-8 encoding of the strings
+  nodes:   item code, number of children,
+           (key string index, child node offset) for each child
+  string data: UTF-8 bytes, padded to a whole number of words
+
+All offsets other than the string data offsets are word offsets.  The
+lowest flag bit is set for permission trees with object-first keys
+(see ``tutelary.engine.PermissionTree``).  (Version 1 files, which
+have no flags word, can still be read.)  Item
+codes are one more than the index of the JSON representation of the
+item in the string table, or zero for nodes with no item.  Because the
+string table is sorted, the components of a query key can be mapped to
+string indexes by binary search, after which matching against the tree
+only involves integer comparisons.  (ID set keys, like ``[1000-1999]``,
+all sort together, since they start with the same character, and each
+query key component is mapped to the indexes of the ID sets containing
+it as well as its own index.)
+
+New versions of the file are written to a temporary file and renamed
+into place, so that readers always see a complete file.  Readers check
+for a new version of the file at most every ``check_interval``
+seconds.
+
+"""
+import json
+import mmap
+import os
+import sys
+import tempfile
+import threading
+import time
+from array import array
+
+from .engine import OBJECT_END, Action
+from .wildtree import WildTree, id_set, is_id
+
+
+MAGIC = 0x53545554      # b'TUTS' read as a little-endian word
+VERSION = 2
+_HEADER_WORDS = 8
+_INDEX_WORDS = {1: 3, 2: 4}
+_OBJECT_FIRST = 1
+_WORD = 'I' if array('I').itemsize == 4 else 'L'
+
+
+def write_store(path, trees):
+    """Atomically publish a store file at ``path`` containing the
+    permission trees given as (permission set ID, tree) pairs, where
+    the trees may be ``PermissionTree`` or ``WildTree`` objects.
+
+    """
+    trees = sorted(trees, key=lambda t: t[0])
+    strings = set()
+
+    def collect(node):
+        if node[0] is not None:
+            strings.add(json.dumps(node[0], sort_keys=True))
+        for k, st in node[1]:
+            strings.add(k)
+            collect(st)
+
+    roots = [(psetid, _wildtree(tree).root,
+              _OBJECT_FIRST if getattr(tree, 'object_first', False) else 0)
+             for psetid, tree in trees]
+    for _, root, _ in roots:
+        collect(root)
+    strings = sorted(strings, key=lambda s: s.encode('utf-8'))
+    index = {s: i for i, s in enumerate(strings)}
+
+    index_words = _INDEX_WORDS[VERSION]
+    nodes_start = _HEADER_WORDS + index_words * len(roots) + 2 * len(strings)
+    words = array(_WORD, [0] * nodes_start)
+
+    def encode(node):
+        # Children are written before their parents, so that child
+        # offsets are known when the parent is written.
+        children = [(index[k], encode(st)) for k, st in node[1]]
+        offset = len(words)
+        item = node[0]
+        words.append(0 if item is None else
+                     index[json.dumps(item, sort_keys=True)] + 1)
+        words.append(len(children))
+        for k, child in children:
+            words.append(k)
+            words.append(child)
+        return offset
+
+    pos = _HEADER_WORDS
+    for psetid, root, flags in roots:
+        offset = encode(root)
+        entry = [psetid & 0xffffffff, psetid >> 32, offset, flags]
+        words[pos:pos + index_words] = array(_WORD, entry[:index_words])
+        pos += index_words
+
+    blob = bytearray()
+    for s in strings:
+        b = s.encode('utf-8')
+        words[pos:pos + 2] = array(_WORD, [len(blob), len(b)])
+        blob.extend(b)
+        pos += 2
+    blob.extend(b'\0' * (-len(blob) % 4))
+
+    data_offset = 4 * len(words)
+    nwords = len(words) + len(blob) // 4
+    words[0:_HEADER_WORDS] = array(_WORD, [
+        MAGIC, VERSION, len(roots), _HEADER_WORDS,
+        len(strings), _HEADER_WORDS + index_words * len(roots),
+        data_offset, nwords
+    ])
+    if sys.byteorder == 'big':
+        words.byteswap()
+
+    write_atomically(path, [words.tobytes(), bytes(blob)])
+
+
+def write_atomically(path, chunks):
+    """Write a sequence of byte strings to a temporary file and rename
+    it to ``path``, so that readers of ``path`` only ever see complete
+    files.
+
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)),
+                               prefix='.tutelary-')
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            for chunk in chunks:
+                fp.write(chunk)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+class MappedStore:
+    """A store file mapped into memory.  Use ``get`` to find the tree for
+    a permission set.
+
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as fp:
+            st = os.fstat(fp.fileno())
+            self.stat = (st.st_ino, st.st_mtime_ns, st.st_size)
+            self.map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        if sys.byteorder == 'little':
+            self.words = memoryview(self.map).cast(_WORD)
+        else:
+            self.words = array(_WORD, self.map)
+            self.words.byteswap()
+        w = self.words
+        if len(w) < _HEADER_WORDS or w[0] != MAGIC:
+            raise ValueError('not a permission tree store: ' + path)
+        if w[1] not in _INDEX_WORDS:
+            raise ValueError('unsupported permission tree store version ' +
+                             str(w[1]))
+        if w[7] != len(w):
+            raise ValueError('truncated permission tree store: ' + path)
+        self.index_words = _INDEX_WORDS[w[1]]
+        self.nsets = w[2]
+        self.index_offset = w[3]
+        self.nstrings = w[4]
+        self.strings_offset = w[5]
+        self.data_offset = w[6]
+        self.loaded_at = time.monotonic()
+        self.wildcard = self.string_index('*')
+        self.multi_wildcard = self.string_index('**')
+        self.allow_code = self.string_index('"allow"') + 1
+        # Parsed ID set keys, by string index.
+        self.id_sets = {}
+        for i in range(self._lower_bound(b'['), self._lower_bound(b'\\')):
+            ids = id_set(self.string(i))
+            if ids is not None:
+                self.id_sets[i] = ids
+
+    def __len__(self):
+        return self.nsets
+
+    def get(self, psetid):
+        """The ``MappedTree`` for a permission set, or ``None`` if the
+        permission set isn't in the store.
+
+        """
+        w = self.words
+        lo, hi = 0, self.nsets
+        while lo < hi:
+            mid = (lo + hi) // 2
+            pos = self.index_offset + self.index_words * mid
+            mid_id = w[pos] | (w[pos + 1] << 32)
+            if mid_id == psetid:
+                flags = w[pos + 3] if self.index_words > 3 else 0
+                return MappedTree(self, w[pos + 2],
+                                  bool(flags & _OBJECT_FIRST))
+            elif mid_id < psetid:
+                lo = mid + 1
+            else:
+                hi = mid
+        return None
+
+    def string(self, idx):
+        pos = self.strings_offset + 2 * idx
+        start = self.data_offset + self.words[pos]
+        return self.map[start:start + self.words[pos + 1]].decode('utf-8')
+
+    def string_index(self, s):
+        """Index of a string in the string table, or -1 if it doesn't
+        appear there.
+
+        """
+        b = s.encode('utf-8')
+        w, m = self.words, self.map
+        lo, hi = 0, self.nstrings
+        while lo < hi:
+            mid = (lo + hi) // 2
+            pos = self.strings_offset + 2 * mid
+            start = self.data_offset + w[pos]
+            cand = m[start:start + w[pos + 1]]
+            if cand == b:
+                return mid
+            elif cand < b:
+                lo = mid + 1
+            else:
+                hi = mid
+        return -1
+
+    def key_indexes(self, key):
+        """(String index, numeric ID) pairs for the components of a key:
+        the index of the component in the string table (or -1 if it
+        doesn't appear there), and its value if it is an ID that ID
+        set keys can match (or ``None``).
+
+        """
+        return [(self.string_index(k), int(k) if is_id(k) else None)
+                for k in key]
+
+    def _lower_bound(self, b):
+        # Index of the first string not less than the bytes ``b``.
+        w, m = self.words, self.map
+        lo, hi = 0, self.nstrings
+        while lo < hi:
+            mid = (lo + hi) // 2
+            pos = self.strings_offset + 2 * mid
+            start = self.data_offset + w[pos]
+            if m[start:start + w[pos + 1]] < b:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def close(self):
+        if isinstance(self.words, memoryview):
+            self.words.release()
+        self.map.close()
+
+
+class MappedTree:
+    """Permission tree evaluated directly against the contents of a
+    ``MappedStore``.  Supports the same queries as
+    ``tutelary.engine.PermissionTree``.
+
+    """
+    def __init__(self, store, root, object_first=False):
+        self.store = store
+        self.root = root
+        self.object_first = object_first
+
+    def lookup(self, key):
+        """Look up a key path, with the same semantics as ``WildTree``
+        lookup.  Raises ``KeyError`` if there is no match.
+
+        """
+        store = self.store
+        idxs = store.key_indexes(key)
+        code = _find(store.words, self.root, idxs, 0, store.wildcard,
+                     store.multi_wildcard, store.id_sets)
+        if code < 0:
+            raise KeyError(key)
+        return json.loads(self.store.string(code - 1))
+
+    def allow(self, act, obj=None):
+        objc = obj.components if obj is not None else []
+        store = self.store
+        if self.object_first:
+            key = list(objc) + [OBJECT_END] + list(act.components)
+        else:
+            key = act.components + objc
+        idxs = store.key_indexes(key)
+        code = _find(store.words, self.root, idxs, 0, store.wildcard,
+                     store.multi_wildcard, store.id_sets)
+        return code == store.allow_code
+
+    def permitted_actions(self, obj=None):
+        return [a for a in Action.registered
+                if self.allow(a, obj(str(a)) if obj is not None else None)]
+
+    def to_wildtree(self):
+        """Decode the mapped tree into a frozen ``WildTree`` (mostly
+        useful for debugging).
+
+        """
+        store, w = self.store, self.store.words
+        items = {}
+
+        def decode(pos):
+            code = w[pos]
+            if code and code not in items:
+                items[code] = json.loads(store.string(code - 1))
+            subtrees = tuple(
+                (store.string(w[pos + 2 + 2 * i]),
+                 decode(w[pos + 3 + 2 * i]))
+                for i in range(w[pos + 1])
+            )
+            return (items.get(code), subtrees)
+
+        tree = WildTree()
+        tree.root = decode(self.root)
+        tree.frozen = True
+        return tree
+
+
+def _find(w, pos, idxs, i, wildcard, multi, id_sets):
+    """Find the item code for a key (given as pairs from
+    ``MappedStore.key_indexes``, starting at position ``i``) in the
+    node at word offset ``pos``.  Mirrors
+    ``tutelary.wildtree.find_in_tree``, returning -1 if there is no
+    match.  (``wildcard`` and ``multi`` are the string indexes of ``*``
+    and ``**``, and ``id_sets`` maps the string indexes of ID set keys
+    to their ``IdSet``.)
+
+    """
+    n = w[pos + 1]
+    if i == len(idxs):
+        if w[pos] != 0:
+            return w[pos]
+        for c in range(pos + 2, pos + 2 + 2 * n, 2):
+            if w[c] == wildcard or w[c] == multi:
+                code = _find(w, w[c + 1], idxs, i, wildcard, multi, id_sets)
+                if code >= 0:
+                    return code
+        return -1
+    head, num = idxs[i]
+    for c in range(pos + 2, pos + 2 + 2 * n, 2):
+        k = w[c]
+        if k == multi:
+            code = _find_multi(w, w[c + 1], idxs,
+                               tuple(range(i, len(idxs) + 1)),
+                               wildcard, multi, id_sets, set())
+        elif (k == head or k == wildcard or
+              num is not None and k in id_sets and num in id_sets[k]):
+            code = _find(w, w[c + 1], idxs, i + 1, wildcard, multi, id_sets)
+        else:
+            continue
+        if code >= 0:
+            return code
+    return -1
+
+
+def _find_multi(w, pos, idxs, positions, wildcard, multi, id_sets,
+                failed):
+    """Find the item code for a key below a ``**`` wildcard, where the
+    key components matched so far may be any of the given
+    ``positions``.  Mirrors ``tutelary.wildtree._find_multi``.
+
+    """
+    if (pos, positions) in failed:
+        return -1
+    end = len(idxs)
+    if w[pos] != 0 and positions[-1] == end:
+        return w[pos]
+    for c in range(pos + 2, pos + 2 + 2 * w[pos + 1], 2):
+        k = w[c]
+        if k == multi:
+            nxt = tuple(range(positions[0], end + 1))
+        elif k == wildcard:
+            nxt = tuple(sorted({min(p + 1, end) for p in positions}))
+        else:
+            nxt = tuple(p + 1 for p in positions
+                        if p < end and _matches(k, idxs[p], id_sets))
+        if nxt:
+            code = _find_multi(w, w[c + 1], idxs, nxt, wildcard, multi,
+                               id_sets, failed)
+            if code >= 0:
+                return code
+    failed.add((pos, positions))
+    return -1
+
+
+def _matches(k, head, id_sets):
+    # Does the string with index ``k`` match a key component given as a
+    # pair from ``MappedStore.key_indexes`` (apart from the wildcard)?
+    if k == head[0]:
+        return True
+    ids = id_sets.get(k) if head[1] is not None else None
+    return ids is not None and head[1] in ids
+
+
+def _wildtree(tree):
+    return tree if isinstance(tree, WildTree) else tree.tree
+
+
+class SharedStore:
+    """Process-wide access to the store file at a given path, reopening it
+    when a new version is published.
+
+    """
+    def __init__(self, path, check_interval=1.0):
+        self.path = path
+        self.check_interval = check_interval
+        self.store = None
+        self.checked_at = None
+        self.lock = threading.Lock()
+
+    def current(self):
+        """The current ``MappedStore``, or ``None`` if there is no store
+        file.
+
+        """
+        now = time.monotonic()
+        if (self.checked_at is not None and
+                now - self.checked_at < self.check_interval):
+            return self.store
+        with self.lock:
+            try:
+                st = os.stat(self.path)
+            except FileNotFoundError:
+                # Look again next time: the first version of the file
+                # may be published at any moment.
+                self.store = None
+                self.checked_at = None
+                return None
+            self.checked_at = now
+            stat = (st.st_ino, st.st_mtime_ns, st.st_size)
+            if self.store is None or self.store.stat != stat:
+                # The old mapping is left for the garbage collector to
+                # close, since other threads may still be using it.
+                self.store = MappedStore(self.path)
+            return self.store
@@ -1,8 +1,21 @@
 # coding:utf-8
+import re
+import sys
+from bisect import bisect_right
 from collections import MutableMapping
+from functools import lru_cache
 from json import loads, dumps
 
 
+# Minimum number of sibling keys that are numeric IDs with identical
+# subtrees for ``WildTree.minimise`` to replace them with an ID set key.
+ID_SET_MIN_SIZE = 4
+
+# Minimum number of subtrees of a node in a frozen tree for lookups to
+# use a Bloom filter of the node's keys (or None to disable them).
+BLOOM_MIN_CHILDREN = 256
+
+
 class WildTree(MutableMapping):
     """
     Data structure for mapping between segmented paths
@@ -13,24 +26,59 @@ class WildTree(MutableMapping):
     Provides JSON serialisation (via repr) and deserialisation (via
     constructor).
 
+    Trees can be frozen, after which they are immutable snapshots that
+    can safely be shared between threads: all nodes are converted to
+    tuples and any attempt to modify the tree raises ``TypeError``.
+    Updates are made by taking a ``copy`` of a frozen tree, which shares
+    all of its nodes with the original and copies only the nodes along
+    the paths that are actually modified.  Frozen trees are built only
+    from tuples and atomic values, so the garbage collector can stop
+    tracking them entirely (see ``tutelary.prefork``).
+
+    Frozen nodes are also hash-consed: identical frozen subtrees are
+    represented by a single shared node, however many trees they appear
+    in, so equality of frozen subtrees is identity.
+
+    As well as ``*`` wildcards, which match any single key component,
+    key paths may contain ``**`` wildcards, which match any sequence of
+    key components (including the empty sequence), and ID set
+    components, like ``[1000-1999]`` or ``[3,17,40-49]``, which match
+    any numeric ID in the set (see ``IdSet``).  Lookups below a ``**``
+    wildcard in the tree track the set of key positions that the
+    wildcard may have stopped at, and remember the nodes where the
+    lookup has already failed for a set of positions, so that the cost
+    of a lookup is bounded by the number of nodes in the tree times
+    the number of different sets of positions, rather than growing
+    exponentially with the number of ``**`` wildcards.
+
+    Lookups in frozen trees use a Bloom filter of the keys of each node
+    with at least ``BLOOM_MIN_CHILDREN`` subtrees (built when a lookup
+    first reaches the node), so that lookups of keys that aren't there
+    only need to try the node's wildcard and ID set subtrees, rather
+    than comparing the key with every subtree's key.
+
     """
     def __init__(self, json=None):
         """
         By default, all new ``WildTree`` objects are empty.  They can also
-        be deserialised from a JSON representation.  We store the
-        optional value at the endpoint of the path to this node, plus
-        a list of subtrees.  Each subtree is a pair whose first
-        element is a key value (which may be a ``*`` wildcard) and
-        whose second element is a ``WildTree``.
+        be deserialised from a JSON representation.  Each node stores
+        the optional value at the endpoint of the path to the node,
+        plus a list of subtrees, as a two-element list (or tuple, in
+        frozen trees).  Each subtree is a pair whose first element is
+        a key value (which may be a ``*`` wildcard) and whose second
+        element is a node.  (Only mutable nodes are lists: anything
+        else is a shared, read-only node.)
 
         """
         if json is None:
-            self.root = {'item': None, 'subtrees': []}
+            self.root = [None, []]
         else:
-            self.root = loads(json)
+            self.root = _from_json(loads(json))
+        self.frozen = False
+        self._prefilters = {}
 
     def __repr__(self):
-        return dumps(self.root)
+        return dumps(_to_json(self.root))
 
     def __contains__(self, key):
         """
@@ -40,14 +88,14 @@ class WildTree(MutableMapping):
         while len(key) > 0:
             head, key = key[0], key[1:]
             found = False
-            for st in node['subtrees']:
+            for st in node[1]:
                 if st[0] == head:
                     found = True
                     node = st[1]
                     break
             if not found:
                 return False
-        return node['item'] is not None
+        return node[0] is not None
 
     def __len__(self):
         """
@@ -58,18 +106,23 @@ class WildTree(MutableMapping):
 
         """
         def _len_help(tree):
-            n = sum(_len_help(t[1]) for t in tree['subtrees'])
-            return n + 1 if tree['item'] is not None else n
+            n = sum(_len_help(t[1]) for t in tree[1])
+            return n + 1 if tree[0] is not None else n
         return _len_help(self.root)
 
+    def __eq__(self, other):
+        if isinstance(other, WildTree) and self.root is other.root:
+            return True
+        return super().__eq__(other)
+
     def __iter__(self):
         """
         Iterate over keys in the tree in "domination order".
         """
         def _iter_help(tree):
-            if tree['item'] is not None:
+            if tree[0] is not None:
                 yield ()
-            for st in tree['subtrees']:
+            for st in tree[1]:
                 for tail in _iter_help(st[1]):
                     yield (st[0],) + tail
         yield from _iter_help(self.root)
@@ -78,7 +131,8 @@ class WildTree(MutableMapping):
         """
         Key lookup with wildcards.
         """
-        return find_in_tree(self.root, key)[0]
+        return find_in_tree(self.root, key,
+                            prefilters=self._lookup_prefilters())[0]
 
     def __setitem__(self, key, value):
         """
@@ -86,30 +140,147 @@ class WildTree(MutableMapping):
         existing key paths.
 
         """
+        self._check_mutable()
         self._purge_unreachable(key)
-        node = self.root
+        node = self._own_root()
+        multi = False
         while len(key) > 0:
             found = False
-            for st in node['subtrees']:
+            for i, st in enumerate(node[1]):
+                # An existing subtree can only be reused if no earlier
+                # subtree can match the same keys.  Below a ``**``
+                # wildcard, subtrees with different keys can match the
+                # same keys at different positions, so only the first
+                # subtree can be reused, and only if the item at its
+                # root (which lookups try before anything below it)
+                # is about to be replaced, or there isn't one.
                 if st[0] == key[0]:
-                    found = True
-                    node = st[1]
+                    if (not (multi or key[0] == '**') or len(key) == 1 or
+                            st[1][0] is None):
+                        found = True
+                        node = _own_child(node, i)
                     break
-                elif st[0] == '*':
+                elif multi or component_overlap(st[0], key[0]):
                     break
             if not found:
-                default = {'item': None, 'subtrees': []}
-                node['subtrees'].insert(0, (key[0], default))
+                default = [None, []]
+                node[1].insert(0, (key[0], default))
                 node = default
+            multi = multi or key[0] == '**'
             key = key[1:]
-        node['item'] = value
+        node[0] = value
 
     def __delitem__(self, key):
         """
         Key deletion: wildcards must be matched explicitly.
         """
+        self._check_mutable()
         _, idxs = find_in_tree(self.root, key, perfect=True)
-        del_by_idx(self.root, idxs)
+        del_by_idx(self._own_path(idxs), idxs)
+
+    def overlay(self, other):
+        """
+        Return a new frozen tree equivalent to inserting all the keys of
+        ``other``, in order, into a copy of this tree, so that keys in
+        ``other`` take precedence.  The two trees are merged
+        structurally, in time proportional to their sizes: the keys of
+        this tree that are dominated by keys of ``other`` are purged,
+        and the subtrees of the two trees are then interleaved, merging
+        subtrees with the same key wherever that doesn't change the
+        order in which lookups try them.
+
+        """
+        lower = _freeze_node(self.root)
+        upper = _freeze_node(other.root)
+        lower = (_purge_dominated(lower, _multi_closure([(upper, False)])) or
+                 (None, ()))
+        t = WildTree()
+        t.root = _overlay_nodes(upper, lower)
+        t.frozen = True
+        return t
+
+    def minimise(self, outcome=None):
+        """
+        Remove the key paths that don't affect the outcome of any lookup,
+        where the outcome of a lookup is given by applying the
+        ``outcome`` function to the value found (or to ``None`` for
+        lookups that don't find anything).  By default, the outcome is
+        the value itself.  Returns the ratio of the number of nodes in
+        the tree after minimisation to the number before.
+
+        Lookups find the first key path in the tree (in iteration
+        order) that matches the lookup key, so a key path can be
+        removed if the key paths after it that match any of the same
+        keys all give the same outcome, up to and including one that
+        dominates it (or if there is no dominating key path, and the
+        outcome is the same as for a failed lookup).  Since this only
+        depends on the outcomes for the keys that the path matches,
+        all such paths can be removed at once.  The tree's nodes are
+        replaced rather than modified, so the original nodes can still
+        be shared with other trees.
+
+        Finally, runs of at least ``ID_SET_MIN_SIZE`` sibling keys that
+        are numeric IDs (like the object IDs of per-object rules) with
+        identical subtrees are replaced by a single ID set key, where
+        that doesn't change the order in which lookups try subtrees
+        that can match the same keys.
+
+        """
+        if outcome is None:
+            def outcome(value):
+                return value
+        root = _freeze_node(self.root)
+        rules = []
+        _collect_items(root, (), (), rules)
+        order = {trace: i for i, (trace, _, _) in enumerate(rules)}
+        unmatched = outcome(None)
+        drop = set()
+        for i, (trace, path, item) in enumerate(rules):
+            result = outcome(item)
+            later = sorted(order[t] for t in _overlapping(root, path, 0, ())
+                           if order[t] > i)
+            redundant = result == unmatched
+            for j in later:
+                _, other, other_item = rules[j]
+                if outcome(other_item) != result:
+                    redundant = False
+                    break
+                if dominates(other, path):
+                    redundant = True
+                    break
+            if redundant:
+                drop.add(trace)
+        before = _node_count(root)
+        if drop:
+            root = _drop_items(root, (), drop) or canonical_node((None, ()))
+        self.root = _compress_ids(root, {})
+        self._prefilters = {}
+        return _node_count(self.root) / before
+
+    def node_count(self):
+        """
+        Number of nodes in the tree, including the root.
+        """
+        return _node_count(self.root)
+
+    def freeze(self):
+        """
+        Make the tree immutable.  Returns the tree itself for convenience.
+        """
+        if not self.frozen:
+            self.root = _freeze_node(self.root)
+            self.frozen = True
+        return self
+
+    def copy(self):
+        """
+        Return a mutable copy of the tree.  Nodes of frozen trees are
+        shared with the copy until it modifies them.
+
+        """
+        t = WildTree()
+        t.root = self.root if self.frozen else _thaw_node(self.root, True)
+        return t
 
     def find(self, key, perfect=False):
         """
@@ -118,7 +289,50 @@ class WildTree(MutableMapping):
         ``KeyError`` if the key path doesn't exist in the tree.
 
         """
-        return find_in_tree(self.root, key, perfect)
+        return find_in_tree(self.root, key, perfect,
+                            self._lookup_prefilters())
+
+    def lookup_each(self, prefix, keys, default=None):
+        """
+        Look up the key paths ``prefix + key`` for each of ``keys``,
+        returning a list of the items found (or ``default`` for keys
+        with no match).  The nodes matching ``prefix`` are found once
+        and shared between the lookups.
+
+        This gives the same results as separate lookups as long as the
+        last component of ``prefix`` is a separator that occurs exactly
+        once in every key path in the tree, and never in the keys: it
+        then can't be matched by a wildcard in any successful lookup.
+
+        """
+        prefix = tuple(prefix)
+        prefilters = self._lookup_prefilters()
+        nodes = []
+        _descend(self.root, prefix, (0,), nodes, set(), prefilters)
+        found = []
+        for key in keys:
+            key = tuple(key)
+            for node in nodes:
+                try:
+                    found.append(find_in_tree(node, key, False,
+                                              prefilters)[0])
+                    break
+                except KeyError:
+                    pass
+            else:
+                found.append(default)
+        return found
+
+    def _lookup_prefilters(self):
+        """
+        The table of Bloom filters for the nodes of the tree, or ``None``
+        if lookups shouldn't use them (because the tree is mutable, or
+        they are disabled).
+
+        """
+        if not self.frozen or BLOOM_MIN_CHILDREN is None:
+            return None
+        return self._prefilters
 
     def _purge_unreachable(self, key):
         """
@@ -132,59 +346,745 @@ class WildTree(MutableMapping):
                 dels.append(p)
         for k in dels:
             _, idxs = find_in_tree(self.root, k, perfect=True)
-            del_by_idx(self.root, idxs)
+            del_by_idx(self._own_path(idxs), idxs)
+
+    def _check_mutable(self):
+        if self.frozen:
+            raise TypeError('frozen WildTree does not support modification')
+
+    def _own_root(self):
+        """
+        Make sure that the root node is owned by this tree (rather than
+        shared with a frozen tree) and return it.
+
+        """
+        if type(self.root) is not list:
+            self.root = _thaw_node(self.root)
+        return self.root
+
+    def _own_path(self, idxs):
+        """
+        Make sure that all nodes along an index path through the subtree
+        lists are owned by this tree.  Returns the root node.
+
+        """
+        node = self._own_root()
+        for i in idxs:
+            node = _own_child(node, i)
+        return self.root
+
+
+def _from_json(d):
+    """
+    Convert a node from its JSON form.
+    """
+    return [d['item'], [(k, _from_json(st)) for k, st in d['subtrees']]]
+
+
+def _to_json(node):
+    """
+    Convert a node to its JSON form.
+    """
+    return {'item': node[0],
+            'subtrees': [(k, _to_json(st)) for k, st in node[1]]}
+
+
+def _thaw_node(node, deep=False):
+    """
+    Shallow copy of a node with a mutable subtree list.  If ``deep`` is
+    set, all mutable descendants are copied too (frozen ones are
+    shared).
+
+    """
+    if deep:
+        if type(node) is not list:
+            return node
+        return [node[0], [(k, _thaw_node(st, True)) for k, st in node[1]]]
+    return [node[0], list(node[1])]
+
+
+def _own_child(node, idx):
+    """
+    Return the ``idx``'th child of an owned node, replacing it by a
+    mutable copy first if it is shared.
+
+    """
+    k, child = node[1][idx]
+    if type(child) is not list:
+        child = _thaw_node(child)
+        node[1][idx] = (k, child)
+    return child
+
+
+def _freeze_node(node):
+    """
+    Convert a node and all its descendants to immutable form, reusing
+    any parts that are already frozen.
+
+    """
+    if type(node) is not list:
+        return node
+    return canonical_node(
+        (node[0], tuple((k, _freeze_node(st)) for k, st in node[1]))
+    )
+
+
+# Hash-consing table for frozen nodes.  This would naturally be a weak
+# table, but tuples can't be weakly referenced (and making nodes
+# instances of a tuple subclass would stop the garbage collector from
+# untracking them), so instead nodes only referenced from the table
+# are pruned whenever the table has doubled in size since the last
+# pruning.
+_canonical = {}
+_canonical_limit = 4096
+
+
+def canonical_node(node):
+    """
+    Return the canonical shared instance of a frozen node, whose
+    children must already be canonical.  Nodes with unhashable items
+    are returned as they are.
+
+    """
+    global _canonical_limit
+    # Children are identified by identity, since they are canonical,
+    # and items by type as well as value, so that, for example, items
+    # of 1 and True are kept distinct.
+    key = (type(node[0]), node[0],
+           tuple((k, id(st)) for k, st in node[1]))
+    try:
+        canon = _canonical.setdefault(key, node)
+    except TypeError:
+        return node
+    if len(_canonical) > _canonical_limit:
+        prune_canonical_nodes()
+        _canonical_limit = max(4096, 2 * len(_canonical))
+    return canon
+
+
+def prune_canonical_nodes():
+    """
+    Drop nodes that are no longer used by any tree from the hash-consing
+    table.  Returns the number of nodes remaining in the table.
+
+    """
+    # References to an unused node: the table entry, the candidate
+    # (key, node) pair, the loop variable and the argument of
+    # getrefcount.
+    unused = 4
+    pruned = True
+    while pruned:
+        pruned = False
+        for key, node in list(_canonical.items()):
+            if sys.getrefcount(node) <= unused:
+                _canonical.pop(key, None)
+                pruned = True
+        key = node = None
+    return len(_canonical)
+
+
+def _purge_dominated(node, uppers):
+    """
+    Remove the items of a frozen node and its descendants that are
+    dominated by items of another tree, given the nodes of the other
+    tree reached by paths dominating the path to ``node``.  The nodes
+    are given as a list of (node, multi) pairs, where ``multi`` is true
+    for nodes reached by a ``**`` wildcard, which can also match any
+    further components.  Returns the pruned node, or ``None`` if
+    nothing is left of it.
+
+    """
+    item = node[0]
+    if item is not None and any(_matches_end(u) for u, _ in uppers):
+        item = None
+    subtrees = []
+    changed = item is not node[0]
+    for k, st in node[1]:
+        subuppers = []
+        for u, multi in uppers:
+            if multi:
+                subuppers.append((u, True))
+            for uk, ust in u[1]:
+                if component_dominates(uk, k):
+                    subuppers.append((ust, uk == '**'))
+        if subuppers:
+            subuppers = _multi_closure(subuppers)
+            pst = _purge_dominated(st, subuppers)
+            changed = changed or pst is not st
+            st = pst
+        if st is not None:
+            subtrees.append((k, st))
+    if not changed:
+        return node
+    if item is None and not subtrees:
+        return None
+    return canonical_node((item, tuple(subtrees)))
+
+
+def _multi_closure(nodes):
+    """
+    Remove duplicates from a list of (node, multi) pairs, and add the
+    nodes reached from them by ``**`` wildcards matching no components
+    (see ``_purge_dominated``).
+
+    """
+    # Nodes are compared by identity: comparing them by value would
+    # mean comparing whole subtrees.
+    seen = {}
+    todo = list(nodes)
+    while todo:
+        node, multi = todo.pop()
+        if (id(node), multi) in seen:
+            continue
+        seen[id(node), multi] = (node, multi)
+        todo.extend((st, True) for k, st in node[1] if k == '**')
+    return list(seen.values())
+
+
+def _matches_end(node):
+    """
+    Does a node have an item, or a chain of wildcard subtrees leading to
+    an item (which matches keys that end at the node)?
+
+    """
+    return node[0] is not None or any(k in ('*', '**') and _matches_end(st)
+                                      for k, st in node[1])
+
+
+def _overlay_nodes(upper, lower):
+    """
+    Merge two frozen nodes so that lookups try the subtrees of ``upper``
+    before those of ``lower``.  Subtrees with the same key are merged
+    recursively when moving the lower subtree forward doesn't take it
+    past any other subtree that could match the same keys.
+
+    """
+    item = upper[0] if upper[0] is not None else lower[0]
+    ups = upper[1]
+    # Only wildcards and ID sets can match the same keys as subtrees
+    # with other keys.
+    wild = [i for i, (k, _) in enumerate(ups) if _is_wild(k)]
+    last = {k: i for i, (k, _) in enumerate(ups)}
+    merged = {}
+    rest = []
+    for k, st in lower[1]:
+        i = last[k] if k in last else -1
+        # Lower wildcard subtrees can match the same keys as any subtree
+        # they would be moved past.  (Subtrees below ``**`` wildcards
+        # are never merged, since subtrees with different keys can
+        # match the same keys there: see ``__setitem__``.)
+        if k == '**':
+            ok = False
+        elif k == '*':
+            ok = i == len(ups) - 1 and not rest
+        elif _is_wild(k):
+            ok = not any(component_overlap(uk, k) for uk, _ in ups[i + 1:])
+        else:
+            ok = not any(j > i and component_overlap(ups[j][0], k)
+                         for j in wild)
+        ok = ok and not any(component_overlap(rk, k) for rk, _ in rest)
+        if ok and i >= 0 and i not in merged:
+            merged[i] = st
+        else:
+            rest.append((k, st))
+    subtrees = [(k, _overlay_nodes(st, merged[i]) if i in merged else st)
+                for i, (k, st) in enumerate(ups)]
+    return canonical_node((item, tuple(subtrees + rest)))
+
+
+def _collect_items(node, trace, path, items):
+    """
+    Append the (index trace, key path, item) triples for all the items
+    of a node and its descendants to ``items``, in iteration order.
+
+    """
+    if node[0] is not None:
+        items.append((trace, path, node[0]))
+    for i, (k, st) in enumerate(node[1]):
+        _collect_items(st, trace + (i,), path + (k,), items)
+
+
+def _overlapping(node, path, depth, trace):
+    """
+    Generate the index traces of the items of a node (at ``depth`` in
+    the tree) and its descendants whose key paths match some of the
+    same keys as the key path ``path``.  Two key paths match a common
+    key if their components overlap (see ``component_overlap``) up to
+    the length of the shorter one, and the rest of the longer one is
+    all wildcards.  Past a ``**`` wildcard in either path, all key
+    paths are taken to overlap.
+
+    """
+    if depth < len(path) and path[depth] == '**':
+        yield from _item_traces(node, trace)
+        return
+    if node[0] is not None and all(c in ('*', '**') for c in path[depth:]):
+        yield trace
+    for i, (k, st) in enumerate(node[1]):
+        if k == '**':
+            yield from _item_traces(st, trace + (i,))
+        elif (k == '*' or depth < len(path) and
+                component_overlap(path[depth], k)):
+            yield from _overlapping(st, path, depth + 1, trace + (i,))
+
+
+def _item_traces(node, trace):
+    items = []
+    _collect_items(node, trace, (), items)
+    return [t for t, _, _ in items]
+
+
+def _drop_items(node, trace, drop):
+    """
+    Remove the items at the given index traces from a frozen node and
+    its descendants, along with any nodes left with neither an item nor
+    subtrees.  Returns ``None`` if nothing is left of the node.
+
+    """
+    item = None if trace in drop else node[0]
+    changed = item is not node[0]
+    subtrees = []
+    for i, (k, st) in enumerate(node[1]):
+        dst = _drop_items(st, trace + (i,), drop)
+        changed = changed or dst is not st
+        if dst is not None:
+            subtrees.append((k, dst))
+    if not changed:
+        return node
+    if item is None and not subtrees:
+        return None
+    return canonical_node((item, tuple(subtrees)))
+
+
+def _compress_ids(node, done):
+    """
+    Replace runs of sibling keys that are numeric IDs with identical
+    subtrees in a frozen node and its descendants by ID set keys (see
+    ``WildTree.minimise``).  ``done`` maps the IDs of nodes already
+    processed to their results, since shared nodes may be reached by
+    many paths.
+
+    """
+    result = done.get(id(node))
+    if result is not None:
+        return result
+    # Subtrees below ``**`` wildcards can't be reordered (see
+    # ``__setitem__``).
+    subtrees = [(k, st if k == '**' else _compress_ids(st, done))
+                for k, st in node[1]]
+    # Literal keys can only match the same keys as equal keys, or
+    # wildcards and ID sets, so the subtrees for distinct IDs can be
+    # moved together as long as they don't pass any of those.
+    groups = {}
+    seg = 0
+    counts = {}
+    for i, (k, st) in enumerate(subtrees):
+        if _is_wild(k):
+            seg += 1
+        else:
+            counts[seg, k] = counts.get((seg, k), 0) + 1
+            if _ID.match(k):
+                groups.setdefault((seg, id(st)), []).append(i)
+    merge = {}
+    for (seg, _), idxs in groups.items():
+        idxs = [i for i in idxs if counts[seg, subtrees[i][0]] == 1]
+        if len(idxs) >= ID_SET_MIN_SIZE:
+            ids = IdSet.from_ids(int(subtrees[i][0]) for i in idxs)
+            for i in idxs:
+                merge[i] = None
+            merge[idxs[0]] = (str(ids), subtrees[idxs[0]][1])
+    if merge:
+        subtrees = [merge[i] if i in merge else kst
+                    for i, kst in enumerate(subtrees)
+                    if i not in merge or merge[i] is not None]
+    result = node
+    if merge or any(st is not ost for (_, st), (_, ost) in
+                    zip(subtrees, node[1])):
+        result = canonical_node((node[0], tuple(subtrees)))
+    done[id(node)] = result
+    return result
+
+
+def _node_count(node):
+    return 1 + sum(_node_count(st) for _, st in node[1])
 
 
 def del_by_idx(tree, idxs):
     """
     Delete a key entry based on numerical indexes into subtree lists.
+    Nodes left with neither an item nor subtrees are removed.
+
     """
     if len(idxs) == 0:
-        tree['item'] = None
-        tree['subtrees'] = []
+        tree[0] = None
     else:
         hidx, tidxs = idxs[0], idxs[1:]
-        del_by_idx(tree['subtrees'][hidx][1], tidxs)
-        if len(tree['subtrees'][hidx][1]['subtrees']) == 0:
-            del tree['subtrees'][hidx]
+        del_by_idx(tree[1][hidx][1], tidxs)
+        child = tree[1][hidx][1]
+        if child[0] is None and len(child[1]) == 0:
+            del tree[1][hidx]
 
 
-def find_in_tree(tree, key, perfect=False):
+def find_in_tree(tree, key, perfect=False, prefilters=None):
     """
-    Helper to perform find in dictionary tree.
+    Helper to perform find in dictionary tree.  If a ``prefilters``
+    table is given, Bloom filters for wide nodes are built in it and
+    used to skip the subtrees that can't match.  (The nodes must be
+    frozen.)
+
     """
     if len(key) == 0:
-        if tree['item'] is not None:
-            return tree['item'], ()
+        if tree[0] is not None:
+            return tree[0], ()
         else:
-            for i in range(len(tree['subtrees'])):
-                if not perfect and tree['subtrees'][i][0] == '*':
-                    item, trace = find_in_tree(tree['subtrees'][i][1],
-                                               (), perfect)
-                    return item, (i,) + trace
+            for i in range(len(tree[1])):
+                if not perfect and tree[1][i][0] in ('*', '**'):
+                    try:
+                        item, trace = find_in_tree(tree[1][i][1],
+                                                   (), perfect)
+                        return item, (i,) + trace
+                    except KeyError:
+                        pass
             raise KeyError(key)
     else:
         head, tail = key[0], key[1:]
-        for i in range(len(tree['subtrees'])):
-            if tree['subtrees'][i][0] == head or \
-               not perfect and tree['subtrees'][i][0] == '*':
+        idxs = range(len(tree[1]))
+        if prefilters is not None and len(idxs) >= BLOOM_MIN_CHILDREN:
+            pf = _prefilter(tree, prefilters)
+            if head not in pf:
+                # Only the wildcard and ID set subtrees can match.
+                idxs = () if perfect else pf.wild
+        for i in idxs:
+            k = tree[1][i][0]
+            if k == '**' and not perfect:
+                res = _find_multi(tree[1][i][1], key,
+                                  tuple(range(len(key) + 1)), set())
+                if res is not None:
+                    return res[0], (i,) + res[1]
+            elif k == head or not perfect and (
+                    k == '*' or k[:1] == '[' and component_matches(k, head)):
                 try:
-                    item, trace = find_in_tree(tree['subtrees'][i][1],
-                                               tail, perfect)
+                    item, trace = find_in_tree(tree[1][i][1],
+                                               tail, perfect, prefilters)
                     return item, (i,) + trace
                 except KeyError:
                     pass
         raise KeyError(key)
 
 
+def _find_multi(node, key, positions, failed):
+    """
+    Lookup below a ``**`` wildcard, where the components of ``key``
+    matched so far may be any of the given (sorted) ``positions`` in
+    the key.  Returns the first item in iteration order matching the
+    rest of the key from any of the positions, and the index trace to
+    it, or ``None`` if there is no match.  The (node, positions) pairs
+    for which there is no match are recorded in ``failed``, since the
+    same node can be reached many times with the same positions.
+
+    """
+    state = (id(node), positions)
+    if state in failed:
+        return None
+    n = len(key)
+    if node[0] is not None and positions[-1] == n:
+        return node[0], ()
+    for i, (k, st) in enumerate(node[1]):
+        if k == '**':
+            nxt = tuple(range(positions[0], n + 1))
+        elif k == '*':
+            # Wildcards at the end of a key path also match keys that
+            # stop short of them.
+            nxt = tuple(sorted({min(p + 1, n) for p in positions}))
+        else:
+            nxt = tuple(p + 1 for p in positions
+                        if p < n and component_matches(k, key[p]))
+        if nxt:
+            res = _find_multi(st, key, nxt, failed)
+            if res is not None:
+                return res[0], (i,) + res[1]
+    failed.add(state)
+    return None
+
+
+def _descend(node, prefix, positions, nodes, seen, prefilters):
+    """
+    Collect in ``nodes``, in lookup order, the subtrees reached through
+    the separator that ends ``prefix`` (see ``WildTree.lookup_each``),
+    where the components of ``prefix`` matched so far may be any of the
+    given ``positions``.  (There is more than one position only below a
+    ``**`` wildcard.)  Nodes already visited with the same positions
+    are recorded in ``seen`` and skipped.
+
+    """
+    state = (id(node), positions)
+    if state in seen:
+        return
+    seen.add(state)
+    end = len(prefix) - 1
+    sep = prefix[end]
+    idxs = range(len(node[1]))
+    if (prefilters is not None and len(positions) == 1 and
+            len(idxs) >= BLOOM_MIN_CHILDREN):
+        pf = _prefilter(node, prefilters)
+        if prefix[positions[0]] not in pf:
+            idxs = pf.wild
+    for i in idxs:
+        k, st = node[1][i]
+        # Neither wildcard can match the separator, since the rest of
+        # the path would then need another one.
+        if k == sep:
+            if positions[-1] == end:
+                nodes.append(st)
+            continue
+        elif k == '**':
+            nxt = tuple(range(positions[0], end + 1))
+        elif k == '*':
+            nxt = tuple(p + 1 for p in positions if p < end)
+        else:
+            nxt = tuple(p + 1 for p in positions
+                        if p < end and component_matches(k, prefix[p]))
+        if nxt:
+            _descend(st, prefix, nxt, nodes, seen, prefilters)
+
+
+class _Prefilter:
+    """
+    Bloom filter of the keys of the subtrees of a node, along with the
+    indexes of the subtrees that can match keys other than their own
+    (wildcards and ID sets).  Keys that aren't in the filter definitely
+    aren't the key of any subtree.  (Hashes of strings are different in
+    different processes, so the filters are never serialised.)
+
+    """
+    HASHES = 3
+    BITS_PER_KEY = 10
+
+    def __init__(self, subtrees):
+        self.nbits = max(64, self.BITS_PER_KEY * len(subtrees))
+        self.bits = bytearray((self.nbits + 7) // 8)
+        wild = []
+        for i, (k, _) in enumerate(subtrees):
+            if _is_wild(k):
+                wild.append(i)
+            for b in self._positions(k):
+                self.bits[b >> 3] |= 1 << (b & 7)
+        self.wild = tuple(wild)
+
+    def __contains__(self, k):
+        bits = self.bits
+        return all(bits[b >> 3] & (1 << (b & 7)) for b in self._positions(k))
+
+    def _positions(self, k):
+        # Double hashing: positions h1 + i * h2 for i = 0, 1, ...
+        h = hash(k)
+        h2 = (h >> 32) | 1
+        return [(h + i * h2) % self.nbits for i in range(self.HASHES)]
+
+
+def _prefilter(node, prefilters):
+    """
+    The ``_Prefilter`` for a node from a table of filters keyed by node
+    ID, building it if necessary.  (The node is kept with its filter
+    to make sure that it isn't a different node with a recycled ID.)
+
+    """
+    entry = prefilters.get(id(node))
+    if entry is None or entry[0] is not node:
+        entry = prefilters[id(node)] = (node, _Prefilter(node[1]))
+    return entry[1]
+
+
 def dominates(p, q):
     """
     Test for path domination.  An individual path element *a*
     dominates another path element *b*, written as *a* >= *b* if
-    either *a* == *b* or *a* is a wild card.  A path *p* = *p1*, *p2*,
+    *a* matches every key that *b* matches (see
+    ``component_dominates``).  A path *p* = *p1*, *p2*,
     ..., *pn* dominates another path *q* = *q1*, *q2*, ..., *qm* if
-    *n* == *m* and, for all *i*, *pi* >= *qi*.
+    *n* >= *m*, for all *i* <= *m*, *pi* >= *qi*, and all the
+    elements of *p* after the *m*'th are wild cards.  (Since trailing
+    wild cards in a path also match keys that stop short of them, *p*
+    then matches every key that *q* matches.)  Paths containing ``**``
+    wildcards are compared by following the positions in *p* that
+    each prefix of *q* can reach.
+
+    """
+    if '**' in p or '**' in q:
+        return _multi_dominates(p, q)
+    return (len(p) >= len(q) and
+            all(map(lambda es: component_dominates(*es), zip(p, q))) and
+            all(e == '*' for e in p[len(q):]))
+
+
+def _multi_dominates(p, q):
+    # States are (position in p, whether a ``**`` just before the
+    # position can match more components).
+    def closure(states):
+        todo = list(states)
+        while todo:
+            i, _ = todo.pop()
+            if i < len(p) and p[i] == '**' and (i + 1, True) not in states:
+                states.add((i + 1, True))
+                todo.append((i + 1, True))
+        return states
+
+    states = closure({(0, False)})
+    for c in q:
+        nxt = set()
+        for i, multi in states:
+            if multi:
+                nxt.add((i, True))
+            if i < len(p) and component_dominates(p[i], c):
+                nxt.add((i + 1, p[i] == '**'))
+        states = closure(nxt)
+        if not states:
+            return False
+    return any(all(e in ('*', '**') for e in p[i:]) for i, _ in states)
+
+
+class IdSet:
+    """
+    Set of non-negative integer IDs, stored as a sorted list of disjoint
+    inclusive ranges, so that membership is tested by bisection.  As a
+    key path component, an ID set is written as a bracketed list of
+    IDs and ranges, like ``[1000-1999]`` or ``[3,17,40-49]``, and
+    matches the components that are the decimal representations
+    (without leading zeros) of its members.
+
+    """
+    def __init__(self, ranges):
+        self.starts = []
+        self.ends = []
+        for start, end in sorted(ranges):
+            if self.ends and start <= self.ends[-1] + 1:
+                self.ends[-1] = max(self.ends[-1], end)
+            else:
+                self.starts.append(start)
+                self.ends.append(end)
+
+    @classmethod
+    def from_ids(cls, ids):
+        return cls((i, i) for i in ids)
+
+    def __contains__(self, n):
+        i = bisect_right(self.starts, n) - 1
+        return i >= 0 and n <= self.ends[i]
+
+    def __len__(self):
+        return sum(e - s + 1 for s, e in zip(self.starts, self.ends))
+
+    def __str__(self):
+        return '[' + ','.join(str(s) if s == e else '%d-%d' % (s, e)
+                              for s, e in zip(self.starts, self.ends)) + ']'
+
+    def issuperset(self, other):
+        return all(self._covers(s, e)
+                   for s, e in zip(other.starts, other.ends))
+
+    def overlaps(self, other):
+        return any(self._meets(s, e)
+                   for s, e in zip(other.starts, other.ends))
+
+    def _covers(self, start, end):
+        i = bisect_right(self.starts, start) - 1
+        return i >= 0 and end <= self.ends[i]
+
+    def _meets(self, start, end):
+        # The last range starting no later than ``end`` is the only
+        # one that can reach ``start``.
+        i = bisect_right(self.starts, end) - 1
+        return i >= 0 and self.ends[i] >= start
+
+
+_ID = re.compile(r'(?:0|[1-9][0-9]*)\Z')
+_ID_SET = re.compile(r'\[((?:0|[1-9][0-9]*)(?:-(?:0|[1-9][0-9]*))?'
+                     r'(?:,(?:0|[1-9][0-9]*)(?:-(?:0|[1-9][0-9]*))?)*)\]\Z')
+
+
+@lru_cache(maxsize=1024)
+def id_set(component):
+    """
+    The ``IdSet`` for an ID set key path component, or ``None`` if the
+    component isn't an ID set.
+
+    """
+    if component[:1] != '[' or not _ID_SET.match(component):
+        return None
+    ranges = []
+    for part in component[1:-1].split(','):
+        start, _, end = part.partition('-')
+        ranges.append((int(start), int(end or start)))
+    if any(s > e for s, e in ranges):
+        return None
+    return IdSet(ranges)
+
+
+def is_id(component):
+    """
+    Is a key path component a numeric ID that can be a member of an ID
+    set?
+
+    """
+    return _ID.match(component) is not None
+
+
+def _is_wild(k):
+    return k in ('*', '**') or k[:1] == '[' and id_set(k) is not None
+
+
+def component_matches(k, head):
+    """
+    Does a key path component ``k`` match the component ``head`` of a
+    lookup key?  Wildcards match anything and ID sets match their
+    members.  (Whether ``**`` wildcards match depends on the rest of
+    the key, so they aren't handled here.)
+
+    """
+    if k == head or k == '*':
+        return True
+    ids = id_set(k) if k[:1] == '[' else None
+    return ids is not None and _ID.match(head) is not None and \
+        int(head) in ids
+
+
+def component_dominates(a, b):
+    """
+    Does key path component ``a`` match every key component that ``b``
+    matches?  (A ``**`` wildcard dominates anything, but is only
+    dominated by another ``**`` wildcard.)
+
+    """
+    if a == b or a == '**':
+        return True
+    if b == '**':
+        return False
+    if a == '*':
+        return True
+    ids = id_set(a) if a[:1] == '[' else None
+    if ids is None:
+        return False
+    if _ID.match(b):
+        return int(b) in ids
+    other = id_set(b)
+    return other is not None and ids.issuperset(other)
+
+
+def component_overlap(a, b):
+    """
+    Can key path components ``a`` and ``b`` match any of the same key
+    components?
 
     """
-    return (len(p) == len(q) and
-            all(map(lambda es: es[0] == es[1] or es[0] == '*', zip(p, q))))
+    if a == b or a in ('*', '**') or b in ('*', '**'):
+        return True
+    if a[:1] != '[' and b[:1] != '[':
+        return False
+    sa, sb = id_set(a), id_set(b)
+    if sa is not None and sb is not None:
+        return sa.overlaps(sb)
+    if sa is not None:
+        return _ID.match(b) is not None and int(b) in sa
+    if sb is not None:
+        return _ID.match(a) is not None and int(a) in sb
+    return False